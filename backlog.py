@@ -0,0 +1,267 @@
+"""
+backlog -- keeps frames and batches that haven't made it to google drive from filling the disk while drive can't be reached, by degrading what we keep in steps
+"""
+
+from util import *
+from file_handler import *
+
+import io
+import threading
+from os import replace
+from os.path import abspath, getmtime
+from shutil import disk_usage
+
+# what each tier does on top of the ones before it
+BACKLOG_TIERS = ['normal', 'slow capture', 'motion only', 'downscale', 'evict']
+
+def downscale_frame(frame, scale, quality):
+	"""
+	re-encode a frame (file or (name, bytes) tuple) at <scale> of its size. files are overwritten with the smaller version
+
+	returns: (the frame, bytes saved)
+	"""
+
+	# (PIL is only needed once we're this far behind)
+	from PIL import Image
+	from transcode import encode
+
+	if isinstance(frame, str):
+		with open(frame, 'rb') as f:
+			data = f.read()
+	else:
+		data = frame[1]
+	new_data = encode(Image.open(io.BytesIO(data)), quality, scale)
+	if len(new_data) >= len(data):
+		return frame, 0
+	if not isinstance(frame, str):
+		return (frame[0], new_data), len(data) - len(new_data)
+	with open(frame + '.tmp', 'wb') as f:
+		f.write(new_data)
+	replace(frame + '.tmp', frame)
+	return frame, len(data) - len(new_data)
+
+class BacklogManager:
+	"""
+	watches how many bytes of unsent data are sitting on disk (frames waiting to be packaged, batches waiting to be uploaded, and backed up batches -- staged or not) and how much free space is left on the card, and steps through the tiers as either gets worse:
+		1. capture no faster than one frame every <slow capture secs>
+		2. only keep frames with motion in them (bar a keyframe every <keyframe secs>)
+		3. downscale frames on their way to being packaged to <downscale> of their size
+		4. evict the oldest unsent data until we're back under the last tier's thresholds
+	tier n kicks in once the working set reaches tier_bytes[n-1] or free space drops to tier_free_bytes[n-1], and only lets go once both are back past <release ratio> of them, so we don't flap in and out
+
+	filter is a frame filter for the upload pool (it does tiers 2 and 3), capture_interval slows down whatever capture interval was asked for (tier 1), and check (run every so often) works out the tier and does the evicting. listeners (callables taking the tier) hear about every tier change. every action taken is counted
+	"""
+
+	def __init__(self, staging=None, frame_dir=PATH_TO_IMAGES, batch_dir=".", backup_dir=LOCAL_BACKUP_LOC, tier_bytes=BACKLOG_TIER_BYTES, tier_free_bytes=BACKLOG_TIER_FREE_BYTES, release_ratio=BACKLOG_RELEASE_RATIO, slow_capture_secs=BACKLOG_CAPTURE_SECS, keyframe_secs=BACKLOG_KEYFRAME_SECS, downscale=BACKLOG_DOWNSCALE, downscale_quality=BACKLOG_DOWNSCALE_QUALITY, in_flight=set, disk_free=None):
+		self.staging = staging # (if given, its dirs are used instead of frame_dir and batch_dir)
+		self.frame_dir = frame_dir
+		self.batch_dir = batch_dir
+		self.backup_dir = expanduser(backup_dir)
+		self.tier_bytes = tier_bytes
+		self.tier_free_bytes = tier_free_bytes
+		self.release_ratio = release_ratio
+		self.slow_capture_secs = slow_capture_secs
+		self.keyframe_secs = keyframe_secs
+		self.downscale = downscale
+		self.downscale_quality = downscale_quality
+		self.in_flight = in_flight # callable giving the paths the upload pool is working on, which we mustn't evict
+		self.disk_free = disk_free if disk_free is not None else (lambda: disk_usage(self.batch_dirs()[0]).free)
+		self.tier = 0
+		self.listeners = []
+		self.motion_filter = None # made the first time it's needed (None: not yet, False: can't be had)
+		self.lock = threading.Lock()
+		self.working_bytes = 0
+		self.free_bytes = None
+
+		# stats
+		self.tier_entries = [0]*len(BACKLOG_TIERS) # how many times we've gone into each tier
+		self.num_checks = 0
+		self.num_motion_dropped = 0
+		self.num_downscaled = 0
+		self.bytes_downscaled = 0 # saved by downscaling
+		self.num_evicted = 0
+		self.bytes_evicted = 0
+		self.num_failed_actions = 0
+		self.log = get_logger('backlog.BacklogManager')
+
+	def add_listener(self, listener):
+		self.listeners.append(listener)
+		listener(self.tier)
+
+	def frame_dirs(self):
+		return [self.frame_dir] if self.staging is None else self.staging.frame_dirs()
+
+	def batch_dirs(self):
+		"""
+		returns: every dir batches might be waiting in, the persistent one first
+		"""
+
+		return [self.batch_dir] if self.staging is None else self.staging.batch_dirs()
+
+	def unsent_files(self):
+		"""
+		everything on disk that hasn't made it to drive yet
+
+		returns: list of (path, size, time it's from) -- the time's taken from the name where there is one
+		"""
+
+		paths = []
+		for frame_dir in self.frame_dirs():
+			if isdir(frame_dir):
+				paths.extend(join(frame_dir, x) for x in listdir(frame_dir) if x.endswith('.jpg'))
+		for batch_dir in self.batch_dirs():
+			if isdir(batch_dir):
+				paths.extend(join(batch_dir, x) for x in listdir(batch_dir) if x.endswith('.zip.gpg') or x.endswith(SeekableBatchPacker.suffix))
+		if isdir(self.backup_dir):
+			paths.extend(join(self.backup_dir, x) for x in listdir(self.backup_dir))
+
+		files = []
+		for path in paths:
+			try:
+				size = getsize(path)
+			except OSError:
+				# (packaged or uploaded out from under us)
+				continue
+			_, timestamp = parse_file_name(basename(path))
+			files.append((path, size, timestamp if timestamp is not None else getmtime(path)))
+		return files
+
+	def tier_for(self, working_bytes, free_bytes):
+		"""
+		returns: the tier we should be in (0 for none), given the working set and free space (bytes)
+		"""
+
+		tier = 0
+		for i, (max_bytes, min_free_bytes) in enumerate(zip(self.tier_bytes, self.tier_free_bytes)):
+			if i < self.tier:
+				# already in it -- stay until we're well clear
+				active = (working_bytes >= max_bytes*self.release_ratio) or (free_bytes <= min_free_bytes / self.release_ratio)
+			else:
+				active = (working_bytes >= max_bytes) or (free_bytes <= min_free_bytes)
+			if active:
+				tier = i + 1
+		return tier
+
+	def check(self):
+		"""
+		measure the backlog, move to the tier that goes with it, and evict if it's come to that
+
+		returns: the tier we're in
+		"""
+
+		self.num_checks += 1
+		files = self.unsent_files()
+		self.working_bytes = sum(x[1] for x in files)
+		self.free_bytes = self.disk_free()
+		tier = self.tier_for(self.working_bytes, self.free_bytes)
+		if tier != self.tier:
+			log_level = logging.WARNING if tier > self.tier else logging.INFO
+			self.log.log(log_level, "Backlog tier {} -> {} ({}): {} unsent bytes on disk, {} bytes free".format(self.tier, tier, BACKLOG_TIERS[tier], self.working_bytes, self.free_bytes), extra=log_fields('backlog', tier=tier, working_bytes=self.working_bytes, free_bytes=self.free_bytes))
+			if tier > self.tier:
+				for i in range(self.tier + 1, tier + 1):
+					self.tier_entries[i] += 1
+			self.tier = tier
+			for listener in self.listeners:
+				listener(tier)
+
+		if tier >= BACKLOG_TIERS.index('evict'):
+			self.evict(files)
+		return self.tier
+
+	def evict(self, files):
+		"""
+		delete the oldest of the given unsent files (bar anything the upload pool is working on) until we're back under the last tier's thresholds
+		"""
+
+		max_bytes = self.tier_bytes[-1]*self.release_ratio
+		min_free_bytes = self.tier_free_bytes[-1] / self.release_ratio
+		in_flight = set(abspath(x) for x in self.in_flight())
+		num_evicted = 0
+		bytes_evicted = 0
+		for path, size, _ in sorted(files, key=lambda x: x[2]):
+			if (self.working_bytes < max_bytes) and (self.free_bytes > min_free_bytes):
+				break
+			if abspath(path) in in_flight:
+				continue
+			try:
+				remove(path)
+			except OSError as e:
+				self.log.error("Couldn't evict {} from the backlog: {}".format(path, e))
+				self.num_failed_actions += 1
+				continue
+			self.log.warning("Evicted {} ({} bytes) from the backlog".format(path, size), extra=log_fields(rate_limit='backlog eviction'))
+			self.working_bytes -= size
+			self.free_bytes += size
+			num_evicted += 1
+			bytes_evicted += size
+
+		self.num_evicted += num_evicted
+		self.bytes_evicted += bytes_evicted
+		if num_evicted:
+			self.log.warning("Evicted the oldest {} unsent files ({} bytes) to keep the disk from filling up".format(num_evicted, bytes_evicted), extra=log_fields('backlog', evicted=num_evicted, evicted_bytes=bytes_evicted))
+
+	def capture_interval(self, secs):
+		"""
+		returns: the capture interval to use when <secs> is asked for, given the tier we're in
+		"""
+
+		if self.tier >= BACKLOG_TIERS.index('slow capture'):
+			return max(secs, self.slow_capture_secs)
+		return secs
+
+	def get_motion_filter(self):
+		with self.lock:
+			if self.motion_filter is None:
+				try:
+					from motion import MotionFilter
+				except ImportError as e:
+					self.log.error("Can't keep only motion frames while backed up without numpy and PIL ({}), skipping that step".format(e))
+					self.motion_filter = False
+				else:
+					self.motion_filter = MotionFilter(keyframe_secs=self.keyframe_secs)
+			return self.motion_filter
+
+	def filter(self, frames:list):
+		"""
+		frame filter for the upload pool: past tier 2 only frames with motion in them are kept, past tier 3 they're downscaled too
+
+		returns: the frames to package
+		"""
+
+		tier = self.tier
+		if tier >= BACKLOG_TIERS.index('motion only'):
+			motion_filter = self.get_motion_filter()
+			if motion_filter:
+				num_frames = len(frames)
+				frames = motion_filter.filter(frames)
+				self.num_motion_dropped += num_frames - len(frames)
+		if tier >= BACKLOG_TIERS.index('downscale'):
+			downscaled = []
+			for frame in frames:
+				try:
+					frame, saved = downscale_frame(frame, self.downscale, self.downscale_quality)
+				except Exception as e:
+					# (send it as it is)
+					self.log.debug("Couldn't downscale frame {}: {}".format(frame_name(frame), e), extra=log_fields(rate_limit='backlog downscale failed'))
+					self.num_failed_actions += 1
+				else:
+					self.num_downscaled += 1
+					self.bytes_downscaled += saved
+				downscaled.append(frame)
+			frames = downscaled
+		return frames
+
+	def stats(self):
+		return {
+			'tier': self.tier,
+			'working_bytes': self.working_bytes,
+			'free_bytes': self.free_bytes,
+			'checks': self.num_checks,
+			'tier_entries': dict(zip(BACKLOG_TIERS[1:], self.tier_entries[1:])),
+			'motion_dropped': self.num_motion_dropped,
+			'downscaled': self.num_downscaled,
+			'bytes_downscaled': self.bytes_downscaled,
+			'evicted': self.num_evicted,
+			'bytes_evicted': self.bytes_evicted,
+			'failed_actions': self.num_failed_actions,
+		}
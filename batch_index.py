@@ -0,0 +1,108 @@
+"""
+batch_index -- local SQLite index of everything we've uploaded, so that purging and lookups don't need to list google drive
+"""
+
+from util import *
+
+import sqlite3
+import threading
+from time import time
+
+class BatchIndex:
+	"""
+	one row per uploaded file, keyed by drive file ID
+
+	safe to share between the upload worker threads
+	"""
+
+	def __init__(self, db_path=BATCH_INDEX_DB_LOC):
+		self.conn = sqlite3.connect(db_path, check_same_thread=False)
+		self.lock = threading.Lock()
+		self.log = get_logger('batch_index.BatchIndex')
+		with self.lock, self.conn:
+			self.conn.execute("CREATE TABLE IF NOT EXISTS batches (file_id TEXT PRIMARY KEY, name TEXT NOT NULL, host TEXT, start_time REAL, end_time REAL, size INTEGER, md5 TEXT, num_frames INTEGER, uploaded_at REAL, parent_id TEXT)")
+			# (indexes from before files could be in subfolders don't have this yet)
+			if 'parent_id' not in [x[1] for x in self.conn.execute("PRAGMA table_info(batches)").fetchall()]:
+				self.conn.execute("ALTER TABLE batches ADD COLUMN parent_id TEXT")
+			self.conn.execute("CREATE INDEX IF NOT EXISTS batches_by_end_time ON batches (end_time)")
+			self.conn.execute("CREATE INDEX IF NOT EXISTS batches_by_host_start_time ON batches (host, start_time)")
+
+	def add(self, file_id, name, host, start_time, end_time, size=None, md5=None, num_frames=0, parent_id=None, replace=True):
+		"""
+		index a file. unless replacing, a file that's already indexed is left as it is
+
+		returns: whether a row was written
+		"""
+
+		with self.lock, self.conn:
+			return 0 < self.conn.execute("INSERT OR {} INTO batches".format('REPLACE' if replace else 'IGNORE') + " (file_id, name, host, start_time, end_time, size, md5, num_frames, uploaded_at, parent_id) VALUES (?,?,?,?,?,?,?,?,?,?)", (file_id, name, host, start_time, end_time, size, md5, num_frames, time(), parent_id)).rowcount
+
+	def remove(self, file_ids):
+		with self.lock, self.conn:
+			self.conn.executemany("DELETE FROM batches WHERE file_id = ?", [(x,) for x in file_ids])
+
+	def remove_in_folders(self, folder_ids):
+		"""
+		forget every file in the given drive folders (e.g. once the folders have been deleted)
+		"""
+
+		with self.lock, self.conn:
+			self.conn.executemany("DELETE FROM batches WHERE parent_id = ?", [(x,) for x in folder_ids])
+
+	def expired(self, cutoff):
+		"""
+		every file whose newest capture is older than the cutoff (s since epoch)
+
+		returns: list of dicts with 'id', 'name' and 'parent_id' (the folder it's in on drive, if known)
+		"""
+
+		with self.lock:
+			rows = self.conn.execute("SELECT file_id, name, parent_id FROM batches WHERE end_time < ? ORDER BY end_time", (cutoff,)).fetchall()
+		return [{'id': file_id, 'name': name, 'parent_id': parent_id} for file_id, name, parent_id in rows]
+
+	def in_range(self, host, start_time, end_time):
+		"""
+		every file from the given host with captures in the given time range (s since epoch)
+
+		returns: list of dicts with all of the indexed fields, oldest first
+		"""
+
+		with self.lock:
+			cursor = self.conn.execute("SELECT * FROM batches WHERE host = ? AND start_time <= ? AND end_time >= ? ORDER BY start_time", (host, end_time, start_time))
+			columns = [x[0] for x in cursor.description]
+			return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+	def count(self):
+		with self.lock:
+			return self.conn.execute("SELECT COUNT(*) FROM batches").fetchone()[0]
+
+	def reconcile(self, remote_files, listed_at=None):
+		"""
+		bring the index in line with a full listing of what's actually on drive (dicts with at least 'id' and 'name', and 'parents' if known): forget anything that's gone, and add anything we didn't know about (times taken from the file name)
+
+		<listed at> is when the listing was started (s since epoch). anything indexed since then may only be missing from it because it was uploaded while the listing was under way, so it's never taken to be gone. likewise a file that gets indexed by its upload while we're reconciling is left as the upload indexed it
+
+		returns: (number of rows added, number of rows removed)
+		"""
+
+		remote_by_id = {x['id']: x for x in remote_files}
+		with self.lock:
+			rows = self.conn.execute("SELECT file_id, uploaded_at FROM batches").fetchall()
+		local_ids = set(x[0] for x in rows)
+
+		gone = set(file_id for file_id, uploaded_at in rows if (file_id not in remote_by_id) and ((listed_at is None) or (uploaded_at is None) or (uploaded_at < listed_at)))
+		self.remove(gone)
+
+		num_added = 0
+		for file_id in set(remote_by_id) - local_ids:
+			file = remote_by_id[file_id]
+			host, timestamp = parse_file_name(file['name'])
+			if timestamp is None:
+				# not one of ours -- leave it out so we never purge it
+				continue
+			if self.add(file_id, file['name'], host, timestamp, timestamp, int(file['size']) if 'size' in file else None, file.get('md5Checksum'), parent_id=(file.get('parents') or [None])[0], replace=False):
+				num_added += 1
+
+		if gone or num_added:
+			self.log.warning("Reconciled index with google drive: added {} missing files, removed {} files no longer on drive".format(num_added, len(gone)))
+		return num_added, len(gone)
@@ -0,0 +1,48 @@
+"""
+bench_encryption -- microbenchmark for per-batch encryption latency
+
+compares the old path (a fresh GPG object + passphrase read on every call) against the long-lived Encryptor, running gpg once per batch and encrypting in-process. every path is told not to compress, same as batches are, so the only difference is how the encryption gets done
+
+usage: python bench_encryption.py [num_batches] [batch_bytes]
+"""
+
+from file_handler import *
+
+import sys
+from os import urandom
+from statistics import mean, median
+
+def time_calls(fn, payload, num_batches):
+	times = []
+	for i in range(num_batches):
+		stream = io.BytesIO(payload)
+		start_time = time()
+		fn(stream, "_BENCH_{}.gpg".format(i))
+		times.append(time() - start_time)
+		remove("_BENCH_{}.gpg".format(i))
+	return times
+
+def one_off_gpg(stream, enc_filename):
+	"""
+	what encrypting a batch used to cost: a new GPG object and the keyfile read every time
+	"""
+
+	return Encryptor(engine='gpg').encrypt_stream(stream, enc_filename)
+
+def report(label, times):
+	print("{:<24} mean {:.4f} s  median {:.4f} s  max {:.4f} s".format(label, mean(times), median(times), max(times)))
+
+if __name__ == "__main__":
+	num_batches = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+	batch_bytes = int(sys.argv[2]) if len(sys.argv) > 2 else MAX_FILE_SIZE_PER_UPLOAD
+
+	# random bytes are about as compressible as a zip full of JPEGs (i.e. not at all)
+	payload = urandom(batch_bytes)
+	print("Encrypting {} batches of {} bytes".format(num_batches, batch_bytes))
+
+	report("one-off gpg", time_calls(one_off_gpg, payload, num_batches))
+	report("persistent gpg", time_calls(Encryptor(engine='gpg').encrypt_stream, payload, num_batches))
+	start_time = time()
+	encryptor = Encryptor(engine='aead')
+	print("(in-process key derived once in {:.4f} s)".format(time() - start_time))
+	report("persistent in-process", time_calls(encryptor.encrypt_stream, payload, num_batches))
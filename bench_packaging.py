@@ -0,0 +1,40 @@
+"""
+bench_packaging -- benchmark for draining a packaging backlog
+
+packs the same backlog of synthetic frames with different numbers of packaging workers and reports frames per second for each
+
+usage: python bench_packaging.py [num_frames] [frame_bytes] [max worker count]
+"""
+
+from file_handler import *
+
+import sys
+from os import urandom, cpu_count
+
+def drain(frames, num_workers):
+	file_handler = FileHandler(num_workers=num_workers)
+	# start the pool up front so that process startup isn't counted against the first run
+	if num_workers > 1:
+		file_handler.executor = process_pool(num_workers)
+	try:
+		start_time = time()
+		batches = file_handler.compress_and_encrypt_batch(frames)
+		elapsed = time() - start_time
+	finally:
+		file_handler.shutdown()
+	for batch in batches:
+		remove(batch)
+	return elapsed, len(batches)
+
+if __name__ == "__main__":
+	num_frames = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+	frame_bytes = int(sys.argv[2]) if len(sys.argv) > 2 else 150000
+	max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else (cpu_count() or 1)
+
+	# in-memory frames so the backlog doesn't have to be rebuilt on disk for every run. random bytes are about as compressible as a JPEG (i.e. not at all)
+	frames = [("bench_{}d0.jpg".format(i), urandom(frame_bytes)) for i in range(num_frames)]
+	print("Draining a backlog of {} frames of {} bytes ({} byte batches)".format(num_frames, frame_bytes, MAX_FILE_SIZE_PER_UPLOAD))
+
+	for num_workers in range(1, max_workers + 1):
+		elapsed, num_batches = drain(frames, num_workers)
+		print("{} worker(s): {} batches in {:.2f} s  {:.1f} frames/s".format(num_workers, num_batches, elapsed, num_frames / elapsed))
@@ -0,0 +1,49 @@
+"""
+bench_startup -- what svlc spends its time on before it can capture and before it can upload
+
+times (each in a fresh interpreter) importing everything capture needs, importing the google drive stack on top of that, and building a drive service from the cached discovery document vs. letting googleapiclient find it itself. once svlc is running, the actual time to first frame and first upload are in the log ("Startup: ...") and the stats log's startup profile
+
+usage: python bench_startup.py [repeats]
+"""
+
+import sys
+import subprocess
+from statistics import median
+from time import perf_counter
+
+CAPTURE_PATH = "import recorder, file_handler, uploader, batch_index, upload_journal, scheduler, log_shipper"
+DRIVE_STACK = CAPTURE_PATH + "; import gdrive_handler"
+# no credentials needed just to build the service object
+BUILD_FROM_CACHE = DRIVE_STACK + "; import httplib2, time; t = time.perf_counter(); gdrive_handler.build_from_document(gdrive_handler.load_discovery_doc(), http=httplib2.Http()); print(time.perf_counter() - t)"
+BUILD_FROM_SCRATCH = DRIVE_STACK + "; import httplib2, time; t = time.perf_counter(); gdrive_handler.build('drive', 'v3', http=httplib2.Http()); print(time.perf_counter() - t)"
+
+def time_in_fresh_interpreter(code, repeats):
+	"""
+	returns: median wall time to run the given code in a new interpreter (incl. interpreter startup)
+	"""
+
+	times = []
+	for i in range(repeats):
+		start_time = perf_counter()
+		subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL)
+		times.append(perf_counter() - start_time)
+	return median(times)
+
+def time_reported(code, repeats):
+	"""
+	returns: median of the time the given code prints out itself
+	"""
+
+	return median(float(subprocess.run([sys.executable, "-c", code], check=True, capture_output=True).stdout.decode().split()[-1]) for i in range(repeats))
+
+if __name__ == "__main__":
+	repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+	bare = time_in_fresh_interpreter("pass", repeats)
+	capture_path = time_in_fresh_interpreter(CAPTURE_PATH, repeats)
+	drive_stack = time_in_fresh_interpreter(DRIVE_STACK, repeats)
+	print("{:<36} {:.3f} s".format("interpreter startup", bare))
+	print("{:<36} {:.3f} s".format("imports needed to capture", capture_path - bare))
+	print("{:<36} {:.3f} s".format("google drive stack on top of that", drive_stack - capture_path))
+	print("{:<36} {:.3f} s".format("build service (cached discovery doc)", time_reported(BUILD_FROM_CACHE, repeats)))
+	print("{:<36} {:.3f} s".format("build service (googleapiclient)", time_reported(BUILD_FROM_SCRATCH, repeats)))
@@ -6,22 +6,122 @@ define constants for svlc
 FILE_DEC_SEPARATOR = "d" # what character do we use to separate integer parts from decimal parts in filenames?
 
 # timing constants
-SECS_PER_CYCLE = 0.5 # run at 2Hz
 #TODO we may just want to upload when the compressed file gets to 5MB [get a rough estimate beforehand of how long/how many images this will take]
 SECS_PER_UPLOAD = 60 # upload every minute
-SECS_PER_LOG_UPLOAD = 3600 # logs very hour
+SECS_PER_LOG_UPLOAD = 3600 # ship whatever's been added to the log every hour
 SECS_PER_PURGE = 300 # purge olds every five minutes
 MAX_AGE_BEFORE_PURGE = 86400 # purge files older than 1 day
 SECS_PER_STILL_CAP = 1 # capture 1 image every <value> seconds (TODO: needs tuning)
+SECS_PER_CONTINUOUS_CAP = 0.25 # in continuous mode, keep at most 1 frame every <value> seconds
+SECS_PER_RETRY_SWEEP = 30 # look for failed/interrupted batches that are due for another go every 30 seconds
+SECS_PER_INDEX_RECONCILE = 21600 # check the local batch index against google drive every six hours
+SECS_PER_STATS_LOG = 300 # log job timing stats every five minutes
 
 # google drive related constants
 # If modifying these scopes, delete the file token.json.
 GDRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
 ACTIVE_GDRIVE_DIR_NAME = 'sv_dev'
-# TODO: figure out how to do bigger uploads
-MAX_FILE_SIZE_PER_UPLOAD = 5000000 # bytes
+GDRIVE_FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+REMOTE_LAYOUT = 'flat' # 'flat' uploads everything straight into ACTIVE_GDRIVE_DIR_NAME. 'hour' or 'day' files batches under <host>/<UTC hour or day> folders, so purging deletes whole folders at once (a batch then stays up to an hour/day past MAX_AGE_BEFORE_PURGE) and finding batches only lists folders that could hold them
+GDRIVE_LIST_PAGE_SIZE = 1000 # max files per page when listing (1000 is the most drive will give us)
+GDRIVE_MAX_BATCH_REQUESTS = 100 # max requests per batch HTTP call (drive's limit is 100)
+GDRIVE_DISCOVERY_CACHE_LOC = "./drive_v3_discovery.json" # local copy of the drive API discovery document, so building a service never has to go looking for it
+MAX_FILE_SIZE_PER_UPLOAD = 50000000 # bytes. uploads are resumable so this is just a target batch size (only STREAM_SPOOL_BYTES of a batch is ever built in memory)
+UPLOAD_CHUNK_SIZE = 4*1024*1024 # bytes per resumable upload chunk (must be a multiple of 256KiB)
+MAX_UPLOAD_RETRIES = 5 # how many times in a row we'll try to resume an interrupted upload before giving up on it
+UPLOAD_RETRY_BASE_SECS = 1 # base delay for exponential backoff between upload resume attempts
+VERIFY_MODE = 'checksum' # 'checksum' compares our MD5 against the one drive reports, 'download' downloads and compares every upload
+VERIFY_AUDIT_EVERY_N = 20 # in checksum mode, still download and compare 1 in every N uploads as an audit (0 to never audit)
+UPLOAD_RETRY_BACKOFF_BASE_SECS = 60 # after a batch fails, wait this long before the first retry, doubling every time it fails again...
+UPLOAD_RETRY_BACKOFF_MAX_SECS = 3600 # ...up to this long
+DRIVE_HANDLER_RETRY_BASE_SECS = 5 # if an upload worker can't set up google drive (e.g. we booted offline), wait this long before trying again, doubling every time it fails...
+DRIVE_HANDLER_RETRY_MAX_SECS = 300 # ...up to this long
+UPLOAD_WORKERS = 2 # number of background threads uploading batches in parallel
+UPLOAD_QUEUE_DEPTH = 8 # max number of packaging/upload jobs allowed to wait for a worker before new ones get turned away
+UPLOAD_POOL_STOP_SECS = 30 # on the way out, how long to wait for the packaging/uploads under way to finish
+ADAPTIVE_UPLOADS = False # tune the batch size and upload interval to the uplink as uploads succeed and fail (MAX_FILE_SIZE_PER_UPLOAD and SECS_PER_UPLOAD are where it starts)
+ADAPTIVE_BATCH_MIN_BYTES = 1000000 # smallest batch size we'll shrink to on a bad link...
+ADAPTIVE_BATCH_MAX_BYTES = 150000000 # ...and the biggest we'll grow to on a good one
+ADAPTIVE_UPLOAD_MIN_SECS = 30 # most often we'll hand frames over for upload...
+ADAPTIVE_UPLOAD_MAX_SECS = 900 # ...and the least often (while failing, or while batches are slow to fill)
+ADAPTIVE_UPLOAD_TARGET_SECS = 60 # grow batches no bigger than the measured throughput gets up in this long
+ADAPTIVE_UPLOAD_TIMEOUT_SECS = 180 # an upload that takes longer than this counts against the batch size like a failure
+ADAPTIVE_GROW_FACTOR = 1.5 # batch size multiplier after an upload goes well...
+ADAPTIVE_SHRINK_FACTOR = 0.5 # ...and after one fails or times out
+ADAPTIVE_STATS_ALPHA = 0.3 # weight of the newest upload in the throughput/latency/error rate moving averages
+ADAPTIVE_HISTORY_LEN = 100 # how many batch size/interval changes to keep for stats
+
+# capture constants
+CAPTURE_MODE = 'still' # 'still' writes one JPEG per capture job, 'continuous' streams frames off the video port into an in-memory ring buffer
+CAMERA_RESOLUTION = (1024,768)
+CAMERA_FRAMERATE = 10 # frames per second the camera streams at in continuous mode (we only keep as many as SECS_PER_CONTINUOUS_CAP allows)
+RING_BUFFER_FRAMES = 480 # max frames held in memory waiting to be packaged before the oldest get overwritten (2 upload cycles at 4 fps)...
+RING_BUFFER_MAX_BYTES = 64000000 # ...or max bytes of them, whichever comes first
+MOTION_FILTER = False # drop frames with no motion in them before packaging (needs numpy and PIL)
+MOTION_LUMA_SIZE = (64,48) # frames are compared at this (tiny) resolution
+MOTION_BACKGROUND_ALPHA = 0.05 # how quickly the background model takes on each new frame (0-1)
+MOTION_PIXEL_THRESHOLD = 25 # how far (0-255) a pixel's brightness has to be off the background to count as changed
+MOTION_AREA_THRESHOLD = 0.01 # fraction of pixels that have to change for a frame to count as motion
+MOTION_KEYFRAME_SECS = 60 # keep at least one frame every <value> seconds even if nothing is happening
+CAPTURE_RATE_CONTROL = False # capture faster while there's motion and slower while there isn't (needs numpy and PIL)
+SECS_PER_CAP_MIN = 0.25 # fastest we'll capture (only while there's activity)...
+SECS_PER_CAP_MAX = 4 # ...and the slowest, once things have gone quiet
+SECS_PER_RATE_CONTROL = 1 # how often the newest frame is checked for motion
+RATE_CONTROL_ACTIVE_THRESHOLD = 0.02 # fraction of pixels changed that counts as activity (goes straight to the fastest rate)...
+RATE_CONTROL_QUIET_THRESHOLD = 0.005 # ...and below which it counts as quiet. anything in between keeps the current rate
+RATE_CONTROL_HOLD_SECS = 30 # how long it has to stay quiet before we start backing off
+RATE_CONTROL_HISTORY_LEN = 100 # how many rate changes to keep for stats
+TRANSCODE = False # re-encode frames that are over TRANSCODE_MAX_BYTES_PER_FRAME before packaging (needs PIL)
+TRANSCODE_MAX_BYTES_PER_FRAME = 150000 # per frame byte budget
+TRANSCODE_MIN_QUALITY = 40 # lowest JPEG quality we'll go to before downscaling instead...
+TRANSCODE_MAX_QUALITY = 90 # ...and the highest we'll bother with
+TRANSCODE_QUALITY_STEP = 5 # how far above the last quality that worked for a scene we try each time
+TRANSCODE_MAX_ENCODES = 5 # most encodes we'll spend searching for a quality (per scale)
+TRANSCODE_MIN_SCALE = 0.25 # smallest we'll downscale a frame to (fraction of each dimension)
+TRANSCODE_WORKERS = 3 # worker processes for re-encoding (leave a core for capture)
 
 # file handling constants
 LOCAL_BACKUP_LOC = "~/local_bak/"
 ENC_PASSPHRASE_LOC = "./enc_pw.txt" # TODO make this file and make sure it has proper perms (640)
 PATH_TO_IMAGES = "./working_images/"
+BATCH_INDEX_DB_LOC = "./batch_index.sqlite3" # local index of everything we've uploaded
+UPLOAD_JOURNAL_DB_LOC = "./upload_journal.sqlite3" # where each batch is on its way to google drive
+BACKLOG_CONTROL = True # keep unsent frames/batches from filling the disk while google drive can't be reached (see backlog.py)
+SECS_PER_BACKLOG_CHECK = 30 # how often we measure the backlog
+BACKLOG_TIER_BYTES = (500000000, 1000000000, 1500000000, 2000000000) # unsent bytes on disk at which each tier kicks in: slow capture, motion only, downscale, evict...
+BACKLOG_TIER_FREE_BYTES = (2000000000, 1000000000, 500000000, 250000000) # ...or the free space left on the disk at which it does
+BACKLOG_RELEASE_RATIO = 0.8 # a tier only lets go once the backlog is under this fraction of its threshold (and free space over its threshold divided by this)
+BACKLOG_CAPTURE_SECS = 10 # capture no faster than 1 image every <value> seconds while backed up
+BACKLOG_KEYFRAME_SECS = 600 # while only keeping motion frames, still keep one every <value> seconds
+BACKLOG_DOWNSCALE = 0.5 # fraction of each dimension frames are downscaled to while badly backed up (needs PIL)...
+BACKLOG_DOWNSCALE_QUALITY = 70 # ...and the JPEG quality they're re-encoded at
+STAGING = False # keep frames and freshly packed batches in a RAM-backed dir (STAGING_DIR) instead of on the SD card until they're uploaded (see staging.py)
+STAGING_DIR = "/dev/shm/svlc/" # should be on a tmpfs
+STAGING_MAX_BYTES = 64000000 # most we'll keep in staging -- past this, new frames and batches go to the card and the oldest staged frames are spilled there...
+STAGING_SPILL_RATIO = 0.8 # ...until staging is back under this fraction of it
+STAGING_STALL_SECS = 900 # a batch that's sat in staging this long means uploads have stalled: everything goes to the card until they're moving again
+SECS_PER_STAGING_CHECK = 10 # how often we measure staging
+LOG_SHIP_DB_LOC = "./log_ship.sqlite3" # how much of each log file we've already shipped to google drive
+LOG_ROTATE_BYTES = 10000000 # once the log is at least this big, it's rotated out and a fresh one started (shipped or not)
+LOG_ROTATE_KEEP = 2 # how many rotated (and fully shipped) logs to keep around locally
+LOG_SEGMENT_MAX_BYTES = 1000000 # at most this much of a log goes up in one segment
+LOG_RATE_LIMIT_LINES = 10 # noisy log lines (e.g. one per file removed) are let through at most this many times...
+LOG_RATE_LIMIT_SECS = 60 # ...every <value> seconds
+STREAM_BATCHES = True # build batch archives in memory and stream them straight into the encryptor so that only the encrypted batch ever touches the disk
+STREAM_SPOOL_BYTES = 16000000 # most of a batch that's built in memory when streaming -- anything bigger is spooled out to a temp file next to the batch
+BATCH_FORMAT = 'zip' # 'zip' encrypts each batch archive as a whole, 'seekable' encrypts every frame on its own behind an encrypted index so single frames can be fetched with ranged downloads (one encryption per frame, so it needs ENCRYPTION_ENGINE 'aead' -- zip batches are packed instead with gpg)
+SEEKABLE_INDEX_PREFETCH_BYTES = 65536 # how much of the front of a seekable batch we grab at once when reading its index (more is only fetched if the index doesn't fit)
+RESTORE_WORKERS = 4 # batches downloaded/decrypted at once when restoring frames from google drive
+RESTORE_DIR = "./restored/" # where restored frames go by default (sorted into <host>/<date>/<hour> folders)
+RESTORE_PACK_SLACK_SECS = ADAPTIVE_UPLOAD_MAX_SECS # without the batch index, batches packed more than this long after a time range ends are taken to have none of its frames (the longest we go between uploads)
+PACKAGING_WORKERS = 1 # worker processes packing batches in parallel (only worth it for backlogs of more than one batch -- 3 on a pi 4 leaves a core for capture)
+COMPRESS_SAMPLE_BYTES = 4096 # how much of each file we look at to decide whether it's worth compressing
+COMPRESS_MIN_SAVING = 0.05 # compress only if a quick pass over the sample saves at least this fraction of it
+COMPRESSIBLE_CODEC = 'deflate' # what to compress worthwhile content with: 'deflate', 'bzip2', 'lzma' or 'zstd' (python 3.14+)
+COMPRESSIBLE_LEVEL = 6 # compression level for deflate/bzip2/zstd (zipfile always uses the default preset for lzma)
+ENCRYPTION_ENGINE = 'aead' # 'aead' encrypts in-process with AES-256-GCM (needs the cryptography package), 'gpg' runs a gpg process for every batch/log segment/frame. files made by either can always be decrypted
+AEAD_CHUNK_BYTES = 1024*1024 # plaintext bytes per separately authenticated chunk of an in-process encrypted file (encrypting to disk never holds much more than this in memory)
+AEAD_SCRYPT_LOG2_COST = 15 # scrypt work factor (as a power of 2) for deriving the in-process encryption key from the passphrase -- done once per run (2^15 takes 32MB of RAM)
+GPG_BATCH_COMPRESS_ALGO = 'none' # archives are already compressed -- don't make GPG compress them again
+ENC_OVERHEAD_BYTES = 1024 # fixed number of bytes we assume encryption adds on top of the archive (headers, salt, MDC/tags). deliberately pessimistic
+ENC_OVERHEAD_RATIO = 0.005 # starting guess for the size-proportional part of the encryption overhead -- refined from measurements as we go
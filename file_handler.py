@@ -4,19 +4,36 @@ file_handler -- handles all of the local file manipulation (incl. compression, e
 
 from util import *
 
-from os.path import isdir, getsize
-from os import mkdir, remove
+from os.path import isdir, isfile, getsize, basename, expanduser, join, abspath, dirname
+from os import makedirs, remove, listdir, replace
 from shutil import move
 import logging
 from filecmp import cmp as compare_files
 from gnupg import GPG
+from time import time, process_time
+from hashlib import md5
 import zipfile
+import zlib
+import io
+import json
+import struct
+from os import urandom
+from tempfile import SpooledTemporaryFile
+try:
+	# (only needed for in-process encryption, see Encryptor)
+	from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+	from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+	from cryptography.exceptions import InvalidTag
+except ImportError:
+	AESGCM = None
 
 log = get_logger('file_handler')
 
 def local_backup(files_to_perm_backup):
 	"""
 	Perform a local backup of the given files
+
+	returns: the new paths of the files
 	"""
 
 	log.warning("Performing local backup of the following files due to upload verification failure: ")
@@ -24,36 +41,90 @@ def local_backup(files_to_perm_backup):
 		log.warning(file)
 
 	# create local backup dir if it does not exist already
-	if not isdir(LOCAL_BACKUP_LOC):
+	backup_dir = expanduser(LOCAL_BACKUP_LOC)
+	if not isdir(backup_dir):
 		log.info("Local backup directory does not already exist, creating.")
-		mkdir(LOCAL_BACKUP_LOC)
+		makedirs(backup_dir)
 
 	# move all files from their current location into the backup dir
+	new_paths = []
 	for file in files_to_perm_backup:
-		move(file,"{}/{}".format(LOCAL_BACKUP_LOC,file))
+		new_path = join(backup_dir, basename(file))
+		if abspath(file) != abspath(new_path):
+			move(file,new_path)
+		new_paths.append(new_path)
 
 	log.warning("Local backup complete")
+	return new_paths
+
+def backed_up_files():
+	"""
+	list everything currently sitting in the local backup dir
+	"""
+
+	backup_dir = expanduser(LOCAL_BACKUP_LOC)
+	if not isdir(backup_dir):
+		return []
+	return [join(backup_dir, x) for x in sorted(listdir(backup_dir))]
+
+# codecs we can use for content that's worth compressing (name -> zipfile compression type). zstd needs python 3.14+
+COMPRESSION_CODECS = {'deflate': zipfile.ZIP_DEFLATED, 'bzip2': zipfile.ZIP_BZIP2, 'lzma': zipfile.ZIP_LZMA}
+if hasattr(zipfile, 'ZIP_ZSTANDARD'):
+	COMPRESSION_CODECS['zstd'] = zipfile.ZIP_ZSTANDARD
+CODEC_NAMES = dict((v, k) for k, v in COMPRESSION_CODECS.items())
+CODEC_NAMES[zipfile.ZIP_STORED] = 'stored'
+
+# leading bytes of formats that are already compressed, so there's no point trying again
+COMPRESSED_MAGIC = [
+	b'\xff\xd8\xff', # JPEG
+	b'\x89PNG', # PNG
+	b'\x1f\x8b', # gzip
+	b'PK\x03\x04', # zip
+	b'\xfd7zXZ', # xz
+	b'BZh', # bzip2
+]
+
+def choose_codec(sample:bytes, codec=COMPRESSIBLE_CODEC, min_saving=COMPRESS_MIN_SAVING):
+	"""
+	given the first few KB of a file, decide whether it's worth compressing
+
+	already compressed formats are recognised by their magic number. anything else gets a quick (level 1) deflate of the sample, and if that doesn't save at least <min_saving> of it, neither will anything else
+
+	returns: the zipfile compression type to use for it
+	"""
+
+	if any(sample.startswith(x) for x in COMPRESSED_MAGIC):
+		return zipfile.ZIP_STORED
+	if (0 == len(sample)) or (len(zlib.compress(sample, 1)) > len(sample)*(1 - min_saving)):
+		return zipfile.ZIP_STORED
+	if codec not in COMPRESSION_CODECS:
+		log.warning("Compression codec {} isn't available here, using deflate instead".format(codec))
+		codec = 'deflate'
+	return COMPRESSION_CODECS[codec]
+
+def frame_sample(frame, num_bytes=COMPRESS_SAMPLE_BYTES):
+	if isinstance(frame, str):
+		with open(frame, 'rb') as f:
+			return f.read(num_bytes)
+	return frame[1][:num_bytes]
 
 def compress_files(filenames,dest_filename):
 	zf = zipfile.ZipFile(dest_filename, mode='w')
 	try:
 		for filename in filenames:
-			zf.write(filename, filename, compress_type=zipfile.ZIP_DEFLATED)
+			zf.write(filename, filename, compress_type=choose_codec(frame_sample(filename)), compresslevel=COMPRESSIBLE_LEVEL)
 	except FileNotFoundError as e:
 		log.error("Caught FileNotFoundError while attempting to create zip file: {}".format(e))
 	finally:
 		zf.close()
 
-def encrypt_file(filename,enc_filename):
-	log.info("Encrypting {} using passphrase".format(filename))
-	# disable logging for all GPG related things because it is way too damned noisy -_-
-	log.setLevel(logging.CRITICAL)
-	gpg = GPG()
-	log.setLevel(logging.DEBUG)
-	key = ""
+def read_passphrase(passphrase_loc=ENC_PASSPHRASE_LOC):
+	"""
+	read the encryption passphrase from the keyfile
+	"""
 
-	# read key from file
-	with open(ENC_PASSPHRASE_LOC,'r') as keyfile:
+	key = ""
+	with open(passphrase_loc,'r') as keyfile:
 		key = keyfile.readline()
 		# remove characters that will cause GPG to think this is an "incorrect passphrase" smdh
 		key = key.replace('\n','').replace('\r','')
@@ -61,109 +132,931 @@ def encrypt_file(filename,enc_filename):
 	if "" == key:
 		log.error("Error reading key from keyfile: empty string")
 
-	# do the encryption
-	with open(filename,'rb') as raw_file:
+	return key
+
+# AEAD encrypted files start with a plaintext header (magic, flags, scrypt cost, KDF salt, nonce prefix, plaintext bytes per chunk) and are then split into chunks, each AES-GCM encrypted on its own with the header (and whether it's the last chunk) as associated data. chunk <i>'s nonce is the prefix followed by <i>
+AEAD_MAGIC = b'SVLCAE01'
+AEAD_HEADER = struct.Struct('>8sBB16s8sI')
+AEAD_FLAG_ZLIB = 1 # the plaintext was deflated before it was encrypted
+AEAD_TAG_BYTES = 16
+
+def aead_plaintext_chunks(stream, chunk_bytes, compress=False):
+	"""
+	read the given (binary) stream a chunk at a time, deflating it on the way if asked to
+
+	yields: (chunk, whether it's the last one). every chunk but the last is exactly <chunk bytes> long, the last may be empty
+	"""
+
+	compressor = zlib.compressobj() if compress else None
+	pending = bytearray()
+	done = False
+	while not done:
+		data = stream.read(chunk_bytes)
+		done = 0 == len(data)
+		if compressor is not None:
+			data = compressor.flush() if done else compressor.compress(data)
+		pending += data
+		# (a full chunk is held back until we know whether anything comes after it)
+		while len(pending) > chunk_bytes:
+			yield bytes(pending[:chunk_bytes]), False
+			del pending[:chunk_bytes]
+	yield bytes(pending), True
+
+class Encryptor:
+	"""
+	long-lived symmetric encryptor. the passphrase is read once, and everything is encrypted with the same engine for the life of the encryptor:
+
+	'aead' (the default) encrypts in-process with AES-256-GCM, using a key derived (with scrypt) from the passphrase once up front. streams are encrypted a chunk (<chunk bytes>) at a time, so encrypting to a file never holds more than a couple of chunks in memory. needs the cryptography package -- without it we fall back on gpg
+
+	'gpg' runs a gpg process per call. archives are already compressed, so by default we tell gpg not to compress them again (this is where most of its CPU time went)
+
+	decryption works out which of the two produced a file by its magic, so anything we've ever produced (incl. old .gpg archives) can always be decrypted
+	"""
+
+	def __init__(self, passphrase_loc=ENC_PASSPHRASE_LOC, engine=ENCRYPTION_ENGINE, chunk_bytes=AEAD_CHUNK_BYTES, scrypt_log2_cost=AEAD_SCRYPT_LOG2_COST):
+		self.log = get_logger('file_handler.Encryptor')
+		self.gpg = None # only started if something actually needs gpg (see get_gpg), so the aead engine can run without it
+		self.lock = threading.Lock() # batches are encrypted from several upload threads
+		self.passphrase = read_passphrase(passphrase_loc)
+		self.chunk_bytes = chunk_bytes
+		self.scrypt_log2_cost = scrypt_log2_cost
+		self.aead_keys = {} # (salt, scrypt cost) -> derived key, so each is only derived once
+		self.engine = engine
+		if ('aead' == engine) and (AESGCM is None):
+			self.log.error("Can't encrypt in-process without the cryptography package, running gpg instead")
+			self.engine = 'gpg'
+		if 'aead' == self.engine:
+			# every file we encrypt shares this salt (and so the key), each gets its own nonce prefix
+			self.salt = urandom(16)
+			self.aead = AESGCM(self.aead_key(self.salt, scrypt_log2_cost))
+		self.num_encrypted = 0
+		self.total_encrypt_secs = 0
+
+	def get_gpg(self):
+		with self.lock:
+			if self.gpg is None:
+				# disable logging for all GPG related things because it is way too damned noisy -_-
+				log.setLevel(logging.CRITICAL)
+				self.gpg = GPG()
+				log.setLevel(logging.DEBUG)
+			return self.gpg
+
+	def aead_key(self, salt, scrypt_log2_cost):
+		"""
+		returns: the AES-256 key derived from the passphrase with the given salt and scrypt cost
+		"""
+
+		if (salt, scrypt_log2_cost) not in self.aead_keys:
+			kdf = Scrypt(salt=salt, length=32, n=2**scrypt_log2_cost, r=8, p=1)
+			self.aead_keys[(salt, scrypt_log2_cost)] = kdf.derive(self.passphrase.encode('utf-8'))
+		return self.aead_keys[(salt, scrypt_log2_cost)]
+
+	def encrypt_stream(self, stream, enc_filename, compress=False):
+		"""
+		encrypt everything readable from the given (binary) stream into enc_filename. set compress for data that isn't already compressed (e.g. logs)
+
+		the encrypted output is hashed on its way to disk so it can be checked against drive without reading it back
+
+		returns: MD5 hex digest of the encrypted file, or None if encryption failed
+		"""
+
+		if 'aead' == self.engine:
+			with open(enc_filename,'wb') as enc_file:
+				return self.encrypt_aead(stream, enc_file, compress=compress)
+
+		# (gpg writes the file itself, so the encrypted batch is never held in memory)
+		if not self.encrypt_gpg(stream, compress=compress, output=enc_filename).ok:
+			self.log.error("Error encrypting to {}".format(enc_filename))
+			return None
+		return file_md5(enc_filename)
+
+	def encrypt_to_bytes(self, stream, compress=False):
+		"""
+		encrypt everything readable from the given (binary) stream, keeping the result in memory
+
+		returns: the encrypted bytes, or None if encryption failed
+		"""
+
+		if 'aead' == self.engine:
+			out = io.BytesIO()
+			if self.encrypt_aead(stream, out, compress=compress) is None:
+				return None
+			return out.getvalue()
+
+		result = self.encrypt_gpg(stream, compress=compress)
+		return result.data if result.ok else None
+
+	def encrypt_gpg(self, stream, compress=False, output=None):
+		"""
+		run the given (binary) stream through gpg, into <output> if given (otherwise the result holds the encrypted bytes)
+
+		returns: python-gnupg's result
+		"""
+
+		extra_args = None if compress else ['--compress-algo', GPG_BATCH_COMPRESS_ALGO]
+		start_time = time()
 		log.setLevel(logging.CRITICAL)
-		gpg.encrypt_file(raw_file,[],passphrase=key,output=enc_filename,symmetric=True)
+		result = self.get_gpg().encrypt_file(stream,[],passphrase=self.passphrase,symmetric=True,armor=False,output=output,extra_args=extra_args)
 		log.setLevel(logging.DEBUG)
+		if not result.ok:
+			self.log.error("Error encrypting stream: {}".format(result.status))
+			return result
+		with self.lock:
+			self.total_encrypt_secs += time() - start_time
+			self.num_encrypted += 1
+		return result
 
+	def encrypt_aead(self, stream, out, compress=False):
+		"""
+		encrypt everything readable from the given (binary) stream onto the end of <out>, a chunk at a time
+
+		returns: MD5 hex digest of what was written, or None if encryption failed
+		"""
+
+		start_time = time()
+		header = AEAD_HEADER.pack(AEAD_MAGIC, AEAD_FLAG_ZLIB if compress else 0, self.scrypt_log2_cost, self.salt, urandom(8), self.chunk_bytes)
+		nonce_prefix = header[-12:-4]
+		hasher = md5(header)
+		try:
+			out.write(header)
+			for i, (chunk, last) in enumerate(aead_plaintext_chunks(stream, self.chunk_bytes, compress=compress)):
+				data = self.aead.encrypt(nonce_prefix + struct.pack('>I', i), chunk, header + (b'\x01' if last else b'\x00'))
+				hasher.update(data)
+				out.write(data)
+		except (OSError, ValueError, OverflowError) as e:
+			self.log.error("Error encrypting stream: {}".format(e))
+			return None
+		with self.lock:
+			self.total_encrypt_secs += time() - start_time
+			self.num_encrypted += 1
+		return hasher.hexdigest()
+
+	def encrypt_file(self, filename, enc_filename, compress=False):
+		self.log.info("Encrypting {} using passphrase".format(filename))
+		with open(filename,'rb') as raw_file:
+			return self.encrypt_stream(raw_file, enc_filename, compress=compress)
+
+	def decrypt_stream(self, stream):
+		"""
+		decrypt everything readable from the given (binary) stream, whichever engine encrypted it
+
+		returns: the decrypted bytes, or None if decryption failed
+		"""
+
+		head = stream.read(AEAD_HEADER.size)
+		if head.startswith(AEAD_MAGIC) and (AEAD_HEADER.size == len(head)):
+			return self.decrypt_aead(head, stream)
+
+		# a GPG message (incl. old .gpg archives made before there was an Encryptor)
+		log.setLevel(logging.CRITICAL)
+		result = self.get_gpg().decrypt_file(io.BytesIO(head + stream.read()),passphrase=self.passphrase)
+		log.setLevel(logging.DEBUG)
+		if not result.ok:
+			self.log.error("Error decrypting stream: {}".format(result.status))
+			return None
+		return result.data
+
+	def decrypt_aead(self, header, stream):
+		"""
+		decrypt the chunks following the given AEAD header in the stream. a chunk that's been tampered with, reordered, dropped or cut short fails the lot
+
+		returns: the decrypted bytes, or None if decryption failed
+		"""
+
+		if AESGCM is None:
+			self.log.error("Can't decrypt an in-process encrypted stream without the cryptography package")
+			return None
+		_, flags, scrypt_log2_cost, salt, nonce_prefix, chunk_bytes = AEAD_HEADER.unpack(header)
+		aead = AESGCM(self.aead_key(salt, scrypt_log2_cost))
+		decompressor = zlib.decompressobj() if flags & AEAD_FLAG_ZLIB else None
+		plaintext = io.BytesIO()
+		i = 0
+		data = stream.read(chunk_bytes + AEAD_TAG_BYTES)
+		try:
+			while True:
+				next_data = stream.read(chunk_bytes + AEAD_TAG_BYTES)
+				last = 0 == len(next_data)
+				chunk = aead.decrypt(nonce_prefix + struct.pack('>I', i), data, header + (b'\x01' if last else b'\x00'))
+				plaintext.write(chunk if decompressor is None else decompressor.decompress(chunk))
+				if last:
+					break
+				data = next_data
+				i += 1
+			if decompressor is not None:
+				plaintext.write(decompressor.flush())
+		except (InvalidTag, ValueError, zlib.error) as e:
+			self.log.error("Error decrypting stream: {}".format(repr(e)))
+			return None
+		return plaintext.getvalue()
+
+	def decrypt_file(self, enc_filename, filename):
+		self.log.info("Decrypting {} using passphrase".format(enc_filename))
+		with open(enc_filename,'rb') as enc_file:
+			data = self.decrypt_stream(enc_file)
+		if data is None:
+			return False
+		with open(filename,'wb') as raw_file:
+			raw_file.write(data)
+		return True
+
+	def mean_encrypt_secs(self):
+		with self.lock:
+			if 0 == self.num_encrypted:
+				return 0
+			return self.total_encrypt_secs / self.num_encrypted
 
 def check_if_files_match(local_file_path, downloaded_file_path):
 	return compare_files(local_file_path, downloaded_file_path)
 
+def file_md5(path, block_size=1024*1024):
+	"""
+	MD5 hex digest of the file at the given path (this is the checksum drive keeps for every file)
+	"""
+
+	hasher = md5()
+	with open(path,'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			hasher.update(block)
+	return hasher.hexdigest()
+
+def frame_name(frame):
+	"""
+	frames are either the path of an image on disk or a (name, encoded bytes) tuple straight from an in-memory capture
+	"""
+
+	return frame if isinstance(frame, str) else frame[0]
+
+def frame_size(frame):
+	return getsize(frame) if isinstance(frame, str) else len(frame[1])
+
+def max_zip_member_bytes(frame):
+	"""
+	worst case number of bytes that adding the given frame to a zip archive will cost us (local header + data + central directory entry)
+
+	assumes the data doesn't compress at all and allows for the few bytes per block that DEFLATE adds to incompressible input
+	"""
+
+	raw_bytes = frame_size(frame)
+	name_bytes = len(frame_name(frame).encode('utf-8'))
+	return raw_bytes + ((raw_bytes // 16000) + 1)*5 + (zipfile.sizeFileHeader + name_bytes) + (zipfile.sizeCentralDir + name_bytes) + 64
+
+# batches are written under <batch>.part and only renamed into place once they're complete, so anything going by a batch's name is a whole batch
+PART_SUFFIX = '.part'
+
+class BatchPacker:
+	"""
+	packs files into a single archive one at a time, keeping a running total of how big the final (encrypted) product will be so the batch can be sealed before it goes over the size limit
+
+	every file is compressed exactly once and the archive is encrypted exactly once, when it is sealed. if streaming, the archive is built in memory and fed straight into the encryptor so it never hits the disk -- up to <spool bytes> of it anyway, past that it's spooled out to a temp file next to the batch so big batches don't eat the RAM
+	"""
+
+	suffix = '.zip'
+
+	def __init__(self, zip_filename, max_bytes, enc_overhead_ratio, encryptor:Encryptor, streaming=STREAM_BATCHES, spool_bytes=STREAM_SPOOL_BYTES):
+		self.zip_filename = zip_filename
+		self.enc_filename = zip_filename + '.gpg'
+		self.max_bytes = max_bytes
+		self.enc_overhead_ratio = enc_overhead_ratio
+		self.encryptor = encryptor
+		self.files = [] # names of everything in the archive
+		self.files_on_disk = [] # the subset that came from disk (and so need removing once the batch is sealed)
+		self.raw_bytes = 0
+		self.start_time = None
+		self.end_time = None
+		self.num_compress_passes = 0
+		self.compress_cpu_secs = 0
+		self.codec_counts = {} # codec name -> number of members compressed with it
+		self.num_encrypt_passes = 0
+		self.streaming = streaming
+		self.spool_bytes = spool_bytes
+		# we own the underlying file so we always know how many bytes have actually been written
+		if streaming:
+			self.fp = SpooledTemporaryFile(max_size=spool_bytes, dir=dirname(abspath(zip_filename)))
+		else:
+			self.fp = open(zip_filename, 'wb')
+		self.zf = zipfile.ZipFile(self.fp, mode='w')
+		self.log = get_logger('file_handler.BatchPacker')
+
+	def projected_size(self, extra_zip_bytes=0):
+		"""
+		upper bound on the size of the encrypted batch if it were sealed with <extra_zip_bytes> more bytes of archive in it
+		"""
+
+		# central directory entries are written on close, so add those in for what we already have
+		zip_bytes = self.fp.tell() + sum(zipfile.sizeCentralDir + len(info.filename.encode('utf-8')) for info in self.zf.infolist()) + zipfile.sizeEndCentDir + extra_zip_bytes
+		return int(zip_bytes*(1 + self.enc_overhead_ratio)) + ENC_OVERHEAD_BYTES
+
+	def would_overflow(self, frame):
+		return self.projected_size(self.max_member_bytes(frame, self.enc_overhead_ratio)) > self.max_bytes
+
+	@staticmethod
+	def max_member_bytes(frame, enc_overhead_ratio):
+		return max_zip_member_bytes(frame)
+
+	@staticmethod
+	def max_batch_bytes(member_bytes, enc_overhead_ratio):
+		"""
+		worst case size of a sealed batch whose members cost <member_bytes> in total
+		"""
+
+		return int((zipfile.sizeEndCentDir + member_bytes)*(1 + enc_overhead_ratio)) + ENC_OVERHEAD_BYTES
+
+	def add(self, frame):
+		"""
+		compress the given frame (a file, or a name and its bytes) into the archive
+		"""
+
+		filename = frame_name(frame)
+		start_cpu = process_time()
+		# frames are already compressed JPEGs, so this is almost always going to be stored as is
+		codec = choose_codec(frame_sample(frame))
+		if isinstance(frame, str):
+			self.zf.write(filename, filename, compress_type=codec, compresslevel=COMPRESSIBLE_LEVEL)
+			self.files_on_disk.append(filename)
+		else:
+			self.zf.writestr(filename, frame[1], compress_type=codec, compresslevel=COMPRESSIBLE_LEVEL)
+		self.compress_cpu_secs += process_time() - start_cpu
+		self.codec_counts[CODEC_NAMES[codec]] = self.codec_counts.get(CODEC_NAMES[codec], 0) + 1
+		self.num_compress_passes += 1
+		self.files.append(filename)
+		self.raw_bytes += frame_size(frame)
+		# keep track of the capture time range covered by this batch
+		_, timestamp = parse_file_name(basename(filename))
+		if timestamp is not None:
+			self.start_time = timestamp if self.start_time is None else min(self.start_time, timestamp)
+			self.end_time = timestamp if self.end_time is None else max(self.end_time, timestamp)
+
+	def seal(self):
+		"""
+		close out the archive and encrypt it. the (unencrypted) archive is discarded afterwards, whether or not encryption worked
+
+		returns: a dict of stats about the batch
+		"""
+
+		# closing the zip file writes the central directory but leaves a file object we passed in open
+		self.zf.close()
+		zip_bytes = self.fp.tell()
+		checksum = None
+		part_filename = self.enc_filename + PART_SUFFIX
+		try:
+			if self.streaming:
+				self.log.info("Encrypting in-memory archive {} using passphrase".format(self.zip_filename))
+				self.fp.seek(0)
+				checksum = self.encryptor.encrypt_stream(self.fp, part_filename)
+				# the archive only ever existed in memory, unless it got too big and was spooled out
+				zip_bytes_written = 0 if zip_bytes <= self.spool_bytes else zip_bytes
+			else:
+				self.fp.close()
+				checksum = self.encryptor.encrypt_file(self.zip_filename, part_filename)
+				zip_bytes_written = zip_bytes
+			if checksum is not None:
+				replace(part_filename, self.enc_filename)
+		finally:
+			self.fp.close()
+			if not self.streaming:
+				remove(self.zip_filename)
+			if isfile(part_filename):
+				# (don't leave half an encrypted batch lying around)
+				remove(part_filename)
+		if checksum is None:
+			raise RuntimeError("Failed to encrypt batch {}".format(self.enc_filename))
+		self.num_encrypt_passes += 1
+		enc_bytes = getsize(self.enc_filename)
+
+		return {
+			'batch': self.enc_filename,
+			'num_files': len(self.files),
+			'start_time': self.start_time,
+			'end_time': self.end_time,
+			'raw_bytes': self.raw_bytes,
+			'zip_bytes': zip_bytes,
+			'enc_bytes': enc_bytes,
+			'md5': checksum,
+			'bytes_written': zip_bytes_written + enc_bytes,
+			'compress_passes': self.num_compress_passes,
+			'compress_cpu_secs': self.compress_cpu_secs,
+			'compress_ratio': 0 if 0 == self.raw_bytes else zip_bytes / self.raw_bytes,
+			'codecs': self.codec_counts,
+			'encrypt_passes': self.num_encrypt_passes,
+		}
+
+	def discard(self):
+		"""
+		throw away the batch without encrypting it
+		"""
+
+		self.zf.close()
+		self.fp.close()
+		if not self.streaming:
+			remove(self.zip_filename)
+
+# seekable batches start with this magic and the length of the encrypted index that follows it. frame offsets in the index count from the end of the index
+SEEKABLE_MAGIC = b'SVLCSB01'
+SEEKABLE_HEADER = struct.Struct('>8sQ')
+SEEKABLE_INDEX_VERSION = 1
+# most bytes an index entry takes up, not counting the frame's name: the keys, plus room for a float and three 20 digit ints
+SEEKABLE_ENTRY_MAX_BYTES = 140
+
+def encode_seekable_index(entries:list):
+	return json.dumps({'version': SEEKABLE_INDEX_VERSION, 'frames': entries}, separators=(',', ':')).encode('utf-8')
+
+class SeekableBatchPacker:
+	"""
+	packs frames into a seekable batch: a short plaintext header, an encrypted index of every frame's name, capture time, offset and size, and then the frames themselves, each encrypted on its own
+
+	any one frame can be pulled back out of an uploaded batch by reading the index and making a ranged download of just that frame. frames are encrypted as they're added and the index once when the batch is sealed, so (like BatchPacker) nothing is ever processed twice
+
+	that's one encryption per frame, so it's only cheap with the in-process encryptor -- FileHandler won't pack seekable batches with gpg
+	"""
+
+	suffix = '.svb'
+
+	def __init__(self, filename, max_bytes, enc_overhead_ratio, encryptor:Encryptor, streaming=STREAM_BATCHES, spool_bytes=STREAM_SPOOL_BYTES):
+		# the batch isn't a GPG message as a whole, so there's no .gpg on the end of this one
+		self.enc_filename = filename
+		self.frames_filename = filename + '.frames'
+		self.max_bytes = max_bytes
+		self.enc_overhead_ratio = enc_overhead_ratio
+		self.encryptor = encryptor
+		self.files = [] # names of everything in the batch
+		self.files_on_disk = [] # the subset that came from disk (and so need removing once the batch is sealed)
+		self.entries = [] # index entries, in the order the frames were added
+		self.index_bytes = len(encode_seekable_index([]))
+		self.raw_bytes = 0
+		self.start_time = None
+		self.end_time = None
+		self.num_compress_passes = 0
+		self.compress_cpu_secs = 0
+		self.codec_counts = {} # 'deflate' for frames the encryptor compressed on the way through, 'stored' for the rest
+		self.num_encrypt_passes = 0
+		self.streaming = streaming
+		self.spool_bytes = spool_bytes
+		# encrypted frames pile up in here until the index is ready to go in front of them (spooled out to a temp file if there are too many to keep in memory)
+		if streaming:
+			self.fp = SpooledTemporaryFile(max_size=spool_bytes, dir=dirname(abspath(filename)))
+		else:
+			self.fp = open(self.frames_filename, 'wb')
+		self.log = get_logger('file_handler.SeekableBatchPacker')
+
+	def projected_size(self, extra_bytes=0):
+		"""
+		upper bound on the size of the sealed batch if it had <extra_bytes> more in it
+		"""
+
+		return SEEKABLE_HEADER.size + int(self.index_bytes*(1 + self.enc_overhead_ratio)) + ENC_OVERHEAD_BYTES + self.fp.tell() + extra_bytes
+
+	def would_overflow(self, frame):
+		return self.projected_size(self.max_member_bytes(frame, self.enc_overhead_ratio)) > self.max_bytes
+
+	@staticmethod
+	def max_member_bytes(frame, enc_overhead_ratio):
+		"""
+		worst case number of bytes adding the given frame will cost us: the frame encrypted on its own, plus its entry in the index
+		"""
+
+		entry_bytes = len(json.dumps(frame_name(frame))) + SEEKABLE_ENTRY_MAX_BYTES
+		return int((frame_size(frame) + entry_bytes)*(1 + enc_overhead_ratio)) + ENC_OVERHEAD_BYTES + 1
+
+	@staticmethod
+	def max_batch_bytes(member_bytes, enc_overhead_ratio):
+		"""
+		worst case size of a sealed batch whose members cost <member_bytes> in total
+		"""
+
+		return SEEKABLE_HEADER.size + int(len(encode_seekable_index([]))*(1 + enc_overhead_ratio)) + ENC_OVERHEAD_BYTES + member_bytes
+
+	def add(self, frame):
+		"""
+		encrypt the given frame (a file, or a name and its bytes) onto the end of the batch
+		"""
+
+		filename = frame_name(frame)
+		start_cpu = process_time()
+		# frames are already compressed JPEGs, so the encryptor is almost never going to be asked to compress one
+		compress = zipfile.ZIP_STORED != choose_codec(frame_sample(frame))
+		self.compress_cpu_secs += process_time() - start_cpu
+		if isinstance(frame, str):
+			with open(filename, 'rb') as f:
+				chunk = self.encryptor.encrypt_to_bytes(f, compress=compress)
+		else:
+			chunk = self.encryptor.encrypt_to_bytes(io.BytesIO(frame[1]), compress=compress)
+		if chunk is None:
+			# (if it came from disk it stays there for next time)
+			self.log.error("Failed to encrypt {}, leaving it out of batch {}".format(filename, self.enc_filename))
+			return
+		self.num_compress_passes += 1
+		self.num_encrypt_passes += 1
+		codec = 'deflate' if compress else 'stored'
+		self.codec_counts[codec] = self.codec_counts.get(codec, 0) + 1
+
+		_, timestamp = parse_file_name(basename(filename))
+		entry = {'name': filename, 'time': timestamp, 'offset': self.fp.tell(), 'size': len(chunk), 'raw_size': frame_size(frame)}
+		self.fp.write(chunk)
+		self.entries.append(entry)
+		self.index_bytes += len(json.dumps(entry, separators=(',', ':'))) + (1 if len(self.entries) > 1 else 0)
+		if isinstance(frame, str):
+			self.files_on_disk.append(filename)
+		self.files.append(filename)
+		self.raw_bytes += entry['raw_size']
+		# keep track of the capture time range covered by this batch
+		if timestamp is not None:
+			self.start_time = timestamp if self.start_time is None else min(self.start_time, timestamp)
+			self.end_time = timestamp if self.end_time is None else max(self.end_time, timestamp)
+
+	def seal(self):
+		"""
+		encrypt the index and write out the finished batch: header, index, then the frames
+
+		returns: a dict of stats about the batch (same as BatchPacker's)
+		"""
+
+		index = encode_seekable_index(self.entries)
+		enc_index = self.encryptor.encrypt_to_bytes(io.BytesIO(index), compress=True)
+		if enc_index is None:
+			self.discard()
+			raise RuntimeError("Failed to encrypt the index of batch {}".format(self.enc_filename))
+		self.num_encrypt_passes += 1
+
+		hasher = md5()
+		part_filename = self.enc_filename + PART_SUFFIX
+		try:
+			with open(part_filename, 'wb') as enc_file:
+				for block in (SEEKABLE_HEADER.pack(SEEKABLE_MAGIC, len(enc_index)), enc_index):
+					hasher.update(block)
+					enc_file.write(block)
+				frames_bytes_written = self.fp.tell()
+				if self.streaming:
+					self.fp.seek(0)
+					if frames_bytes_written <= self.spool_bytes:
+						frames_bytes_written = 0
+				else:
+					self.fp.close()
+					self.fp = open(self.frames_filename, 'rb')
+				for block in iter(lambda: self.fp.read(1024*1024), b''):
+					hasher.update(block)
+					enc_file.write(block)
+			replace(part_filename, self.enc_filename)
+		finally:
+			self.fp.close()
+			if not self.streaming:
+				remove(self.frames_filename)
+			if isfile(part_filename):
+				remove(part_filename)
+		enc_bytes = getsize(self.enc_filename)
+		# what the batch would have come to unencrypted
+		plain_bytes = SEEKABLE_HEADER.size + len(index) + self.raw_bytes
+
+		return {
+			'batch': self.enc_filename,
+			'num_files': len(self.files),
+			'start_time': self.start_time,
+			'end_time': self.end_time,
+			'raw_bytes': self.raw_bytes,
+			'zip_bytes': plain_bytes,
+			'enc_bytes': enc_bytes,
+			'md5': hasher.hexdigest(),
+			'bytes_written': enc_bytes + frames_bytes_written,
+			'compress_passes': self.num_compress_passes,
+			'compress_cpu_secs': self.compress_cpu_secs,
+			'compress_ratio': 0 if 0 == self.raw_bytes else plain_bytes / self.raw_bytes,
+			'codecs': self.codec_counts,
+			'encrypt_passes': self.num_encrypt_passes,
+		}
+
+	def discard(self):
+		"""
+		throw away the batch without writing it out
+		"""
+
+		self.fp.close()
+		if not self.streaming:
+			remove(self.frames_filename)
+
+BATCH_PACKERS = {'zip': BatchPacker, 'seekable': SeekableBatchPacker}
+
+def new_packer(base_name, batch_num, max_bytes, enc_overhead_ratio, encryptor:Encryptor, batch_format=BATCH_FORMAT):
+	"""
+	start batch number <batch_num> of the given format, named <base name>_B<n>
+	"""
+
+	packer_class = BATCH_PACKERS[batch_format]
+	return packer_class(base_name + "_B{}{}".format(batch_num, packer_class.suffix), max_bytes, enc_overhead_ratio, encryptor)
+
+def local_range_reader(path):
+	"""
+	read_range for a seekable batch sitting on the local disk
+	"""
+
+	def read_range(start, end):
+		with open(path, 'rb') as f:
+			f.seek(start)
+			return f.read(end - start)
+	return read_range
+
+class SeekableBatchReader:
+	"""
+	reads frames back out of a seekable batch without touching the rest of it
+
+	read_range(start, end) returns bytes [start, end) of the batch, wherever it happens to live (a local file, or ranged downloads from drive)
+	"""
+
+	def __init__(self, read_range, encryptor:Encryptor, prefetch_bytes=SEEKABLE_INDEX_PREFETCH_BYTES):
+		self.read_range = read_range
+		self.encryptor = encryptor
+		self.prefetch_bytes = prefetch_bytes
+		self.entries = None
+		self.num_reads = 0
+		self.bytes_read = 0
+		self.log = get_logger('file_handler.SeekableBatchReader')
+
+	def read(self, start, end):
+		data = self.read_range(start, end)
+		if data is None:
+			raise IOError("Couldn't read bytes {}-{} of seekable batch".format(start, end - 1))
+		self.num_reads += 1
+		self.bytes_read += len(data)
+		return data
+
+	def index(self):
+		"""
+		read and decrypt the batch's index (only the first time it's asked for)
+
+		returns: list of index entries, with offsets counted from the start of the batch
+		"""
+
+		if self.entries is not None:
+			return self.entries
+
+		head = self.read(0, max(self.prefetch_bytes, SEEKABLE_HEADER.size))
+		if len(head) < SEEKABLE_HEADER.size:
+			raise ValueError("Batch is too short to be a seekable batch ({} bytes)".format(len(head)))
+		magic, enc_index_bytes = SEEKABLE_HEADER.unpack_from(head)
+		if SEEKABLE_MAGIC != magic:
+			raise ValueError("Not a seekable batch (magic {})".format(magic))
+		frames_start = SEEKABLE_HEADER.size + enc_index_bytes
+		if len(head) < frames_start:
+			# the index didn't fit in what we grabbed up front
+			head += self.read(len(head), frames_start)
+		index = self.encryptor.decrypt_stream(io.BytesIO(head[SEEKABLE_HEADER.size:frames_start]))
+		if index is None:
+			raise ValueError("Couldn't decrypt the index of seekable batch")
+		index = json.loads(index.decode('utf-8'))
+		if index['version'] > SEEKABLE_INDEX_VERSION:
+			raise ValueError("Seekable batch index version {} is newer than we know how to read".format(index['version']))
+
+		self.entries = index['frames']
+		for entry in self.entries:
+			entry['offset'] += frames_start
+		return self.entries
+
+	def frames_in_range(self, start_time, end_time):
+		"""
+		index entries for every frame captured in the given time range (s since epoch, inclusive)
+		"""
+
+		return [x for x in self.index() if (x['time'] is not None) and (start_time <= x['time'] <= end_time)]
+
+	def read_frames(self, entries:list):
+		"""
+		fetch and decrypt the frames with the given index entries. frames that sit next to each other in the batch are fetched together in a single read
+
+		yields: (name, frame bytes) in batch order
+		"""
+
+		entries = sorted(entries, key=lambda x: x['offset'])
+		i = 0
+		while i < len(entries):
+			# take as long a run of back to back frames as we can
+			j = i + 1
+			while (j < len(entries)) and (entries[j]['offset'] == entries[j - 1]['offset'] + entries[j - 1]['size']):
+				j += 1
+			run_start = entries[i]['offset']
+			data = self.read(run_start, entries[j - 1]['offset'] + entries[j - 1]['size'])
+			for entry in entries[i:j]:
+				frame = self.encryptor.decrypt_stream(io.BytesIO(data[entry['offset'] - run_start:entry['offset'] - run_start + entry['size']]))
+				if frame is None:
+					self.log.error("Failed to decrypt frame {}, skipping it".format(entry['name']))
+					continue
+				yield entry['name'], frame
+			i = j
+
+def plan_batches(frames:list, max_bytes, enc_overhead_ratio, batch_format=BATCH_FORMAT):
+	"""
+	split the frames up into batches ahead of time, using the same worst case size estimates the packer uses, so that the batches can be packed independently of one another
+
+	returns: list of lists of frames, in the order given
+	"""
+
+	packer_class = BATCH_PACKERS[batch_format]
+	batches = []
+	batch = []
+	batch_member_bytes = 0
+	for frame in frames:
+		member_bytes = packer_class.max_member_bytes(frame, enc_overhead_ratio)
+		if batch and (packer_class.max_batch_bytes(batch_member_bytes + member_bytes, enc_overhead_ratio) > max_bytes):
+			batches.append(batch)
+			batch = []
+			batch_member_bytes = 0
+		batch.append(frame)
+		batch_member_bytes += member_bytes
+	if batch:
+		batches.append(batch)
+	return batches
+
+# each packaging worker process loads the key once and keeps its own encryptor
+_worker_encryptor = None
+
+def pack_batch(base_name, batch_num, frames:list, max_bytes, enc_overhead_ratio, batch_format=BATCH_FORMAT, passphrase_loc=ENC_PASSPHRASE_LOC):
+	"""
+	pack and seal a single planned batch. runs in a packaging worker process
+
+	returns: (the batch's stats, the frames in it that came from disk, the names of every frame in it)
+	"""
+
+	global _worker_encryptor
+	if _worker_encryptor is None:
+		_worker_encryptor = Encryptor(passphrase_loc)
+	packer = new_packer(base_name, batch_num, max_bytes, enc_overhead_ratio, _worker_encryptor, batch_format)
+	for frame in frames:
+		packer.add(frame)
+	return packer.seal(), packer.files_on_disk, packer.files
+
 class FileHandler:
 
-	def __init__(self):
+	def __init__(self, num_workers=PACKAGING_WORKERS):
 		# this is a purely empirical thing to get a decent starting point for batch size -- it will be updated as we go
 		self.approx_final_bytes_per_img = 575000
 		self.num_images_approx_based_on = 8
+		# proportional overhead of encryption on top of the archive size. we keep the worst we've seen so that the packer stays pessimistic
+		self.enc_overhead_ratio = ENC_OVERHEAD_RATIO
+		# per-batch stats from the last call to compress_and_encrypt_batch
+		self.batch_stats = []
+		# batch file name -> stats for that batch (incl. MD5 of the encrypted batch and capture time range) for the uploader to pick up
+		self.batch_info = {}
+		# names of the frames that made it into a sealed batch in the last call to compress_and_encrypt_batch (anything else handed over is still unpacked)
+		self.frames_packed = set()
+		# one encryptor for the life of the handler so the key is only loaded once
+		self.encryptor = Encryptor()
+		# with more than one worker, batches are planned up front and packed in parallel in a process pool (started on first use)
+		self.num_workers = num_workers
+		self.executor = None
+		self.max_batch_bytes = MAX_FILE_SIZE_PER_UPLOAD
+		self.batch_format = BATCH_FORMAT
+		# where batches get packed (None: the current dir), and what every byte written is counted against
+		self.staging = None
+		# called with each batch's stats the moment it's sealed, before the frames that went into it are removed (so it can be journaled first)
+		self.on_sealed = None
 		self.log = get_logger('file_handler.FileHandler')
 
 	def compress_and_encrypt_batch(self,filelist:list):
 		"""
-		given a list of files that need to be compressed/encrypted, generate and size the batches properly so that all of the final products are less than <max upload size>
+		given a list of frames (files, or (name, bytes) tuples from an in-memory capture) that need to be compressed/encrypted, pack them into batches such that all of the final products are less than <max upload size>
+
+		frames are appended to an open archive one at a time and the batch is sealed as soon as the next file would push it over the limit, so each file is only compressed and encrypted once
+
+		batches are named <base name>_B<n> in the order of the frames given, so the same frames always end up in the same batches whether or not they're packed in parallel
 		"""
 		self.log.info("Performing batch compression and encryption.")
 
-		# first we have to generate the batch assignments
-		left_to_assign = filelist.copy()
-		assignments = {file:None for file in filelist} # this will map file names onto batch number
+		self.check_batch_format()
+		self.batch_stats = []
+		self.frames_packed = set()
+		base_name = gen_file_name()
+		frames = []
+		for file in filelist:
+			if isinstance(file, str) and not isfile(file):
+				self.log.error("File {} disappeared before it could be packed, skipping.".format(file))
+				continue
+			frames.append(file)
+		if self.staging is not None:
+			base_name = join(self.staging.batch_dir(sum(frame_size(x) for x in frames)), base_name)
+
+		if self.num_workers > 1:
+			final_filenames = self.pack_in_parallel(frames, base_name)
+		else:
+			final_filenames = self.pack_in_series(frames, base_name)
+
+		# log pass info so we can show that nothing gets rebuilt
+		self.log.debug("Total compress passes: {}, total encrypt passes: {}, total bytes written: {}".format(sum(x['compress_passes'] for x in self.batch_stats), sum(x['encrypt_passes'] for x in self.batch_stats), sum(x['bytes_written'] for x in self.batch_stats)))
+
+		# finally, return the file names we ended up with
+		return final_filenames
+
+	def check_batch_format(self):
+		"""
+		seekable batches encrypt every frame on its own, which with gpg means a gpg process per frame. so without the in-process encryptor we pack zip batches instead
+		"""
+
+		if ('seekable' == self.batch_format) and ('aead' != self.encryptor.engine):
+			self.log.error("Seekable batches need in-process encryption (with gpg it's a gpg process per frame), packing zip batches instead")
+			self.batch_format = 'zip'
+
+	def pack_in_series(self, frames:list, base_name):
 		final_filenames = []
 		batch_num = 0
+		packer = None
 
-		# info that is useful for debugging (probably)
-		num_downward_adjustments = 0
-		num_upward_adjustments = 0
-
-		while len(left_to_assign) > 0:
-			# get the file name for this batch
-			batch_zip_filename = gen_file_name() + "_B{}.zip".format(batch_num)
-			batch_filename = batch_zip_filename + '.gpg'
-
-			# start with the best initial guess for the next batch
-			num_in_this_batch = min(len(left_to_assign),max(1,int(MAX_FILE_SIZE_PER_UPLOAD / self.approx_final_bytes_per_img)))
-			prev_was_too_big = False
-			good_num_found = False
-			while not good_num_found:
-				# try the current value
-				this_batch_files = left_to_assign[:num_in_this_batch]
-				compress_files(this_batch_files,batch_zip_filename)
-				encrypt_file(batch_zip_filename,batch_filename)
-				# check size
-				size = getsize(batch_filename)
-				if num_in_this_batch == 1:
+		for file in frames:
+
+			if (packer is not None) and (len(packer.files) > 0) and packer.would_overflow(file):
+				final_filenames.append(self.seal_batch(packer))
+				packer = None
+
+			if packer is None:
+				packer = new_packer(base_name, batch_num, self.max_batch_bytes, self.enc_overhead_ratio, self.encryptor, self.batch_format)
+				batch_num += 1
+				if packer.would_overflow(file):
 					# we're just gonna have to live with an overly large file unfortunately. luckily this should be pretty unlikely
-					self.log.warning("File {} produces a compressed/encrypted archive larger than the upload limit ({} bytes > {} bytes)".format(this_batch_files[0], size, MAX_FILE_SIZE_PER_UPLOAD))
-					good_num_found = True
-				elif size > MAX_FILE_SIZE_PER_UPLOAD:
-					# too big, have to decrease
-					num_in_this_batch -= 1
-					num_downward_adjustments += 1
-					# set this so we know when to stop shrinking
-					prev_was_too_big = True
-				else:
-					if prev_was_too_big:
-						# we know for a fact we can't add on -- just stick with what we've got
-						good_num_found = True
-					elif size > MAX_FILE_SIZE_PER_UPLOAD - (self.approx_final_bytes_per_img*0.9):
-						# deadband case -- assume that our estimate is good
-						good_num_found = True
-					elif num_in_this_batch == len(left_to_assign):
-						# no more left to assign -- this'll do
-						good_num_found = True
-					else:
-						# could probably fit more in -- increase
-						num_in_this_batch += 1
-						num_upward_adjustments += 1
-
-				if not good_num_found:
-					# clear out this iteration's files
-					remove(batch_zip_filename)
-					remove(batch_filename)
-				else:
-					# when done get rid of the zip file and image files
-					self.log.info("Good size found: {} files. Removing zip and packaged files.".format(num_in_this_batch))
-					remove(batch_zip_filename)
-					for file in this_batch_files:
-						self.log.debug("Removing {}".format(file))
-						remove(file)
-
-			# update our estimates
-			self.approx_final_bytes_per_img = ((self.approx_final_bytes_per_img*self.num_images_approx_based_on) + getsize(batch_filename)) / (self.num_images_approx_based_on + num_in_this_batch)
-			self.num_images_approx_based_on += num_in_this_batch
-			self.log.info("New estimated final bytes per image: {}, based on {} total images screened.".format(self.approx_final_bytes_per_img, self.num_images_approx_based_on))
-
-			# assign the files
-			this_batch_files = left_to_assign[:num_in_this_batch]
-			for file in this_batch_files:
-				assignments[file] = batch_num
-			left_to_assign = left_to_assign[num_in_this_batch:]
-			final_filenames.append(batch_filename)
-			batch_num += 1
-
-		# log adjustment info
-		self.log.debug("Number of times batch size increased: {}".format(num_upward_adjustments))
-		self.log.debug("Number of times batch size decreased: {}".format(num_downward_adjustments))
+					self.log.warning("File {} will produce a compressed/encrypted archive larger than the upload limit ({} bytes > {} bytes)".format(frame_name(file), packer.projected_size(packer.max_member_bytes(file, packer.enc_overhead_ratio)), self.max_batch_bytes))
+
+			packer.add(file)
+
+		if packer is not None:
+			if len(packer.files) > 0:
+				final_filenames.append(self.seal_batch(packer))
+			else:
+				# nothing made it into this one (e.g. every file vanished) -- don't upload an empty batch
+				packer.discard()
 
-		# finally, return the file names we ended up with
 		return final_filenames
+
+	def pack_in_parallel(self, frames:list, base_name):
+		"""
+		plan the batches up front and pack them all at once in the process pool. a batch that fails to pack is skipped (its files are left where they are for next time)
+		"""
+
+		batches = plan_batches(frames, self.max_batch_bytes, self.enc_overhead_ratio, self.batch_format)
+		if len(batches) <= 1:
+			# not worth shipping everything off to another process for
+			return self.pack_in_series(frames, base_name)
+
+		if self.executor is None:
+			self.executor = process_pool(self.num_workers)
+		self.log.info("Packing {} frames as {} batches across {} worker processes.".format(len(frames), len(batches), self.num_workers))
+		futures = [self.executor.submit(pack_batch, base_name, i, batch, self.max_batch_bytes, self.enc_overhead_ratio, self.batch_format) for i, batch in enumerate(batches)]
+
+		final_filenames = []
+		for future, batch in zip(futures, batches):
+			try:
+				stats, files_on_disk, files = future.result()
+			except Exception:
+				self.log.exception("Caught exception while packing a batch of {} frames, skipping it.".format(len(batch)))
+				continue
+			final_filenames.append(self.record_batch(stats, files_on_disk, files))
+		return final_filenames
+
+	def batch_dirs(self):
+		"""
+		returns: every dir batches might be packed into (joined with a batch's name, gives the path it's packed under)
+		"""
+
+		if self.staging is None:
+			return ['']
+		return self.staging.batch_dirs()
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+	def seal_batch(self, packer:BatchPacker):
+		"""
+		seal (encrypt) the given batch, remove the files that went into it and update our estimates
+
+		returns: name of the encrypted batch file
+		"""
+
+		return self.record_batch(packer.seal(), packer.files_on_disk, packer.files)
+
+	def record_batch(self, stats, files_on_disk, files):
+		"""
+		bookkeeping for a freshly sealed batch: remove the files that went into it and update our estimates
+
+		returns: name of the encrypted batch file
+		"""
+
+		self.batch_stats.append(stats)
+		self.batch_info[stats['batch']] = stats
+		self.frames_packed.update(files)
+		if self.staging is not None:
+			self.staging.record_write(stats['batch'], stats['bytes_written'])
+		if self.on_sealed is not None:
+			self.on_sealed(stats)
+		self.log.info("Sealed batch {}: {} files, {} raw bytes -> {} zip bytes -> {} encrypted bytes ({} compress passes, {} encrypt passes, {} bytes written)".format(stats['batch'], stats['num_files'], stats['raw_bytes'], stats['zip_bytes'], stats['enc_bytes'], stats['compress_passes'], stats['encrypt_passes'], stats['bytes_written']), extra=log_fields('package', batch=stats['batch'], frames=stats['num_files'], enc_bytes=stats['enc_bytes'], cpu_secs=round(stats['compress_cpu_secs'], 3)))
+		self.log.info("Batch {} compression: ratio {:.3f}, {:.3f} sec CPU, codecs {}".format(stats['batch'], stats['compress_ratio'], stats['compress_cpu_secs'], stats['codecs']))
+		if stats['enc_bytes'] > self.max_batch_bytes:
+			self.log.warning("Batch {} is larger than the upload limit ({} bytes > {} bytes)".format(stats['batch'], stats['enc_bytes'], self.max_batch_bytes))
+
+		# get rid of the packaged files (in-memory frames never had one)
+		self.log.info("Removing {} packaged files.".format(len(files_on_disk)))
+		for file in files_on_disk:
+			self.log.debug("Removing {}".format(file), extra=log_fields(rate_limit='removing packaged file'))
+			remove(file)
+
+		# update our estimates
+		self.enc_overhead_ratio = max(self.enc_overhead_ratio, (stats['enc_bytes'] - ENC_OVERHEAD_BYTES - stats['zip_bytes']) / stats['zip_bytes'])
+		self.approx_final_bytes_per_img = ((self.approx_final_bytes_per_img*self.num_images_approx_based_on) + stats['enc_bytes']) / (self.num_images_approx_based_on + stats['num_files'])
+		self.num_images_approx_based_on += stats['num_files']
+		self.log.info("New estimated final bytes per image: {}, based on {} total images screened.".format(self.approx_final_bytes_per_img, self.num_images_approx_based_on))
+
+		return stats['batch']
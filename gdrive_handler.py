@@ -4,20 +4,66 @@ gdrive_handler -- handles all of the google drive related functionalities for sv
 import io
 
 from file_handler import *
+from batch_index import *
 from constants import *
 from util import *
 
-from time import time
+from time import time, sleep, strftime, strptime, gmtime
+from calendar import timegm
 import os
+import re
+import threading
 from os.path import getsize
-from shutil import copyfileobj
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from httplib2 import HttpLib2Error
+
+# the discovery document is read from disk once and shared by every handler we build
+_discovery_doc = None
+_discovery_lock = threading.Lock()
+
+# held while finding/making a folder, so two upload threads never make the same one twice
+_folder_lock = threading.Lock()
+
+# upload responses worth waiting out and retrying, on top of any 5xx: the request timed out, or we're being rate limited. any other 4xx is on our end and won't get better
+RETRYABLE_HTTP_STATUSES = (408, 429)
+
+# how each partitioned layout names its period folders (in UTC), and how long a period is
+REMOTE_PERIODS = {
+	'hour': ("%Y-%m-%dT%H", 3600),
+	'day': ("%Y-%m-%d", 86400),
+}
+
+def load_discovery_doc(cache_loc=GDRIVE_DISCOVERY_CACHE_LOC):
+	"""
+	get the drive v3 discovery document from the local cache. the first time round it's taken from the copy that ships with googleapiclient and cached for next time
+
+	returns: the document (JSON text), or None if there's no copy to be had locally
+	"""
+
+	global _discovery_doc
+	with _discovery_lock:
+		if _discovery_doc is not None:
+			return _discovery_doc
+		if os.path.isfile(cache_loc):
+			with open(cache_loc) as f:
+				_discovery_doc = f.read()
+			return _discovery_doc
+		try:
+			from googleapiclient.discovery_cache import get_static_doc
+		except ImportError:
+			# (older googleapiclient -- build will have to fetch it)
+			return None
+		_discovery_doc = get_static_doc('drive', 'v3')
+		if _discovery_doc is not None:
+			with open(cache_loc, 'w') as f:
+				f.write(_discovery_doc)
+		return _discovery_doc
 
 def init_service():
 	# shamelessly stolen from the quickstart file
@@ -41,7 +87,39 @@ def init_service():
 			
 	
 	# NOTE: this can return an HttpError (I think)
-	return build('drive', 'v3', credentials=creds)
+	discovery_doc = load_discovery_doc()
+	if discovery_doc is None:
+		return build('drive', 'v3', credentials=creds)
+	return build_from_document(discovery_doc, credentials=creds)
+
+def remote_folder_path(file_name, layout):
+	"""
+	where a file goes under the given remote layout: batches go in <host>/<period> (by the time in their name), everything else goes straight in the working dir
+
+	returns: (host folder name, period folder name), or None for the working dir
+	"""
+
+	if (layout not in REMOTE_PERIODS) or (re.search(r"_B\d+\.", file_name) is None):
+		return None
+	hostname, timestamp = parse_file_name(file_name)
+	if timestamp is None:
+		return None
+	return hostname, strftime(REMOTE_PERIODS[layout][0], gmtime(timestamp))
+
+def period_bounds(folder_name):
+	"""
+	the time range a period folder (of any layout) covers
+
+	returns: (start, end) in s since epoch, or None if it isn't a period folder
+	"""
+
+	for period_format, period_secs in REMOTE_PERIODS.values():
+		try:
+			start_time = timegm(strptime(folder_name, period_format))
+		except ValueError:
+			continue
+		return start_time, start_time + period_secs
+	return None
 	
 
 class GDriveHandler:
@@ -49,14 +127,29 @@ class GDriveHandler:
 	actual handler class
 	"""
 	
-	def __init__(self):
+	def __init__(self, service=None, chunk_size=UPLOAD_CHUNK_SIZE, index:BatchIndex=None, layout=REMOTE_LAYOUT):
 		self.log = get_logger('gdrive_handler.GDriveHandler')
-		try:
-			self.service = init_service()
-		except HttpError as e:
-			self.log.error("Caught HTTP error while initializing google drive handler: {}".format(e))
+		if service is not None:
+			# mostly so the handler can be pointed at a fake drive for testing
+			self.service = service
+		else:
+			try:
+				self.service = init_service()
+			except HttpError as e:
+				self.log.error("Caught HTTP error while initializing google drive handler: {}".format(e))
 
 		self.working_dir_id = None # hold onto this so we don't have to get it every time
+		self.layout = layout
+		self.folder_ids = {} # (parent folder ID, name) -> ID of the subfolders we've found or made, same idea
+		self.index = index # local record of what we've uploaded. if there is one, purging works off of it instead of listing drive
+		self.chunk_size = chunk_size
+		self.max_upload_retries = MAX_UPLOAD_RETRIES
+		self.upload_retry_base_secs = UPLOAD_RETRY_BASE_SECS
+		self.list_page_size = GDRIVE_LIST_PAGE_SIZE
+		self.verify_mode = VERIFY_MODE
+		self.verify_audit_every_n = VERIFY_AUDIT_EVERY_N
+		self.num_verified = 0
+		self.uploaded_checksums = {} # drive file ID -> MD5 drive reported on upload, held until the file is verified
 
 	def get_working_dir_id(self):
 		"""
@@ -70,7 +163,7 @@ class GDriveHandler:
 
 		# get the contents of the 'my drive'/top level dir
 		try:
-			gdrive_qry = self.service.files().list(q="trashed=false and name contains 'sv_dev'",fields="nextPageToken, files(id, name)").execute()
+			gdrive_qry = self.service.files().list(q="trashed=false and name = '{}' and mimeType = '{}'".format(ACTIVE_GDRIVE_DIR_NAME, GDRIVE_FOLDER_MIME_TYPE),fields="nextPageToken, files(id, name)").execute()
 			top_lv_contents = gdrive_qry.get('files',[])
 		except HttpError as e:
 			self.log.error("Caught HTTP error while getting the contents of the top level dir: {}".format(e))
@@ -88,11 +181,92 @@ class GDriveHandler:
 			return []
 		self.working_dir_id = top_lv_qry[0]['id']
 		return self.working_dir_id
+
+	def get_folder_id(self, name, parent_id, create=True):
+		"""
+		get the ID of the folder with the given name in the given folder on google drive, making it first if it isn't there yet (and we're allowed to)
+
+		returns: the folder's ID, or None if it couldn't be found or made
+		"""
+
+		key = (parent_id, name)
+		with _folder_lock:
+			if key in self.folder_ids:
+				return self.folder_ids[key]
+			found = self.list_files("'{}' in parents and name = '{}' and mimeType = '{}' and trashed=false".format(parent_id, name, GDRIVE_FOLDER_MIME_TYPE))
+			if found is None:
+				return None
+			if found:
+				self.folder_ids[key] = found[0]['id']
+			elif not create:
+				return None
+			else:
+				try:
+					self.folder_ids[key] = self.service.files().create(body={'name': name, 'mimeType': GDRIVE_FOLDER_MIME_TYPE, 'parents': [parent_id]}, fields='id').execute()['id']
+				except HttpError as e:
+					self.log.error("Caught HTTP error while making folder {} on google drive: {}".format(name, e))
+					return None
+				self.log.info("Made folder {} (id: {}) on google drive".format(name, self.folder_ids[key]))
+			return self.folder_ids[key]
+
+	def get_folder_name(self, folder_id):
+		"""
+		returns: the name of the folder with the given ID, or None if it couldn't be found
+		"""
+
+		with _folder_lock:
+			for (parent_id, name), known_id in self.folder_ids.items():
+				if folder_id == known_id:
+					return name
+		try:
+			return self.service.files().get(fileId=folder_id, fields='name').execute().get('name')
+		except HttpError as e:
+			self.log.error("Caught HTTP error while getting the name of folder with ID {}: {}".format(folder_id, e))
+			return None
+
+	def get_upload_dir_id(self, file_name):
+		"""
+		get the ID of the folder the given file should be uploaded into under the remote layout
+
+		returns: the folder's ID, or None if it couldn't be found or made
+		"""
+
+		working_dir_id = self.get_working_dir_id()
+		folder_path = remote_folder_path(file_name, self.layout)
+		if folder_path is None:
+			return working_dir_id
+		host_dir_id = self.get_folder_id(folder_path[0], working_dir_id)
+		if host_dir_id is None:
+			return None
+		return self.get_folder_id(folder_path[1], host_dir_id)
+
+	def list_period_folders(self, host_dir_id=None):
+		"""
+		list the period folders in the given host folder (or in every host folder)
+
+		returns: list of dicts with 'id' and 'name', or None if listing failed
+		"""
+
+		if host_dir_id is None:
+			host_dirs = self.list_files("'{}' in parents and mimeType = '{}' and trashed=false".format(self.get_working_dir_id(), GDRIVE_FOLDER_MIME_TYPE))
+		else:
+			host_dirs = [{'id': host_dir_id}]
+		if host_dirs is None:
+			return None
+		period_dirs = []
+		for host_dir in host_dirs:
+			listing = self.list_files("'{}' in parents and mimeType = '{}' and trashed=false".format(host_dir['id'], GDRIVE_FOLDER_MIME_TYPE))
+			if listing is None:
+				return None
+			period_dirs.extend(x for x in listing if period_bounds(x['name']) is not None)
+		return period_dirs
 		
-	def upload_file(self, path_to_file):
+	def upload_file(self, path_to_file, batch_info=None):
 		"""
 		upload the file located at the specified path to google drive within the working directory
 
+		batch_info (stats from FileHandler) fills in the capture time range and frame count in the index, otherwise the time in the file name is used
+
 		returns: ID of uploaded file, or "" if failure to upload
 		"""
 
@@ -103,24 +277,73 @@ class GDriveHandler:
 		if not os.path.isfile(path_to_file):
 			self.log.error("Error uploading file: file {} not found".format(path_to_file))
 			return ""
-		# make sure the file is small enough
-		#TODO figure out how to remove this req by doing bigger uploads
-		filesize = getsize(path_to_file)
-		if filesize > MAX_FILE_SIZE_PER_UPLOAD:
-			self.log.warning("File {} is too large ({} bytes > max limit of {} bytes) to upload using simple (i.e. non interruptable) upload type. Will attempt to upload regardless, but integrity may be compromised.".format(path_to_file,filesize,MAX_FILE_SIZE_PER_UPLOAD))
-		# basic verifications complete -- proceed to upload
-
-		working_dir_id = self.get_working_dir_id()
-		meta_info = {'name':path_to_file,'parents':[working_dir_id]}
-		media = MediaFileUpload(path_to_file)
+		# name it after the file itself, wherever it happens to live locally (e.g. the backup dir)
+		file_name = os.path.basename(path_to_file)
+		parent_id = self.get_upload_dir_id(file_name)
+		if parent_id is None:
+			self.log.error("Error uploading file {}: couldn't find or make its folder on google drive".format(path_to_file))
+			return ""
+		meta_info = {'name':file_name,'parents':[parent_id]}
+		media = MediaFileUpload(path_to_file, chunksize=self.chunk_size, resumable=True)
 		try:
-			upload_result = self.service.files().create(body=meta_info,media_body=media,fields='id').execute()
+			request = self.service.files().create(body=meta_info,media_body=media,fields='id, md5Checksum')
+			upload_result = self.run_resumable_upload(request, path_to_file)
 		except HttpError as e:
 			self.log.error("Caught HTTP error while uploading file {}: {}".format(path_to_file,e))
+			return ""
+
+		if upload_result is None:
+			return ""
+
+		# hold onto drive's checksum so we can verify without downloading
+		if 'md5Checksum' in upload_result:
+			self.uploaded_checksums[upload_result.get('id')] = upload_result['md5Checksum']
+
+		if self.index is not None:
+			hostname, timestamp = parse_file_name(file_name)
+			if (batch_info is not None) and (batch_info['start_time'] is not None):
+				self.index.add(upload_result.get('id'), file_name, hostname, batch_info['start_time'], batch_info['end_time'], getsize(path_to_file), upload_result.get('md5Checksum'), batch_info['num_files'], parent_id)
+			else:
+				self.index.add(upload_result.get('id'), file_name, hostname, timestamp, timestamp, getsize(path_to_file), upload_result.get('md5Checksum'), parent_id=parent_id)
 
 		# return the ID given by the service
 		return upload_result.get('id')
 
+	def run_resumable_upload(self, request, path_to_file):
+		"""
+		send the given resumable upload request chunk by chunk. if the connection drops partway through, the next attempt asks drive how much it has and picks up from the last acknowledged byte rather than starting over
+
+		returns: the response body from drive, or None if the upload had to be abandoned
+		"""
+
+		response = None
+		num_failures = 0
+		while response is None:
+			try:
+				status, response = request.next_chunk()
+			except HttpError as e:
+				if (e.resp.status < 500) and (e.resp.status not in RETRYABLE_HTTP_STATUSES):
+					raise
+				error = e
+			except (HttpLib2Error, OSError) as e:
+				error = e
+			else:
+				if status is not None:
+					# made progress -- only consecutive failures count against us
+					num_failures = 0
+					self.log.debug("Uploaded {} of {} bytes of {}".format(status.resumable_progress, status.total_size, path_to_file))
+				continue
+
+			num_failures += 1
+			if num_failures > self.max_upload_retries:
+				self.log.error("Giving up on upload of {} after {} failed attempts: {}".format(path_to_file, num_failures, error))
+				return None
+			delay = self.upload_retry_base_secs * (2 ** (num_failures - 1))
+			self.log.warning("Upload of {} interrupted ({}), resuming in {} sec".format(path_to_file, error, delay))
+			sleep(delay)
+
+		return response
+
 	def remove_file(self, file_id, file_name):
 		"""
 		remove the file with given name and ID from google drive
@@ -128,89 +351,305 @@ class GDriveHandler:
 
 		self.log.info("Deleting file {} with ID {} from google drive".format(file_name,file_id))
 		try:
-			self.service.files().delete(fileId=file_id)
+			self.service.files().delete(fileId=file_id).execute()
 		except HttpError as e:
 			self.log.error("Caught HTTP error while removing file {} with ID {}: {}".format(file_name, file_id, e))
-	
+
+	def remove_files(self, files):
+		"""
+		remove all of the given files (dicts with 'id' and 'name') from google drive, sending up to <max batch size> deletes per HTTP request
+
+		returns: the IDs of the files that are now gone
+		"""
+
+		deleted_ids = []
+		def on_delete(request_id, response, exception):
+			if (exception is not None) and not (isinstance(exception, HttpError) and (404 == exception.resp.status)):
+				self.log.error("Caught HTTP error while removing file with ID {}: {}".format(request_id, exception))
+			else:
+				# (a 404 means someone beat us to it, which is just as good)
+				deleted_ids.append(request_id)
+
+		for i in range(0, len(files), GDRIVE_MAX_BATCH_REQUESTS):
+			batch = self.service.new_batch_http_request(callback=on_delete)
+			for file in files[i:i + GDRIVE_MAX_BATCH_REQUESTS]:
+				self.log.info("Deleting file {} with ID {} from google drive".format(file['name'], file['id']))
+				batch.add(self.service.files().delete(fileId=file['id']), request_id=file['id'])
+			try:
+				batch.execute()
+			except HttpError as e:
+				self.log.error("Caught HTTP error while sending batch delete request: {}".format(e))
+
+		if self.index is not None:
+			self.index.remove(deleted_ids)
+		return deleted_ids
+
 	def purge_olds(self):
 		"""
 		Purge the old (see constants for how old is 'old') files from the working dir on google drive
+
+		period folders are deleted whole (in one request each) once everything that could be in them has expired. files in a period folder that hasn't expired yet are left for when it does
 		"""
 
-		# first get the list of files currently in the working directory
-		working_dir_contents = self.find_existing_files()
 		min_timestamp_to_not_delete = time() - MAX_AGE_BEFORE_PURGE
-		
-		# check each of these to see if their timestamp is older than current time - max time before delete
-		for file in working_dir_contents:
+		self.purge_expired_folders(min_timestamp_to_not_delete)
+		if self.index is not None:
+			# everything we need to know is in the local index
+			working_dir_id = self.get_working_dir_id()
+			expired_files = [x for x in self.index.expired(min_timestamp_to_not_delete) if x['parent_id'] in (None, working_dir_id)]
+		else:
+			# only ask for files created before the cutoff, so we only ever see what actually needs deleting
+			expired_files = self.find_existing_files(created_before=min_timestamp_to_not_delete)
+
+		# double check each of these against the timestamp in its name, and leave anything we didn't make alone
+		to_delete = []
+		for file in expired_files:
 			name = file['name']
-			file_id = file['id']
 			
 			hostname,timestamp = parse_file_name(name)
 			if (hostname is None) or (timestamp is None):
 				self.log.error("Found file in working directory with improperly formatted name: {}".format(name))
 				# ignore this file
-			else:
-				# check if old enough to delete
-				if timestamp < min_timestamp_to_not_delete:
-					# this file is too old -- delete it
-					self.remove_file(file_id,name)
+			elif timestamp < min_timestamp_to_not_delete:
+				# this file is too old -- delete it
+				to_delete.append(file)
+
+		if 0 != len(to_delete):
+			deleted_ids = self.remove_files(to_delete)
+			self.log.info("Purged {} of {} expired files from google drive".format(len(deleted_ids), len(to_delete)))
+
+	def purge_expired_folders(self, cutoff):
+		"""
+		delete every period folder that ends before the cutoff (s since epoch), along with everything in it
+
+		with an index the folders come from the index, otherwise from listing the host folders -- either way it's a handful of requests however many files there are
+		"""
+
+		if self.index is not None:
+			working_dir_id = self.get_working_dir_id()
+			folder_ids = set(x['parent_id'] for x in self.index.expired(cutoff)) - {None, working_dir_id}
+			period_dirs = [{'id': x, 'name': self.get_folder_name(x)} for x in folder_ids]
+			period_dirs = [x for x in period_dirs if (x['name'] is not None) and (period_bounds(x['name']) is not None)]
+		elif self.layout in REMOTE_PERIODS:
+			period_dirs = self.list_period_folders()
+			if period_dirs is None:
+				return
+		else:
+			# (nothing's ever been put in a folder)
+			return
+
+		expired_dirs = [x for x in period_dirs if period_bounds(x['name'])[1] <= cutoff]
+		if 0 == len(expired_dirs):
+			return
+		deleted_ids = self.remove_files(expired_dirs)
+		if self.index is not None:
+			self.index.remove_in_folders(deleted_ids)
+		with _folder_lock:
+			self.folder_ids = {k: v for k, v in self.folder_ids.items() if v not in deleted_ids}
+		self.log.info("Purged {} of {} expired folders from google drive".format(len(deleted_ids), len(expired_dirs)))
+
+	def reconcile_index(self):
+		"""
+		repair any drift between the local index and what's actually in the working directory on google drive
+		"""
+
+		if self.index is None:
+			return
+		# (anything uploaded from here on might not make it into the listing)
+		listed_at = time()
+		remote_files = self.list_remote_files(fields="id, name, size, md5Checksum, parents")
+		if remote_files is None:
+			# don't reconcile against a listing that failed partway through -- we'd forget about everything
+			return
+		self.index.reconcile(remote_files, listed_at)
+
+	def list_files(self, query, fields="id, name"):
+		"""
+		list every file matching the given query, following the page tokens all the way through
 
-	def find_existing_files(self):
+		returns: list of file dicts with the given fields, or None if listing failed
 		"""
-		helper function for purging old files: list the current contents of the working directory
+
+		files = []
+		page_token = None
+		while True:
+			try:
+				result = self.service.files().list(q=query, pageSize=self.list_page_size, pageToken=page_token, fields="nextPageToken, files({})".format(fields)).execute()
+			except HttpError as e:
+				self.log.error("Caught HTTP error while listing files matching {}: {}".format(query, e))
+				return None
+			files.extend(result.get('files',[]))
+			page_token = result.get('nextPageToken')
+			if page_token is None:
+				return files
+
+	def list_remote_files(self, fields="id, name"):
+		"""
+		list every file in the working directory and the folders under it (one listing per folder)
+
+		returns: list of file dicts with the given fields (folders left out), or None if listing failed
+		"""
+
+		files = []
+		folder_ids = [self.get_working_dir_id()]
+		while folder_ids:
+			listing = self.list_files("'{}' in parents and trashed=false".format(folder_ids.pop()), fields="mimeType, " + fields)
+			if listing is None:
+				return None
+			for file in listing:
+				if GDRIVE_FOLDER_MIME_TYPE == file.get('mimeType'):
+					folder_ids.append(file['id'])
+				else:
+					files.append(file)
+		return files
+
+	def find_existing_files(self, created_before=None):
+		"""
+		helper function for purging old files: list the current contents of the working directory (optionally only those created before the given time, in s since epoch)
 		"""
 	
 		# find the working directory ID
 		working_dir_id = self.get_working_dir_id()
 		
 		# now that we have the ID of the directory, we can list its contents
-		try:
-			working_dir_contents = self.service.files().list(q='"{}" in parents'.format(working_dir_id), fields="nextPageToken, files(id, name)").execute().get('files',[])
-		except HttpError as e:
-			self.log.error("Caught HTTP error while getting contents of working directory: {}".format(e))
+		query = "'{}' in parents and trashed=false and mimeType != '{}'".format(working_dir_id, GDRIVE_FOLDER_MIME_TYPE)
+		if created_before is not None:
+			query += " and createdTime < '{}'".format(strftime("%Y-%m-%dT%H:%M:%S", gmtime(created_before)))
+		working_dir_contents = self.list_files(query)
+		if working_dir_contents is None:
 			return []
 
 		if not working_dir_contents:
-			# this is not an error -- we'll get this if the directory is cleared completely
-			self.log.warning("No files found in working directory: {} (id: {})".format(ACTIVE_GDRIVE_DIR_NAME,working_dir_id))
+			# this is not an error -- we'll get this if the directory is cleared completely (or nothing has expired)
+			self.log.info("No files found in working directory: {} (id: {})".format(ACTIVE_GDRIVE_DIR_NAME,working_dir_id))
 			return []
 		
 		# we have the contents of the directory (names and file IDs) -- just return that as-is
 		return working_dir_contents
 
+	def verify_upload(self, path_to_file, uploaded_file_id, local_checksum=None):
+		"""
+		verify that the file at the specified path matches the one on google drive at the given id. delete the local file in the event of a verification success
+
+		in checksum mode, the MD5 we computed while producing the file (or of the file on disk, if not given) is compared to the one drive reports, and only 1 in every <audit N> uploads is downloaded and compared in full. in download mode every upload is downloaded and compared
+		"""
+
+		self.num_verified += 1
+		remote_checksum = self.uploaded_checksums.pop(uploaded_file_id, None)
+		if ('download' == self.verify_mode) or ((self.verify_audit_every_n > 0) and (0 == self.num_verified % self.verify_audit_every_n)):
+			self.log.info("Verifying {} by downloading it from drive".format(path_to_file))
+			ver = self.verify_upload_by_download(path_to_file, uploaded_file_id)
+		else:
+			ver = self.verify_upload_by_checksum(path_to_file, uploaded_file_id, local_checksum, remote_checksum)
+
+		if ver:
+			# verification success! Delete the local file
+			remove(path_to_file)
+		return ver
+
+	def get_remote_checksum(self, file_id):
+		"""
+		ask drive for the MD5 of the file with the given ID
+
+		returns: the checksum, or None if it couldn't be retrieved
+		"""
+
+		try:
+			return self.service.files().get(fileId=file_id, fields='md5Checksum').execute().get('md5Checksum')
+		except HttpError as e:
+			self.log.error("Caught HTTP error while getting checksum of file with ID {}: {}".format(file_id, e))
+			return None
+
+	def verify_upload_by_checksum(self, path_to_file, uploaded_file_id, local_checksum=None, remote_checksum=None):
+		if local_checksum is None:
+			local_checksum = file_md5(path_to_file)
+		if remote_checksum is None:
+			remote_checksum = self.get_remote_checksum(uploaded_file_id)
+
+		if local_checksum != remote_checksum:
+			self.log.error("Checksum of file on drive ({}) does NOT match local file {} ({}). Marking local file for local backup.".format(remote_checksum, path_to_file, local_checksum))
+			return False
+		return True
 
-	def verify_upload(self, path_to_file, uploaded_file_id):
+	def verify_upload_by_download(self, path_to_file, uploaded_file_id):
 		"""
-		verify that the file at the specified path matches the one on google drive at the given id. delete downloaded and verified file when complete in the event of a verification success
+		download the file with the given ID from drive and compare it byte for byte with the local file
 		"""
 
 		# download the file to a temp file
 		ver_file_name = path_to_file + "_TMP_VER.raw"
+		data = self.download_file(uploaded_file_id)
+		if data is None:
+			return False
+		with open(ver_file_name,'wb') as verfile:
+			verfile.write(data)
+
+		# download finished, now check that files match
+		match = check_if_files_match(path_to_file,ver_file_name)
+		remove(ver_file_name)
+		if not match:
+			# verification not successful! tell the controller to perform a backup!
+			self.log.error("Downloaded file from drive does NOT match local file. Deleting downloaded file and marking local file for local backup.")
+		return match
+
+	def download_file(self, file_id):
+		"""
+		download the whole of the file with the given ID from drive
+
+		returns: the file's bytes, or None if the download failed
+		"""
+
 		try:
-			req = self.service.files().get_media(fileId=uploaded_file_id)
+			req = self.service.files().get_media(fileId=file_id)
 			fh = io.BytesIO()
 			dler = MediaIoBaseDownload(fh, req)
 			done = False
 			while not done:
 				stat, done = dler.next_chunk()
+		except HttpError as e:
+			self.log.error("Caught HTTP error while downloading file with ID {}: {}".format(file_id, e))
+			return None
+		return fh.getvalue()
 
-			fh.seek(0)
-			with open(ver_file_name,'wb') as verfile:
-				copyfileobj(fh, verfile)
+	def download_range(self, file_id, start, end):
+		"""
+		download bytes [start, end) of the file with the given ID from drive (for pulling single frames out of seekable batches)
 
-		except HttpError:
-			self.log.error("Caught HTTP error while downloading file with ID {} (local path: {})".format(uploaded_file_id,path_to_file))
-			return False
+		returns: the bytes, or None if the download failed
+		"""
 
-		# download finished, now check that files match
-		if check_if_files_match(path_to_file,ver_file_name):
-			# verification success! Delete both files
-			remove(path_to_file)
-			remove(ver_file_name)
-			return True
-		else:
-			self.log.error("Downloaded file from drive does NOT match local file. Deleting downloaded file and marking local file for local backup.")
-			# verification not successful! tell the controller to perform a backup!
-			remove(ver_file_name)
-			return False
+		try:
+			req = self.service.files().get_media(fileId=file_id)
+			req.headers['Range'] = "bytes={}-{}".format(start, end - 1)
+			return req.execute()
+		except HttpError as e:
+			self.log.error("Caught HTTP error while downloading bytes {}-{} of file with ID {}: {}".format(start, end - 1, file_id, e))
+			return None
+
+	def find_batches(self, host, start_time, end_time, slack=RESTORE_PACK_SLACK_SECS):
+		"""
+		find every batch from the given host that might have frames from the given time range (s since epoch) in it
+
+		the local index knows each batch's capture time range. without one, all we have is the time in the name, which is when the batch was packed -- after every frame in it was captured, and (normally) no more than <slack> s after the last one. so with a partitioned layout, only the period folders overlapping the time range (plus slack) need listing
+
+		returns: list of dicts with 'id' and 'name', oldest first
+		"""
+
+		if self.index is not None:
+			return [{'id': x['file_id'], 'name': x['name']} for x in self.index.in_range(host, start_time, end_time)]
+
+		latest_time = end_time + slack
+		candidates = self.find_existing_files()
+		host_dir_id = self.get_folder_id(host, self.get_working_dir_id(), create=False)
+		if host_dir_id is not None:
+			for period_dir in self.list_period_folders(host_dir_id) or []:
+				period_start, period_end = period_bounds(period_dir['name'])
+				if (period_end > start_time) and (period_start <= latest_time):
+					candidates.extend(self.list_files("'{}' in parents and trashed=false".format(period_dir['id'])) or [])
+
+		batches = []
+		for file in candidates:
+			file_host, timestamp = parse_file_name(file['name'])
+			if (host == file_host) and (timestamp is not None) and (start_time <= timestamp <= latest_time):
+				batches.append((timestamp, file))
+		return [x[1] for x in sorted(batches, key=lambda x: x[0])]
@@ -0,0 +1,170 @@
+"""
+log_shipper -- ships the log to google drive a piece at a time: only what's been added since the last successful upload goes up, compressed and encrypted
+"""
+
+from util import *
+from file_handler import *
+
+import sqlite3
+import threading
+from glob import glob, escape as glob_escape
+from os import rename
+from os.path import isfile, getsize
+
+class LogShipper:
+	"""
+	keeps track (on disk, so it survives restarts) of how far into each log file we've shipped. logs left over from a previous run get the rest of their tails shipped along with the current one
+
+	once the current log has grown past <rotate bytes> it's renamed to <log>_R<n>.log and a fresh log started in its place, whether or not it's been shipped (so it can't grow without end while drive is unreachable). a rotated log is shipped like any other left over log until it's done with. only the newest <keep> rotated logs are kept locally, on top of any that haven't been shipped in full yet
+
+	at most <segment bytes> go up in one segment, so a long backlog is shipped a piece at a time rather than read into memory all at once
+
+	safe to share between the upload worker threads (only one ship happens at a time)
+	"""
+
+	def __init__(self, encryptor:Encryptor, log_path=LOGFILE_NAME, db_path=LOG_SHIP_DB_LOC, rotate_bytes=LOG_ROTATE_BYTES, keep=LOG_ROTATE_KEEP, segment_bytes=LOG_SEGMENT_MAX_BYTES):
+		self.encryptor = encryptor
+		self.log_path = log_path
+		self.rotate_bytes = rotate_bytes
+		self.keep = keep
+		self.segment_bytes = segment_bytes
+		self.conn = sqlite3.connect(db_path, check_same_thread=False)
+		self.lock = threading.Lock()
+		# held for the whole of a ship, so the same bytes never go up twice
+		self.ship_lock = threading.Lock()
+		self.num_segments_shipped = 0
+		self.bytes_shipped = 0
+		self.log = get_logger('log_shipper.LogShipper')
+		with self.lock, self.conn:
+			self.conn.execute("CREATE TABLE IF NOT EXISTS logs (path TEXT PRIMARY KEY, offset INTEGER NOT NULL DEFAULT 0, num_segments INTEGER NOT NULL DEFAULT 0, num_rotations INTEGER NOT NULL DEFAULT 0)")
+			self.conn.execute("INSERT OR IGNORE INTO logs (path) VALUES (?)", (log_path,))
+
+	def progress(self, path):
+		"""
+		returns: (offset shipped up to, number of segments shipped, number of rotations) for the given log
+		"""
+
+		with self.lock:
+			return self.conn.execute("SELECT offset, num_segments, num_rotations FROM logs WHERE path = ?", (path,)).fetchone()
+
+	def ship(self, drive_handler):
+		"""
+		ship everything that's been added to the logs since last time, then rotate the current log if it's due
+
+		returns: True if everything there was to ship made it up
+		"""
+
+		with self.ship_lock:
+			with self.lock:
+				paths = [x[0] for x in self.conn.execute("SELECT path FROM logs ORDER BY path").fetchall()]
+			ok = True
+			for path in paths:
+				shipped = self.ship_tail(path, drive_handler)
+				if (path != self.log_path) and shipped:
+					# done with this one for good
+					with self.lock, self.conn:
+						self.conn.execute("DELETE FROM logs WHERE path = ?", (path,))
+				ok = ok and shipped
+
+			# (even if it didn't all make it up: what's left stays in the table until it does)
+			if isfile(self.log_path) and (getsize(self.log_path) >= self.rotate_bytes):
+				ok = self.rotate(drive_handler) and ok
+			self.prune()
+			return ok
+
+	def ship_tail(self, path, drive_handler):
+		"""
+		ship the given log from where we left off up to the end of its last complete line, in segments of at most <segment bytes>
+
+		returns: True unless there was something to ship and it didn't make it up
+		"""
+
+		if not isfile(path):
+			self.log.warning("Log {} has gone missing, giving up on shipping the rest of it".format(path))
+			return True
+		offset, _, _ = self.progress(path)
+		size = getsize(path)
+		if size < offset:
+			# someone's replaced or truncated it under us, so it's all new
+			self.log.warning("Log {} is smaller than what we've already shipped ({} bytes < {} bytes), starting it over".format(path, size, offset))
+			offset = 0
+		with open(path, 'rb') as f:
+			while offset < size:
+				f.seek(offset)
+				segment = f.read(min(size - offset, self.segment_bytes))
+				# don't split a line across two uploads (unless it's one line longer than a whole segment)
+				end = segment.rfind(b'\n') + 1
+				if end > 0:
+					segment = segment[:end]
+				elif len(segment) < self.segment_bytes:
+					break
+				if not self.ship_segment(path, offset, segment, drive_handler):
+					return False
+				offset += len(segment)
+		return True
+
+	def ship_segment(self, path, offset, segment, drive_handler):
+		"""
+		ship <segment>, the bytes of the given log starting at <offset>
+
+		returns: True if it made it up
+		"""
+
+		_, num_segments, _ = self.progress(path)
+		enc_fname = path[:-4] + "_{}.log.gpg".format(num_segments)
+		if self.encryptor.encrypt_stream(io.BytesIO(segment), enc_fname, compress=True) is None:
+			return False
+		try:
+			if "" == drive_handler.upload_file(enc_fname):
+				self.log.error("Failed to ship {} bytes of log {}, will try again next time".format(len(segment), path))
+				return False
+		finally:
+			# do not verify, just delete the encrypted file
+			remove(enc_fname)
+
+		with self.lock, self.conn:
+			self.conn.execute("UPDATE logs SET offset = ?, num_segments = num_segments + 1 WHERE path = ?", (offset + len(segment), path))
+		self.num_segments_shipped += 1
+		self.bytes_shipped += len(segment)
+		self.log.info("Shipped bytes {}-{} of log {} as {}".format(offset, offset + len(segment) - 1, path, enc_fname))
+		return True
+
+	def rotate(self, drive_handler):
+		"""
+		move the current log out of the way, start a fresh one, and ship whatever made it into the old one in between
+
+		returns: True if the old log has been shipped in full
+		"""
+
+		offset, _, num_rotations = self.progress(self.log_path)
+		rotated_path = self.log_path[:-4] + "_R{}.log".format(num_rotations)
+		rename(self.log_path, rotated_path)
+		reopen_log_files()
+		with self.lock, self.conn:
+			self.conn.execute("INSERT OR REPLACE INTO logs (path, offset) VALUES (?,?)", (rotated_path, offset))
+			self.conn.execute("UPDATE logs SET offset = 0, num_rotations = num_rotations + 1 WHERE path = ?", (self.log_path,))
+		self.log.info("Rotated log out to {}".format(rotated_path))
+
+		ok = self.ship_tail(rotated_path, drive_handler)
+		if ok:
+			with self.lock, self.conn:
+				self.conn.execute("DELETE FROM logs WHERE path = ?", (rotated_path,))
+		return ok
+
+	def prune(self):
+		"""
+		only keep the newest few rotated logs around locally (bar any that haven't been shipped in full yet)
+		"""
+
+		rotated = sorted(glob(glob_escape(self.log_path[:-4]) + "_R*.log"), key=lambda x: int(x[len(self.log_path) - 2:-4]))
+		with self.lock:
+			unshipped = set(x[0] for x in self.conn.execute("SELECT path FROM logs").fetchall())
+		for path in rotated[:-self.keep] if self.keep > 0 else rotated:
+			if path not in unshipped:
+				remove(path)
+
+	def stats(self):
+		return {
+			'num_segments_shipped': self.num_segments_shipped,
+			'bytes_shipped': self.bytes_shipped,
+		}
@@ -0,0 +1,206 @@
+"""
+motion -- drops frames that look just like the (empty) scene before they get packaged, so we're not uploading the same picture of nothing over and over, and speeds capture up or down depending on how much is going on
+"""
+
+from util import *
+from file_handler import frame_name
+
+import io
+from collections import deque
+from os import remove
+from os.path import basename
+from time import perf_counter, time
+
+import numpy as np
+from PIL import Image
+
+class MotionFilter:
+	"""
+	compares a small luma (greyscale) version of each frame against a rolling average of the scene, and keeps a frame only if enough of it has changed, or if it's been <keyframe_secs> since the last one we kept
+
+	frames are files or (name, bytes) tuples, same as the packer takes. frames on disk that get dropped are removed
+	"""
+
+	def __init__(self, luma_size=MOTION_LUMA_SIZE, background_alpha=MOTION_BACKGROUND_ALPHA, pixel_threshold=MOTION_PIXEL_THRESHOLD, area_threshold=MOTION_AREA_THRESHOLD, keyframe_secs=MOTION_KEYFRAME_SECS):
+		self.luma_size = luma_size
+		self.background_alpha = background_alpha # weight of each new frame in the background model
+		self.pixel_threshold = pixel_threshold # how far (0-255) a pixel has to be off the background to count as changed
+		self.area_threshold = area_threshold # fraction of pixels that have to change for a frame to count as motion
+		self.keyframe_secs = keyframe_secs
+		self.background = None
+		self.last_kept_time = None
+		self.last_score = 0 # fraction of pixels changed in the most recent frame
+
+		# stats
+		self.num_seen = 0
+		self.num_kept = 0
+		self.num_keyframes = 0 # kept only because it was time for a keyframe
+		self.num_undecodable = 0
+		self.filter_secs = 0
+		self.log = get_logger('motion.MotionFilter')
+
+	def luma(self, frame):
+		"""
+		decode a downscaled greyscale copy of the frame
+
+		draft mode gets the JPEG decoder to do most of the downscaling for us (it just skips the detail), which is far cheaper than decoding at full size
+		"""
+
+		img = Image.open(frame if isinstance(frame, str) else io.BytesIO(frame[1]))
+		img.draft('L', self.luma_size)
+		return np.asarray(img.convert('L').resize(self.luma_size), dtype=np.float32)
+
+	def score(self, luma):
+		"""
+		fraction of the frame that differs from the background, updating the background with it as we go
+		"""
+
+		if self.background is None:
+			self.background = luma.copy()
+			return 1.0
+		changed = np.count_nonzero(np.abs(luma - self.background) > self.pixel_threshold) / luma.size
+		# keep adapting even while there's motion, so lighting changes don't leave us stuck keeping everything
+		self.background += self.background_alpha*(luma - self.background)
+		return changed
+
+	def filter(self, frames:list):
+		"""
+		returns: the frames worth keeping, oldest first
+		"""
+
+		start_time = perf_counter()
+		kept = []
+		num_keyframes = 0
+		# the background model only makes sense if we see the frames in the order they were taken
+		for frame in sorted(frames, key=self.frame_time):
+			self.num_seen += 1
+			frame_time = self.frame_time(frame)
+			try:
+				self.last_score = self.score(self.luma(frame))
+			except Exception:
+				# better to upload something we can't make sense of than to lose it
+				self.log.warning("Could not decode frame {} for motion filtering, keeping it".format(frame_name(frame)))
+				self.num_undecodable += 1
+				kept.append(frame)
+				continue
+
+			if self.last_score >= self.area_threshold:
+				keep = True
+			elif (self.last_kept_time is None) or (frame_time - self.last_kept_time >= self.keyframe_secs):
+				keep = True
+				num_keyframes += 1
+			else:
+				keep = False
+
+			if keep:
+				kept.append(frame)
+				self.last_kept_time = frame_time
+			elif isinstance(frame, str):
+				remove(frame)
+
+		self.num_kept += len(kept)
+		self.num_keyframes += num_keyframes
+		elapsed = perf_counter() - start_time
+		self.filter_secs += elapsed
+		if frames:
+			self.log.info("Motion filter kept {} of {} frames ({} keyframes) at {:.1f} ms/frame. Overall: {}".format(len(kept), len(frames), num_keyframes, 1000*elapsed/len(frames), self.stats()))
+		return kept
+
+	def frame_time(self, frame):
+		_, timestamp = parse_file_name(basename(frame_name(frame)))
+		return time() if timestamp is None else timestamp
+
+	def stats(self):
+		return {
+			'seen': self.num_seen,
+			'kept': self.num_kept,
+			'keyframes': self.num_keyframes,
+			'undecodable': self.num_undecodable,
+			'drop_rate': 0 if 0 == self.num_seen else 1 - self.num_kept/self.num_seen,
+			'ms_per_frame': 0 if 0 == self.num_seen else 1000*self.filter_secs/self.num_seen,
+		}
+
+class CaptureRateController:
+	"""
+	speeds capture up while there's activity and backs it off again once things go quiet
+
+	every so often the newest frame is scored for motion (against its own background model). a score over <active_threshold> drops the capture interval straight to <min_interval>. once scores have stayed under <quiet_threshold> for <hold_secs>, the interval doubles every observation until it reaches <max_interval>. scores in between the two thresholds leave things as they are, so we don't flap around on noise
+
+	every change is passed to each of the listeners (callables taking the new interval in seconds)
+	"""
+
+	def __init__(self, min_interval=SECS_PER_CAP_MIN, max_interval=SECS_PER_CAP_MAX, active_threshold=RATE_CONTROL_ACTIVE_THRESHOLD, quiet_threshold=RATE_CONTROL_QUIET_THRESHOLD, hold_secs=RATE_CONTROL_HOLD_SECS, history_len=RATE_CONTROL_HISTORY_LEN, clock=time):
+		self.min_interval = min_interval
+		self.max_interval = max_interval
+		self.active_threshold = active_threshold
+		self.quiet_threshold = quiet_threshold
+		self.hold_secs = hold_secs
+		self.clock = clock
+		self.interval = max_interval # start out idle
+		self.last_active_time = None
+		self.scorer = MotionFilter()
+		self.listeners = []
+		self.history = deque(maxlen=history_len) # the most recent decisions that changed the interval
+		self.num_observations = 0
+		self.num_changes = 0
+		self.log = get_logger('motion.CaptureRateController')
+
+	def add_listener(self, listener):
+		self.listeners.append(listener)
+		listener(self.interval)
+
+	def update(self, frame):
+		"""
+		score the given frame (file or (name, bytes) tuple) for motion and adjust the capture interval to match
+
+		returns: the capture interval (s)
+		"""
+
+		if frame is None:
+			return self.interval
+		try:
+			luma = self.scorer.luma(frame)
+		except Exception:
+			# (most likely packaged and removed before we got to it)
+			self.log.debug("Could not score frame {}, skipping".format(frame_name(frame)), extra=log_fields(rate_limit='unscorable frame'))
+			return self.interval
+		if self.scorer.background is None:
+			# nothing to compare the first one against
+			self.scorer.score(luma)
+			return self.interval
+		return self.observe(self.scorer.score(luma))
+
+	def observe(self, score):
+		"""
+		adjust the capture interval given the motion score (fraction of the frame changed) of the newest frame
+
+		returns: the capture interval (s)
+		"""
+
+		now = self.clock()
+		self.num_observations += 1
+		if score >= self.active_threshold:
+			self.last_active_time = now
+			new_interval, decision = self.min_interval, 'active'
+		elif (score < self.quiet_threshold) and ((self.last_active_time is None) or (now - self.last_active_time >= self.hold_secs)):
+			new_interval, decision = min(self.max_interval, self.interval*2), 'back off'
+		else:
+			new_interval, decision = self.interval, 'hold'
+
+		if new_interval != self.interval:
+			self.log.info("Capture interval {} -> {} sec ({}, motion score {:.3f})".format(self.interval, new_interval, decision, score))
+			self.history.append({'time': now, 'score': score, 'decision': decision, 'old_interval': self.interval, 'interval': new_interval})
+			self.interval = new_interval
+			self.num_changes += 1
+			for listener in self.listeners:
+				listener(new_interval)
+		return self.interval
+
+	def stats(self):
+		return {
+			'interval': self.interval,
+			'fps': 1 / self.interval,
+			'observations': self.num_observations,
+			'changes': self.num_changes,
+			'history': list(self.history),
+		}
@@ -3,16 +3,31 @@ recorder -- handles all functionalities for svlc related to the capturing of ima
 """
 
 from util import *
-from os.path import isdir
+from scheduler import Histogram
+from os.path import isdir, isfile, getsize
 from os import mkdir
-from picamera import PiCamera # unrunnable except on the pis themselves
+
+import io
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from time import monotonic, sleep
 
 class Recorder:
+	"""
+	still mode: one JPEG written to the images working dir per capture() call
+	"""
 
-	def __init__(self):
+	def __init__(self, staging=None):
+		from picamera import PiCamera # unrunnable except on the pis themselves
 		self.cam = PiCamera()
-		self.cam.resolution = (1024,768) # TODO check if there are other options
+		self.cam.resolution = CAMERA_RESOLUTION # TODO check if there are other options
 		self.warmup_timer = Timer(2) # 2 second warmup
+		self.last_frame = None
+		# (picks the images working dir, and counts what we write)
+		self.staging = staging
+		# how long each frame takes to get from the camera onto the disk (or into staging)
+		self.capture_latency = Histogram()
 		self.log = get_logger('recorder.Recorder')
 
 	def begin_warmup(self):
@@ -26,11 +41,245 @@ class Recorder:
 			return
 
 		# make sure the image working dir exists
-		if not isdir(PATH_TO_IMAGES):
-			self.log.info("Images working directory does not exist. Creating under {}".format(PATH_TO_IMAGES))
-			mkdir(PATH_TO_IMAGES)
+		frame_dir = PATH_TO_IMAGES if self.staging is None else self.staging.frame_dir()
+		if not isdir(frame_dir):
+			self.log.info("Images working directory does not exist. Creating under {}".format(frame_dir))
+			mkdir(frame_dir)
 
 		# generate image name
-		imgname = PATH_TO_IMAGES + gen_file_name('jpg')
+		imgname = frame_dir + gen_file_name('jpg')
 
+		start = monotonic()
 		self.cam.capture(imgname)
+		self.capture_latency.record(monotonic() - start)
+		self.last_frame = imgname
+		if self.staging is not None:
+			self.staging.record_write(imgname, getsize(imgname))
+		mark_startup('first frame')
+
+	def latest_frame(self):
+		"""
+		the most recently captured frame, if it hasn't been packaged yet (otherwise None)
+		"""
+
+		if (self.last_frame is None) or (not isfile(self.last_frame)):
+			return None
+		return self.last_frame
+
+	def stats(self):
+		return {'capture_latency': self.capture_latency.as_dict()}
+
+class FrameSource(ABC):
+	"""
+	something that produces a stream of JPEG encoded frames
+
+	start() is called once before frames() is iterated over, stop() once afterwards
+	"""
+
+	def start(self):
+		pass
+
+	@abstractmethod
+	def frames(self):
+		"""
+		generator of encoded frames (bytes), for as long as the source is running
+		"""
+
+	def stop(self):
+		pass
+
+class PiCameraFrameSource(FrameSource):
+	"""
+	streams frames off the camera's video port, so the still pipeline never has to be re-armed between frames
+	"""
+
+	def __init__(self, resolution=CAMERA_RESOLUTION, framerate=CAMERA_FRAMERATE):
+		self.resolution = resolution
+		self.framerate = framerate
+		self.cam = None
+
+	def start(self):
+		from picamera import PiCamera # unrunnable except on the pis themselves
+		self.cam = PiCamera(resolution=self.resolution, framerate=self.framerate)
+		self.cam.start_preview()
+
+	def frames(self):
+		# the camera encodes each frame into the same stream, which we empty out after every one
+		stream = io.BytesIO()
+		for _ in self.cam.capture_continuous(stream, format='jpeg', use_video_port=True):
+			yield stream.getvalue()
+			stream.seek(0)
+			stream.truncate()
+
+	def stop(self):
+		if self.cam is not None:
+			self.cam.close()
+			self.cam = None
+
+class SyntheticFrameSource(FrameSource):
+	"""
+	generates frames without a camera (a square moving across a gradient) at the given frame rate, so continuous capture can be exercised off the pi
+
+	needs PIL to do the JPEG encoding
+	"""
+
+	def __init__(self, resolution=(320,240), framerate=CAMERA_FRAMERATE, num_frames=None, sleep_fn=sleep):
+		self.resolution = resolution
+		self.framerate = framerate
+		self.num_frames = num_frames # stop after this many (None for never)
+		self.sleep_fn = sleep_fn
+		self.stopped = False
+
+	def start(self):
+		self.stopped = False
+
+	def frames(self):
+		from PIL import Image, ImageDraw
+
+		width, height = self.resolution
+		background = Image.linear_gradient('L').resize(self.resolution).convert('RGB')
+		frame_num = 0
+		while (not self.stopped) and ((self.num_frames is None) or (frame_num < self.num_frames)):
+			img = background.copy()
+			x = (frame_num*8) % width
+			ImageDraw.Draw(img).rectangle([x, height//3, x + width//8, height//3 + height//8], fill=(255,0,0))
+			stream = io.BytesIO()
+			img.save(stream, format='JPEG')
+			yield stream.getvalue()
+			frame_num += 1
+			self.sleep_fn(1 / self.framerate)
+
+	def stop(self):
+		self.stopped = True
+
+class FrameRingBuffer:
+	"""
+	fixed size, in-memory buffer of encoded frames waiting to be packaged. once full (<max frames> frames, or <max bytes> of them), each new frame overwrites the oldest one(s)
+
+	safe to share between the capture thread and whoever is packaging
+	"""
+
+	def __init__(self, max_frames=RING_BUFFER_FRAMES, max_bytes=RING_BUFFER_MAX_BYTES):
+		self.frames = deque() # (name, encoded bytes), oldest first
+		self.max_frames = max_frames
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.num_bytes = 0
+		self.num_pushed = 0
+		self.num_overwritten = 0 # frames that were dropped before anything took them
+		self.log = get_logger('recorder.FrameRingBuffer')
+
+	def __len__(self):
+		with self.lock:
+			return len(self.frames)
+
+	def push(self, name, data):
+		with self.lock:
+			while self.frames and ((len(self.frames) >= self.max_frames) or (self.num_bytes + len(data) > self.max_bytes)):
+				self.num_bytes -= len(self.frames.popleft()[1])
+				self.num_overwritten += 1
+				if 1 == self.num_overwritten % self.max_frames:
+					self.log.warning("Frame ring buffer full, overwriting the oldest frames ({} overwritten so far)".format(self.num_overwritten))
+			self.frames.append((name, data))
+			self.num_bytes += len(data)
+			self.num_pushed += 1
+
+	def latest(self):
+		"""
+		the newest frame in the buffer (None if it's empty)
+		"""
+
+		with self.lock:
+			return self.frames[-1] if self.frames else None
+
+	def snapshot(self):
+		"""
+		every frame currently in the buffer, oldest first. they stay in the buffer until discarded
+		"""
+
+		with self.lock:
+			return list(self.frames)
+
+	def discard(self, frames):
+		"""
+		remove the given frames (e.g. once they've been handed over for packaging). any that have already been overwritten are ignored
+		"""
+
+		names = set(x[0] for x in frames)
+		with self.lock:
+			kept = [x for x in self.frames if x[0] not in names]
+			self.frames = deque(kept)
+			self.num_bytes = sum(len(x[1]) for x in kept)
+
+	def stats(self):
+		with self.lock:
+			return {
+				'frames': len(self.frames),
+				'bytes': self.num_bytes,
+				'pushed': self.num_pushed,
+				'overwritten': self.num_overwritten,
+			}
+
+class ContinuousRecorder:
+	"""
+	continuous mode: a background thread pulls frames from a frame source into a ring buffer, keeping at most one every <min_interval> seconds
+
+	frames only exist in memory until the packer picks them up, so nothing touches the disk until a batch is sealed
+	"""
+
+	def __init__(self, source:FrameSource, ring:FrameRingBuffer=None, min_interval=SECS_PER_CONTINUOUS_CAP, warmup_secs=2, clock=monotonic):
+		self.source = source
+		self.ring = FrameRingBuffer() if ring is None else ring
+		self.min_interval = min_interval
+		self.clock = clock
+		self.warmup_timer = Timer(warmup_secs)
+		self.stopped = threading.Event()
+		self.thread = None
+		self.last_kept_time = None
+		self.num_frames_seen = 0
+		self.num_frames_throttled = 0 # frames the source gave us sooner than min_interval after the last one we kept
+		self.log = get_logger('recorder.ContinuousRecorder')
+
+	def begin_warmup(self):
+		self.source.start()
+		self.warmup_timer.start()
+		self.stopped.clear()
+		self.thread = threading.Thread(target=self.capture_loop, name='capture', daemon=True)
+		self.thread.start()
+
+	def capture_loop(self):
+		try:
+			for data in self.source.frames():
+				if self.stopped.is_set():
+					break
+				self.num_frames_seen += 1
+				if not self.warmup_timer.check_expired():
+					# not warmed up yet, throw the frame away
+					continue
+				now = self.clock()
+				if (self.last_kept_time is not None) and (now - self.last_kept_time < self.min_interval):
+					self.num_frames_throttled += 1
+					continue
+				self.last_kept_time = now
+				# named as if it had been written to the images working dir, so archives look the same in either mode
+				self.ring.push(PATH_TO_IMAGES + gen_file_name('jpg'), data)
+				mark_startup('first frame')
+		except Exception:
+			self.log.exception("Caught exception in continuous capture, stopping.")
+		self.log.info("Continuous capture stopped after {} frames.".format(self.num_frames_seen))
+
+	def latest_frame(self):
+		return self.ring.latest()
+
+	def stop(self):
+		self.stopped.set()
+		self.source.stop()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def stats(self):
+		stats = self.ring.stats()
+		stats['seen'] = self.num_frames_seen
+		stats['throttled'] = self.num_frames_throttled
+		return stats
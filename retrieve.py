@@ -0,0 +1,182 @@
+"""
+retrieve -- pull the frames from a host and time range back out of google drive
+
+seekable batches only have their index and the matching frames downloaded (with ranged downloads). zip batches have to be downloaded and decrypted whole. everything happens in memory -- nothing but the restored frames is written to disk
+
+usage: python retrieve.py <host> <start time> <end time> [output dir]
+	times are in s since epoch. frames end up in <output dir>/<host>/<date>/<hour>/ (local time)
+"""
+
+from gdrive_handler import *
+from file_handler import *
+from batch_index import *
+
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import makedirs
+from os.path import isfile, basename, join, dirname
+from time import localtime, strftime
+
+log = get_logger('retrieve')
+
+def fetch_batch_frames(drive_handler:GDriveHandler, encryptor:Encryptor, batch, start_time, end_time):
+	"""
+	fetch every frame captured in the given time range (s since epoch, inclusive) out of a single batch (a dict with 'id' and 'name')
+
+	returns: (list of (name, frame bytes), number of bytes downloaded). a batch that can't be read gives no frames
+	"""
+
+	if batch['name'].endswith(SeekableBatchPacker.suffix):
+		reader = SeekableBatchReader(partial(drive_handler.download_range, batch['id']), encryptor)
+		try:
+			entries = reader.frames_in_range(start_time, end_time)
+			log.info("Fetching {} of {} frames from seekable batch {}".format(len(entries), len(reader.index()), batch['name']))
+			frames = list(reader.read_frames(entries))
+		except (ValueError, IOError) as e:
+			log.error("Couldn't read seekable batch {}: {}".format(batch['name'], e))
+			return [], reader.bytes_read
+		log.debug("Read {} bytes of {} in {} requests".format(reader.bytes_read, batch['name'], reader.num_reads))
+		return frames, reader.bytes_read
+
+	if batch['name'].endswith(BatchPacker.suffix + '.gpg'):
+		log.info("Fetching all of zip batch {}".format(batch['name']))
+		data = drive_handler.download_file(batch['id'])
+		archive = None if data is None else encryptor.decrypt_stream(io.BytesIO(data))
+		if archive is None:
+			log.error("Couldn't download and decrypt zip batch {}".format(batch['name']))
+			return [], 0 if data is None else len(data)
+		frames = []
+		try:
+			with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+				for name in zf.namelist():
+					_, timestamp = parse_file_name(basename(name))
+					if (timestamp is not None) and (start_time <= timestamp <= end_time):
+						frames.append((name, zf.read(name)))
+		except (zipfile.BadZipFile, ValueError, EOFError, zlib.error) as e:
+			log.error("Couldn't unpack zip batch {}: {}".format(batch['name'], e))
+			return [], len(data)
+		return frames, len(data)
+
+	# (logs and anything else that isn't a batch)
+	return [], 0
+
+def retrieve_frames(drive_handler:GDriveHandler, encryptor:Encryptor, host, start_time, end_time):
+	"""
+	find and fetch every frame from the given host captured in the given time range (s since epoch, inclusive), one batch at a time. a batch that can't be read is skipped
+
+	yields: (name, frame bytes), batch by batch
+	"""
+
+	for batch in drive_handler.find_batches(host, start_time, end_time):
+		yield from fetch_batch_frames(drive_handler, encryptor, batch, start_time, end_time)[0]
+
+def restored_frame_path(out_dir, frame_name):
+	"""
+	where a restored frame goes: <out dir>/<host>/<date>/<hour>/<name>. names within a host sort in capture order, so each folder lists in time order too
+	"""
+
+	name = basename(frame_name)
+	host, timestamp = parse_file_name(name)
+	if timestamp is None:
+		return join(out_dir, name)
+	capture_time = localtime(timestamp)
+	return join(out_dir, host, strftime("%Y-%m-%d", capture_time), strftime("%H", capture_time), name)
+
+class Restorer:
+	"""
+	restores frames from google drive with a bounded pool of download threads. each thread downloads, decrypts and unpacks whole batches, while the frames they produce are written out batch by batch, in order
+
+	each thread gets its own GDriveHandler, since the underlying http connection can't be shared between threads. at most 2x as many batches as there are threads are held in memory at once
+	"""
+
+	def __init__(self, encryptor:Encryptor, drive_handler_factory=GDriveHandler, num_workers=RESTORE_WORKERS):
+		self.encryptor = encryptor
+		self.drive_handler_factory = drive_handler_factory
+		self.num_workers = num_workers
+		self.thread_state = threading.local()
+		self.log = get_logger('retrieve.Restorer')
+
+	def drive_handler(self):
+		if not hasattr(self.thread_state, 'drive_handler'):
+			self.thread_state.drive_handler = self.drive_handler_factory()
+		return self.thread_state.drive_handler
+
+	def fetch(self, batch, start_time, end_time):
+		return fetch_batch_frames(self.drive_handler(), self.encryptor, batch, start_time, end_time)
+
+	def restore(self, host, start_time, end_time, out_dir=RESTORE_DIR):
+		"""
+		restore every frame from the given host captured in the given time range (s since epoch, inclusive) into out_dir
+
+		a batch that can't be fetched is logged and skipped (and counted in the stats), the rest still get restored
+
+		returns: dict of stats (incl. throughput in MB/s and frames/s)
+		"""
+
+		start = time()
+		batches = self.drive_handler().find_batches(host, start_time, end_time)
+		self.log.info("Restoring frames from {} between {} and {} out of {} batches with {} threads".format(host, start_time, end_time, len(batches), self.num_workers))
+
+		num_frames = 0
+		frame_bytes = 0
+		bytes_downloaded = 0
+		num_failed = 0
+		with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+			to_submit = deque(batches)
+			pending = deque()
+
+			def submit_next():
+				batch = to_submit.popleft()
+				pending.append((batch, executor.submit(self.fetch, batch, start_time, end_time)))
+
+			while to_submit and (len(pending) < 2*self.num_workers):
+				submit_next()
+			while pending:
+				batch, future = pending.popleft()
+				# keep the pool busy while we write these out
+				if to_submit:
+					submit_next()
+				try:
+					frames, batch_bytes = future.result()
+				except Exception:
+					# (e.g. the connection dropped partway through) -- the rest of the batches are still worth having
+					self.log.exception("Caught exception while fetching batch {}, skipping it".format(batch['name']))
+					num_failed += 1
+					continue
+				bytes_downloaded += batch_bytes
+				for name, frame in frames:
+					path = restored_frame_path(out_dir, name)
+					makedirs(dirname(path), exist_ok=True)
+					with open(path, 'wb') as f:
+						f.write(frame)
+					num_frames += 1
+					frame_bytes += len(frame)
+
+		elapsed = max(time() - start, 1e-9)
+		stats = {
+			'num_batches': len(batches),
+			'num_failed_batches': num_failed,
+			'num_frames': num_frames,
+			'frame_bytes': frame_bytes,
+			'bytes_downloaded': bytes_downloaded,
+			'secs': elapsed,
+			'download_mb_per_sec': bytes_downloaded / elapsed / 1e6,
+			'frames_per_sec': num_frames / elapsed,
+		}
+		self.log.info("Restored {} frames ({} bytes) from {} batches ({} failed) in {:.2f} sec: {:.2f} MB/s downloaded, {:.1f} frames/s".format(num_frames, frame_bytes, len(batches), num_failed, elapsed, stats['download_mb_per_sec'], stats['frames_per_sec']))
+		return stats
+
+if __name__ == "__main__":
+	host = sys.argv[1]
+	start_time = float(sys.argv[2])
+	end_time = float(sys.argv[3])
+	out_dir = sys.argv[4] if len(sys.argv) > 4 else RESTORE_DIR
+
+	# the local index narrows things down to the batches that actually cover the time range, if we have one. otherwise it goes off the names of everything in the working dir
+	index = BatchIndex() if isfile(BATCH_INDEX_DB_LOC) else None
+	restorer = Restorer(Encryptor(), drive_handler_factory=partial(GDriveHandler, index=index))
+	stats = restorer.restore(host, start_time, end_time, out_dir)
+	print("Restored {} frames from {} batches ({} failed) into {} in {:.2f} s: {:.2f} MB/s, {:.1f} frames/s".format(stats['num_frames'], stats['num_batches'], stats['num_failed_batches'], out_dir, stats['secs'], stats['download_mb_per_sec'], stats['frames_per_sec']))
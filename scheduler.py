@@ -0,0 +1,158 @@
+"""
+scheduler -- runs periodic jobs off of a heap of deadlines, sleeping exactly until the next one is due
+"""
+
+from util import *
+
+import heapq
+from bisect import bisect_left
+from time import monotonic, sleep
+
+# upper edges (in seconds) of the histogram buckets we keep for lateness/overruns. anything beyond the last edge goes in an overflow bucket
+HISTOGRAM_BUCKET_EDGES = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+class Histogram:
+	"""
+	fixed bucket histogram of durations (in seconds)
+	"""
+
+	def __init__(self, edges=HISTOGRAM_BUCKET_EDGES):
+		self.edges = edges
+		self.counts = [0]*(len(edges) + 1)
+		self.total = 0
+		self.max = 0
+		self.num = 0
+
+	def record(self, value):
+		self.counts[bisect_left(self.edges, value)] += 1
+		self.total += value
+		self.max = max(self.max, value)
+		self.num += 1
+
+	def mean(self):
+		if 0 == self.num:
+			return 0
+		return self.total / self.num
+
+	def as_dict(self):
+		labels = ["<={}".format(x) for x in self.edges] + [">{}".format(self.edges[-1])]
+		return {'num': self.num, 'mean': self.mean(), 'max': self.max, 'buckets': dict(zip(labels, self.counts))}
+
+class ScheduledJob:
+	"""
+	a job to be run every <period> seconds
+
+	fixed rate jobs are due every <period> after the first deadline no matter how long they take (so they don't drift), fixed delay jobs are due <period> after the previous run finished
+	"""
+
+	def __init__(self, name, period, callback, fixed_rate=True):
+		self.name = name
+		self.period = period # may be changed while running, takes effect the next time the job is rescheduled
+		self.callback = callback
+		self.fixed_rate = fixed_rate
+		self.next_due = None
+		self.num_runs = 0
+		self.num_skipped = 0 # fixed rate deadlines we were too late to make at all
+		self.lateness = Histogram() # how long after its deadline each run started
+		self.overruns = Histogram() # how much longer than its period each overrunning run took
+
+	def stats(self):
+		return {
+			'period': self.period,
+			'fixed_rate': self.fixed_rate,
+			'num_runs': self.num_runs,
+			'num_skipped': self.num_skipped,
+			'lateness': self.lateness.as_dict(),
+			'overruns': self.overruns.as_dict(),
+		}
+
+class Scheduler:
+
+	def __init__(self, clock=monotonic, sleep_fn=sleep):
+		# monotonic so that wall clock adjustments (e.g. NTP on boot) can't make us skip or double up on jobs
+		self.clock = clock
+		self.sleep_fn = sleep_fn
+		self.heap = [] # (deadline, sequence number, job)
+		self.sequence = 0
+		self.jobs = {}
+		self.log = get_logger('scheduler.Scheduler')
+
+	def add_job(self, name, period, callback, fixed_rate=True, first_delay=None):
+		"""
+		schedule callback() to run every <period> seconds, first after <first_delay> seconds (defaults to one period)
+		"""
+
+		job = ScheduledJob(name, period, callback, fixed_rate)
+		self.jobs[name] = job
+		self.push(job, self.clock() + (period if first_delay is None else first_delay))
+		return job
+
+	def set_period(self, name, period):
+		"""
+		change how often a job runs. if that means it's now due sooner than it was going to be, it's moved up rather than waiting out the old period
+		"""
+
+		job = self.jobs[name]
+		job.period = period
+		deadline = self.clock() + period
+		if deadline < job.next_due:
+			# (the old heap entry is left where it is and skipped over when it comes up)
+			self.push(job, deadline)
+
+	def push(self, job:ScheduledJob, deadline):
+		job.next_due = deadline
+		# the sequence number breaks ties so jobs due at the same time run in the order they were scheduled
+		heapq.heappush(self.heap, (deadline, self.sequence, job))
+		self.sequence += 1
+
+	def run_pending(self):
+		"""
+		run every job whose deadline has passed, and reschedule each one
+
+		returns: seconds until the next deadline, or None if there are no jobs left
+		"""
+
+		while self.heap and (self.heap[0][0] <= self.clock()):
+			deadline, _, job = heapq.heappop(self.heap)
+			if deadline != job.next_due:
+				# superseded by set_period
+				continue
+			start_time = self.clock()
+			job.lateness.record(start_time - deadline)
+			try:
+				job.callback()
+			except Exception:
+				self.log.exception("Caught exception while running job {}".format(job.name))
+			end_time = self.clock()
+			job.num_runs += 1
+
+			run_time = end_time - start_time
+			if run_time > job.period:
+				job.overruns.record(run_time - job.period)
+				self.log.debug("Job {} overran its period by {} sec".format(job.name, run_time - job.period), extra=log_fields(rate_limit='overrun ' + job.name))
+
+			if job.fixed_rate:
+				next_deadline = deadline + job.period
+				if next_deadline < end_time:
+					# we've already missed one or more deadlines entirely -- skip them rather than running back to back to catch up
+					num_missed = int((end_time - next_deadline) // job.period) + 1
+					job.num_skipped += num_missed
+					next_deadline += num_missed*job.period
+			else:
+				next_deadline = end_time + job.period
+			self.push(job, next_deadline)
+
+		if not self.heap:
+			return None
+		return max(0, self.heap[0][0] - self.clock())
+
+	def run_forever(self):
+		while True:
+			wait = self.run_pending()
+			if wait is None:
+				self.log.warning("Nothing left to schedule, stopping.")
+				return
+			self.sleep_fn(wait)
+
+	def stats(self):
+		return {name: job.stats() for name, job in self.jobs.items()}
@@ -0,0 +1,264 @@
+"""
+staging -- keeps frames and freshly packed batches in a RAM-backed dir (a tmpfs) instead of on the SD card while they wait to be uploaded, only spilling them onto the card when uploads stall or staging fills up
+"""
+
+from util import *
+from file_handler import *
+from upload_journal import *
+
+import threading
+from os import makedirs, sep
+from os.path import abspath, getmtime, normpath
+from time import monotonic, time
+
+class StagingArea:
+	"""
+	hands out the dirs frames and batches get written to: <ram dir>/images/ and <ram dir>/batches/ while staging is taking files, otherwise the persistent frame dir and batch dir (on the card)
+
+	staging stops taking files once it holds <max bytes>, or once a batch has sat in it for <stall secs> (uploads have stalled, and anything in RAM goes with the power). check (run every so often) works that out and moves the oldest staged frames over to the persistent frame dir until we're back under <spill ratio> of the cap -- or all of them if uploads have stalled. batches aren't spilled, once written they're the upload pool's (a failed one gets backed up onto the card anyway)
+
+	flush moves everything that's staged and finished over to the persistent dirs, on shutdown (once the upload pool has stopped) and on startup (for anything a crash left behind), so it's picked up like anything else left over
+
+	with no ram dir (or one we can't use) everything goes straight to the persistent dirs. either way every byte we write goes through record_write, so bytes written to flash per hour can be compared with and without staging
+	"""
+
+	def __init__(self, ram_dir=STAGING_DIR, frame_dir=PATH_TO_IMAGES, batch_dir=".", max_bytes=STAGING_MAX_BYTES, spill_ratio=STAGING_SPILL_RATIO, stall_secs=STAGING_STALL_SECS, clock=monotonic, wall_clock=time):
+		self.frame_dir_persistent = frame_dir
+		self.batch_dir_persistent = batch_dir
+		self.max_bytes = max_bytes
+		self.spill_ratio = spill_ratio
+		self.stall_secs = stall_secs
+		self.clock = clock
+		self.wall_clock = wall_clock # (compared with file mtimes)
+		self.start_time = clock()
+		self.lock = threading.Lock()
+		self.log = get_logger('staging.StagingArea')
+
+		self.ram_dir = ram_dir
+		if ram_dir is not None:
+			self.frame_dir_staged = join(ram_dir, 'images') + sep
+			self.batch_dir_staged = join(ram_dir, 'batches')
+			try:
+				makedirs(self.frame_dir_staged, exist_ok=True)
+				makedirs(self.batch_dir_staged, exist_ok=True)
+			except OSError as e:
+				self.log.error("Can't stage files under {} ({}), writing straight to persistent storage instead".format(ram_dir, e))
+				self.ram_dir = None
+		self.accepting = self.ram_dir is not None
+		self.stalled = False
+		self.staged_bytes = 0
+
+		# stats
+		self.num_checks = 0
+		self.num_spilled = 0
+		self.bytes_spilled = 0
+		self.num_flushed = 0
+		self.num_discarded = 0 # unfinished files thrown away by flush
+		self.num_unstaged_batches = 0 # packed straight onto the card because staging wasn't taking them
+		self.num_failed_moves = 0
+		self.flash_bytes_written = 0
+		self.ram_bytes_written = 0
+
+	def is_staged(self, path):
+		return (self.ram_dir is not None) and abspath(path).startswith(abspath(self.ram_dir) + sep)
+
+	def frame_dir(self):
+		"""
+		returns: the dir the next frame should be written to
+		"""
+
+		return self.frame_dir_staged if self.accepting else self.frame_dir_persistent
+
+	def frame_dirs(self):
+		"""
+		returns: every dir frames might be waiting in
+		"""
+
+		if self.ram_dir is None:
+			return [self.frame_dir_persistent]
+		return [self.frame_dir_persistent, self.frame_dir_staged]
+
+	def batch_dir(self, num_bytes=0):
+		"""
+		returns: the dir a batch of (about) <num bytes> should be packed into
+		"""
+
+		if self.ram_dir is None:
+			return self.batch_dir_persistent
+		if self.accepting and (sum(x[1] for x in self.staged_files()) + num_bytes <= self.max_bytes):
+			return self.batch_dir_staged
+		self.num_unstaged_batches += 1
+		return self.batch_dir_persistent
+
+	def batch_dirs(self):
+		"""
+		returns: every dir batches might be waiting in
+		"""
+
+		if self.ram_dir is None:
+			return [self.batch_dir_persistent]
+		return [self.batch_dir_persistent, self.batch_dir_staged]
+
+	def record_write(self, path, num_bytes):
+		"""
+		count <num bytes> just written to <path> against RAM or flash, depending on where it is
+		"""
+
+		with self.lock:
+			if self.is_staged(path):
+				self.ram_bytes_written += num_bytes
+			else:
+				self.flash_bytes_written += num_bytes
+
+	def staged_files(self):
+		"""
+		returns: list of (path, size, mtime, whether it's a frame) of everything in staging, oldest first
+		"""
+
+		if self.ram_dir is None:
+			return []
+		files = []
+		for dir_name, is_frame in ((self.frame_dir_staged, True), (self.batch_dir_staged, False)):
+			for name in listdir(dir_name):
+				path = join(dir_name, name)
+				try:
+					files.append((path, getsize(path), getmtime(path), is_frame))
+				except OSError:
+					# (packaged or uploaded out from under us)
+					continue
+		return sorted(files, key=lambda x: x[2])
+
+	def check(self, in_flight=()):
+		"""
+		measure what's staged, work out whether staging should keep taking files, and spill frames to the card if it's full or uploads have stalled
+
+		returns: whether staging is taking files
+		"""
+
+		if self.ram_dir is None:
+			return False
+		self.num_checks += 1
+		files = self.staged_files()
+		self.staged_bytes = sum(x[1] for x in files)
+		now = self.wall_clock()
+		stalled = any((not is_frame) and (now - mtime >= self.stall_secs) for _, _, mtime, is_frame in files)
+		if stalled != self.stalled:
+			if stalled:
+				self.log.warning("Batches have been waiting in staging for over {} sec, uploads look stalled: writing to persistent storage until they're moving again".format(self.stall_secs), extra=log_fields('staging', stalled=True, staged_bytes=self.staged_bytes))
+			else:
+				self.log.info("Uploads are moving again, back to staging", extra=log_fields('staging', stalled=False, staged_bytes=self.staged_bytes))
+			self.stalled = stalled
+
+		if stalled:
+			self.spill(files, in_flight, 0)
+		elif self.staged_bytes > self.max_bytes:
+			self.spill(files, in_flight, self.max_bytes*self.spill_ratio)
+		# (only start taking files again once there's some room, so we don't flap at the cap)
+		accepting = (not stalled) and ((self.staged_bytes < self.max_bytes) if self.accepting else (self.staged_bytes <= self.max_bytes*self.spill_ratio))
+		if accepting != self.accepting:
+			self.log.log(logging.INFO if accepting else logging.WARNING, "Staging {} ({} bytes staged, cap {})".format("taking files again" if accepting else "full, writing to persistent storage", self.staged_bytes, self.max_bytes), extra=log_fields('staging', accepting=accepting, staged_bytes=self.staged_bytes))
+			self.accepting = accepting
+		return self.accepting
+
+	def spill(self, files, in_flight, target_bytes):
+		"""
+		move the oldest of the given staged frames (bar anything the upload pool is packing) to the persistent frame dir until there are no more than <target bytes> staged
+		"""
+
+		in_flight = set(abspath(x) for x in in_flight)
+		num_spilled = 0
+		bytes_spilled = 0
+		for path, size, _, is_frame in files:
+			if self.staged_bytes <= target_bytes:
+				break
+			if (not is_frame) or (abspath(path) in in_flight):
+				continue
+			if self.move_out(path, self.frame_dir_persistent) is None:
+				continue
+			self.staged_bytes -= size
+			num_spilled += 1
+			bytes_spilled += size
+
+		self.num_spilled += num_spilled
+		self.bytes_spilled += bytes_spilled
+		if num_spilled:
+			self.log.info("Spilled the oldest {} staged frames ({} bytes) to persistent storage".format(num_spilled, bytes_spilled), extra=log_fields('staging', spilled=num_spilled, spilled_bytes=bytes_spilled))
+
+	def move_out(self, path, dest_dir):
+		"""
+		move a staged file over to <dest dir> on the card
+
+		returns: its new path, or None if it couldn't be moved
+		"""
+
+		if not isdir(dest_dir):
+			makedirs(dest_dir)
+		new_path = normpath(join(dest_dir, basename(path)))
+		try:
+			size = getsize(path)
+			move(path, new_path)
+		except OSError as e:
+			self.log.error("Couldn't move {} out of staging: {}".format(path, e))
+			self.num_failed_moves += 1
+			return None
+		self.record_write(new_path, size)
+		return new_path
+
+	def flush(self, journal:UploadJournal, in_flight=()):
+		"""
+		move the finished frames and batches in staging (bar anything the upload pool is still working on) over to the persistent dirs. batches are only ever renamed into place once they're sealed, so anything with a batch's name is a whole one: batches in the journal have it follow them, and any it doesn't know about (sealed just before a crash) are picked up from the batch dir by resume. anything else in staging is half a batch, an intermediate it was being built from, a download being verified, or half a frame, and is thrown away
+
+		returns: number of files moved
+		"""
+
+		in_flight = set(abspath(x) for x in in_flight)
+		num_flushed = 0
+		num_discarded = 0
+		for path, _, _, is_frame in self.staged_files():
+			if abspath(path) in in_flight:
+				continue
+			if is_frame:
+				finished = path.endswith('.jpg')
+			else:
+				finished = path.endswith(BatchPacker.suffix + '.gpg') or path.endswith(SeekableBatchPacker.suffix)
+			if not finished:
+				self.log.warning("Discarding unfinished {} from staging".format(path))
+				try:
+					remove(path)
+				except OSError as e:
+					self.log.error("Couldn't remove {} from staging: {}".format(path, e))
+				num_discarded += 1
+				continue
+
+			new_path = self.move_out(path, self.frame_dir_persistent if is_frame else self.batch_dir_persistent)
+			if new_path is None:
+				continue
+			if (not is_frame) and (journal.state_of(path) is not None):
+				journal.move(path, new_path)
+			num_flushed += 1
+		self.staged_bytes = 0
+		self.num_flushed += num_flushed
+		self.num_discarded += num_discarded
+		if num_flushed or num_discarded:
+			self.log.info("Flushed {} staged files to persistent storage, discarded {} unfinished ones".format(num_flushed, num_discarded), extra=log_fields('staging', flushed=num_flushed, discarded=num_discarded))
+		return num_flushed
+
+	def stats(self):
+		hours = max(self.clock() - self.start_time, 1) / 3600
+		with self.lock:
+			return {
+				'staging': self.ram_dir is not None,
+				'accepting': self.accepting,
+				'stalled': self.stalled,
+				'staged_bytes': self.staged_bytes,
+				'checks': self.num_checks,
+				'spilled': self.num_spilled,
+				'bytes_spilled': self.bytes_spilled,
+				'flushed': self.num_flushed,
+				'discarded': self.num_discarded,
+				'unstaged_batches': self.num_unstaged_batches,
+				'failed_moves': self.num_failed_moves,
+				'ram_bytes_written': self.ram_bytes_written,
+				'flash_bytes_written': self.flash_bytes_written,
+				'flash_bytes_per_hour': self.flash_bytes_written / hours,
+			}
@@ -8,132 +8,214 @@ this file contains the main loop and defers all (other) functionalities elsewher
 primary functionalities:
 	- surveillance:
 		+ recording of static images on a fixed interval, output to files with timestamp and hostname
+		+ or continuous capture off the video port into an in-memory ring buffer (frames only hit the disk once they're packaged)
+		+ optionally keep frames and batches in RAM (a tmpfs) instead of on the SD card until they're uploaded, spilling to the card when uploads stall or it fills up
+		+ optionally capture faster while there's motion, and slower while there isn't
+	- filtering:
+		+ optionally drop frames with no motion in them (bar a keyframe every so often) before they're packaged
+		+ optionally re-encode frames to fit a per frame byte budget
 	- uploading:
 		+ compression of surveillance files for bulk upload
 		+ encryption of compressed bulk upload
+			# or a seekable batch format with every frame encrypted on its own behind an encrypted index (see retrieve.py for getting frames back out)
 		+ upload encrypted files to google drive
+			# optionally growing/shrinking batches and the upload interval to suit the uplink
 		+ verify integrity of upload
+		+ ship new log lines every so often (rotating the log once it gets big)
 			# backup of unverifiable files
 	- cleaning:
 		+ purging of old files
+		+ keeping the local backlog from filling the disk while offline (slowing capture, then keeping only motion frames, then downscaling, then evicting the oldest unsent data)
 			# ignores files moved out of the working dir (i.e. don't just kill everything all the time)
 
 """
 
-DEBUG_NO_RECORDER = False # set this flag to debug on a non-pi system
+DEBUG_NO_RECORDER = False # set this flag to debug on a non-pi system (in continuous mode, frames come from a synthetic source instead)
 
-if not DEBUG_NO_RECORDER:
-	from recorder import *
-from gdrive_handler import *
+# (picamera is only imported once a camera is actually opened, and the google drive stack once the first upload worker needs it)
+from recorder import *
 from file_handler import *
+from uploader import *
+from batch_index import *
+from upload_journal import *
+from scheduler import *
+from log_shipper import *
+from backlog import *
+from staging import *
 from constants import *
+if MOTION_FILTER or CAPTURE_RATE_CONTROL:
+	from motion import *
+if TRANSCODE:
+	from transcode import *
 
-from os import listdir, remove
-from time import time, sleep
-from shutil import copy
+import signal
+import sys
+from os import listdir
+from os.path import isdir
+from functools import partial
+from operator import methodcaller
 
-log = get_logger('main')
+mark_startup('imports done')
 
-# set up objects
-if not DEBUG_NO_RECORDER:
-	recorder = Recorder()
-drive_handler = GDriveHandler()
-file_handler = FileHandler()
-
-# set up timers
-capture_timer = Timer(SECS_PER_STILL_CAP)
-purge_timer = Timer(SECS_PER_PURGE)
-upload_timer = Timer(SECS_PER_UPLOAD)
-log_upload_timer = Timer(SECS_PER_LOG_UPLOAD)
-
-def main_loop(num_times_logs_uploaded=0):
-	# check for timer expiration
-	if capture_timer.check_expired():
-		# perform capture
-		if not DEBUG_NO_RECORDER:
-			recorder.capture()
-		# restart timer for next cycle
-		capture_timer.restart()
-
-	if purge_timer.check_expired():
-		# perform purge
-		drive_handler.purge_olds()
-		# restart timer for next cycle
-		purge_timer.restart()
-
-	if upload_timer.check_expired():
-		# get file list
-		files_to_package = listdir(PATH_TO_IMAGES)
-		files_to_package = [PATH_TO_IMAGES + x for x in files_to_package]
-		# perform compress/encrypt
-		files_to_upload = file_handler.compress_and_encrypt_batch(files_to_package)
-		# most likely, we'll get all or none, but track them separately (and only backup failures) just in case
-		ver_failed_files = []
-		# upload and verify the files
-		for file in files_to_upload:
-			# upload this file
-			drive_file_id = drive_handler.upload_file(file)
-			# verify this file (or backup if ver fails)
-			ver = drive_handler.verify_upload(file, drive_file_id)
-			if not ver:
-				# verification failed, we need to back these files up
-				ver_failed_files.append(file)
-			# otherwise the file will have been deleted
-
-		# backup all failures
-		if 0 != len(ver_failed_files):
-			local_backup(ver_failed_files)
-
-		# restart timer for next cycle
-		upload_timer.restart()
-
-	if log_upload_timer.check_expired():
-		# copy to temp for uploading with new name to avoid rename issues on the drive side
-		copy_of_log = LOGFILE_NAME[:-4] + "_{}.log".format(num_times_logs_uploaded)
-		copy(LOGFILE_NAME,copy_of_log)
-		# perform encrypt (no need to compress logs)
-		enc_fname = LOGFILE_NAME[:-4] + "_{}.log.gpg".format(num_times_logs_uploaded)
-		encrypt_file(copy_of_log,enc_fname)
-		# upload the file
-		drive_handler.upload_file(enc_fname)
-		# do not verify, just delete the temp copy of the file
-		remove(copy_of_log)
-		remove(enc_fname)
-
-		num_times_logs_uploaded += 1
-
-		# restart timer for next cycle
-		log_upload_timer.restart()
-
-	# keeping track of this without using globals cuz apparently python globals suck
-	return num_times_logs_uploaded
+log = get_logger('main')
 
+def new_drive_handler():
+	# runs on the upload threads, so importing the drive stack and building the service happens in the background while capture gets going
+	from gdrive_handler import GDriveHandler
+	return GDriveHandler(index=batch_index)
+
+def capture_job():
+	if recorder is not None:
+		recorder.capture()
+
+def rate_control_job():
+	rate_controller.update(recorder.latest_frame())
+
+# what we'd capture at if the backlog weren't holding us back
+capture_interval = SECS_PER_CONTINUOUS_CAP if 'continuous' == CAPTURE_MODE else SECS_PER_STILL_CAP
+
+def set_capture_interval(secs):
+	global capture_interval
+	capture_interval = secs
+	apply_capture_interval()
+
+def apply_capture_interval(tier=None):
+	secs = capture_interval if backlog is None else backlog.capture_interval(capture_interval)
+	if 'continuous' == CAPTURE_MODE:
+		recorder.min_interval = secs
+	elif 'capture' in scheduler.jobs:
+		scheduler.set_period('capture', secs)
+
+def backlog_job():
+	backlog.check()
+
+def staging_job():
+	staging.check(upload_pool.paths_in_flight())
+
+def shutdown(signum, frame):
+	# (so the staged files get flushed on the way out)
+	sys.exit(0)
+
+def purge_job():
+	upload_pool.submit_job(methodcaller('purge_olds'))
+
+def retry_job():
+	upload_pool.retry_pending()
+
+def reconcile_job():
+	upload_pool.submit_job(methodcaller('reconcile_index'))
+
+def upload_job():
+	# get file list (in continuous mode there may still be some left over from running in still mode), from staging and the card
+	for frame_dir in staging.frame_dirs():
+		if isdir(frame_dir):
+			files_to_package = listdir(frame_dir)
+			# (only finished frames -- not e.g. one that's halfway through being re-encoded)
+			files_to_package = [frame_dir + x for x in files_to_package if x.endswith('.jpg')]
+			# hand them off for compress/encrypt/upload/verify (or backup if ver fails)
+			upload_pool.submit_frames(files_to_package)
+	if 'continuous' == CAPTURE_MODE:
+		# frames stay in the ring buffer until the pool has taken them
+		frames = recorder.ring.snapshot()
+		if upload_pool.submit_frames(frames):
+			recorder.ring.discard(frames)
+		log.debug("Continuous capture stats: {}".format(recorder.stats()))
+	upload_pool.end_cycle()
+	log.debug("Upload pool stats: {}".format(upload_pool.stats()))
+	if upload_controller is not None:
+		# (the controller's decisions are made on the upload threads, but rescheduling has to happen on this one)
+		scheduler.set_period('upload', upload_controller.interval)
+
+def log_upload_job():
+	upload_pool.submit_job(log_shipper.ship)
+
+def stats_job():
+	log.info("Scheduler stats: {}".format(scheduler.stats()))
+	log.info("Log shipping stats: {}".format(log_shipper.stats()))
+	log.info("Logging stats: {}".format(log_stats()))
+	log.info("Startup profile: {}".format(startup_profile()))
+	if rate_controller is not None:
+		log.info("Capture rate controller stats: {}".format(rate_controller.stats()))
+	if upload_controller is not None:
+		log.info("Upload controller stats: {}".format(upload_controller.stats()))
+	if backlog is not None:
+		log.info("Backlog stats: {}".format(backlog.stats()))
+	log.info("Staging stats: {}".format(staging.stats()))
+	if isinstance(recorder, Recorder):
+		log.info("Recorder stats: {}".format(recorder.stats()))
+
+# (everything is set up in here, rather than on import, so that worker processes can import this file without opening the camera etc.)
 if __name__ == "__main__":
 
-	# initialize persistent data
-	num_times_logs_uploaded = 0
-
-	# initialize objects
-	if not DEBUG_NO_RECORDER:
+	# set up objects
+	# (without STAGING everything's written straight to the card, but still counted)
+	staging = StagingArea(STAGING_DIR if STAGING else None)
+	if 'continuous' == CAPTURE_MODE:
+		recorder = ContinuousRecorder(SyntheticFrameSource() if DEBUG_NO_RECORDER else PiCameraFrameSource())
+	elif not DEBUG_NO_RECORDER:
+		recorder = Recorder(staging)
+	else:
+		recorder = None
+	# (the camera's warm-up runs while the rest gets built -- deriving the key alone takes a while)
+	if recorder is not None:
 		recorder.begin_warmup()
+	file_handler = FileHandler()
+	file_handler.staging = staging
+	batch_index = BatchIndex()
+	# all of the packaging and network stuff happens in here so that capture never has to wait on it
+	# optional stages frames go through before they're packaged (dropping the ones with nothing in them first, so we don't waste time re-encoding them)
+	frame_filters = []
+	# (drops/downscales frames only once we're badly backed up)
+	backlog = BacklogManager(staging, in_flight=lambda: upload_pool.paths_in_flight()) if BACKLOG_CONTROL else None
+	if backlog is not None:
+		frame_filters.append(backlog.filter)
+	if MOTION_FILTER:
+		frame_filters.append(MotionFilter().filter)
+	if TRANSCODE:
+		frame_filters.append(FrameTranscoder().transcode)
+	# batch size and upload interval can follow the uplink instead of staying fixed
+	upload_controller = UploadController() if ADAPTIVE_UPLOADS else None
+	upload_journal = UploadJournal()
+	upload_pool = UploadWorkerPool(file_handler, drive_handler_factory=new_drive_handler, journal=upload_journal, frame_filters=frame_filters, controller=upload_controller)
+
+	# only what's been added to the log since last time gets shipped
+	log_shipper = LogShipper(file_handler.encryptor)
+
+	# set up the schedule
+	scheduler = Scheduler()
+	rate_controller = CaptureRateController() if (CAPTURE_RATE_CONTROL and (recorder is not None)) else None
 
-	# start timers
-	capture_timer.start()
-	purge_timer.start()
-	upload_timer.start()
-	log_upload_timer.start()
-
-	# perform the main loop
-	while True:
-		# record cycle start time 
-		start_time = time() # epoch in seconds
-
-		num_times_logs_uploaded = main_loop(num_times_logs_uploaded)
-		
-		end_time = time()
-		remain_cycle_time = SECS_PER_CYCLE - (end_time - start_time)
-		if remain_cycle_time < 0:
-			log.debug("Cycle overrun by {} sec".format(-remain_cycle_time))
-			remain_cycle_time = 0
-		# delay remaining cycle time
-		sleep(remain_cycle_time)
+	# initialize objects
+	# pick up anything left over from last time (incl. whatever was staged when we last went down)
+	staging.flush(upload_journal)
+	upload_pool.start()
+	upload_pool.resume()
+
+	# capture and uploads run at a fixed rate so they don't drift, the rest just need to happen every so often
+	if 'still' == CAPTURE_MODE:
+		scheduler.add_job('capture', SECS_PER_STILL_CAP, capture_job)
+	scheduler.add_job('purge', SECS_PER_PURGE, purge_job, fixed_rate=False)
+	scheduler.add_job('retry', SECS_PER_RETRY_SWEEP, retry_job, fixed_rate=False)
+	scheduler.add_job('reconcile', SECS_PER_INDEX_RECONCILE, reconcile_job, fixed_rate=False)
+	scheduler.add_job('upload', SECS_PER_UPLOAD, upload_job)
+	scheduler.add_job('log_upload', SECS_PER_LOG_UPLOAD, log_upload_job)
+	scheduler.add_job('stats', SECS_PER_STATS_LOG, stats_job, fixed_rate=False)
+	if rate_controller is not None:
+		# (adding the listener applies the controller's starting rate right away)
+		rate_controller.add_listener(set_capture_interval)
+		scheduler.add_job('rate_control', SECS_PER_RATE_CONTROL, rate_control_job)
+	if backlog is not None:
+		# (tier changes happen in backlog_job, so they're applied on this thread)
+		backlog.add_listener(apply_capture_interval)
+		scheduler.add_job('backlog', SECS_PER_BACKLOG_CHECK, backlog_job, fixed_rate=False, first_delay=0)
+	if staging.ram_dir is not None:
+		scheduler.add_job('staging', SECS_PER_STAGING_CHECK, staging_job, fixed_rate=False)
+
+	# perform the main loop, making sure nothing's left in RAM when we stop
+	signal.signal(signal.SIGTERM, shutdown)
+	try:
+		scheduler.run_forever()
+	finally:
+		# (the upload threads own whatever they're working on until they've stopped)
+		stopped = upload_pool.stop()
+		staging.flush(upload_journal, () if stopped else upload_pool.paths_in_flight())
@@ -0,0 +1,302 @@
+"""
+fake_drive -- a tiny local stand-in for the google drive v3 API, enough to exercise GDriveHandler without a network connection
+"""
+
+import json
+import os
+import re
+import threading
+import calendar
+import time
+from email.parser import BytesParser
+from hashlib import md5
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import googleapiclient
+from googleapiclient.discovery import build_from_document
+from googleapiclient.http import build_http
+
+class FakeDriveState:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.files = {} # file ID -> {'name':..., 'parents':..., 'data':...}
+		self.sessions = {} # upload session ID -> {'meta':..., 'data':..., 'total':...}
+		self.next_id = 0
+		# offset into an upload -> number of times to drop the connection when a chunk starting there arrives
+		self.drop_at = {}
+		# offset into an upload -> HTTP statuses to answer chunks starting there with (one per chunk) before taking one
+		self.error_at = {}
+		self.num_sessions_started = 0
+		self.num_status_queries = 0
+		self.num_downloads = 0
+		self.num_range_downloads = 0
+		self.num_list_calls = 0
+		self.num_batch_calls = 0
+		self.num_create_calls = 0
+
+	def metadata(self, file_id):
+		f = self.files[file_id]
+		return {'id': file_id, 'name': f['name'], 'parents': f['parents'], 'mimeType': f['mimeType'], 'createdTime': time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(f['createdTime'])), 'md5Checksum': md5(f['data']).hexdigest()}
+
+	def add_file(self, name, parents, data=b'', created_time=None, mime_type='application/octet-stream'):
+		"""
+		put a file straight into the fake drive
+
+		returns: the new file's ID
+		"""
+
+		with self.lock:
+			file_id = self.new_id()
+			self.files[file_id] = {'name': name, 'parents': parents, 'data': data, 'mimeType': mime_type, 'createdTime': time.time() if created_time is None else created_time}
+		return file_id
+
+	def matches(self, file_id, query):
+		"""
+		evaluate the (small) subset of the drive query language that GDriveHandler uses
+		"""
+
+		f = self.files[file_id]
+		for clause in query.split(" and "):
+			clause = clause.strip()
+			in_parents = re.match(r"'([^']*)' in parents", clause)
+			comparison = re.match(r"(\w+)\s*(!=|=|<|>)\s*'?([^']*)'?", clause)
+			if in_parents:
+				if in_parents.group(1) not in f['parents']:
+					return False
+			elif clause.replace(' ', '') == "trashed=false":
+				continue
+			elif comparison and ('createdTime' == comparison.group(1)):
+				limit = calendar.timegm(time.strptime(comparison.group(3)[:19], "%Y-%m-%dT%H:%M:%S"))
+				if ('<' == comparison.group(2)) and not (f['createdTime'] < limit):
+					return False
+				if ('>' == comparison.group(2)) and not (f['createdTime'] > limit):
+					return False
+			elif comparison and (comparison.group(1) in ('name', 'mimeType')):
+				if (f[comparison.group(1)] == comparison.group(3)) != ('=' == comparison.group(2)):
+					return False
+			else:
+				raise ValueError("fake drive can't handle query clause: {}".format(clause))
+		return True
+
+	def new_id(self):
+		self.next_id += 1
+		return "fake{}".format(self.next_id)
+
+class FakeDriveRequestHandler(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	# httplib2 quietly re-sends a dropped request with a body it has already used up, so don't wait forever for bytes that will never come
+	timeout = 1
+
+	def log_message(self, *args):
+		pass
+
+	@property
+	def state(self) -> FakeDriveState:
+		return self.server.state
+
+	def send_json(self, code, obj):
+		body = json.dumps(obj).encode('utf-8')
+		self.send_response(code)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def send_empty(self, code, headers=None):
+		self.send_response(code)
+		for k, v in (headers or {}).items():
+			self.send_header(k, v)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def read_body(self):
+		return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+	def do_POST(self):
+		url = urlparse(self.path)
+		if url.path.endswith("/batch/drive/v3"):
+			self.do_batch()
+		elif url.path.endswith("/upload/drive/v3/files") and parse_qs(url.query).get('uploadType') == ['resumable']:
+			meta = json.loads(self.read_body() or b'{}')
+			with self.state.lock:
+				session_id = self.state.new_id()
+				self.state.sessions[session_id] = {'meta': meta, 'data': b'', 'total': None}
+				self.state.num_sessions_started += 1
+			self.send_empty(200, {"Location": "http://{}:{}/upload/session/{}".format(*self.server.server_address, session_id)})
+		elif url.path.endswith("/drive/v3/files"):
+			# metadata only (i.e. making a folder)
+			meta = json.loads(self.read_body() or b'{}')
+			self.state.num_create_calls += 1
+			file_id = self.state.add_file(meta.get('name'), meta.get('parents', []), mime_type=meta.get('mimeType', 'application/octet-stream'))
+			self.send_json(200, self.state.metadata(file_id))
+		else:
+			self.send_json(404, {"error": {"code": 404, "message": "not found"}})
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		if url.path.endswith("/drive/v3/files"):
+			self.list_files(parse_qs(url.query))
+			return
+		file_match = re.match(r".*/drive/v3/files/([^/]+)$", url.path)
+		if (file_match is None) or (file_match.group(1) not in self.state.files):
+			self.send_json(404, {"error": {"code": 404, "message": "not found"}})
+		elif parse_qs(url.query).get('alt') == ['media']:
+			self.state.num_downloads += 1
+			data = self.state.files[file_match.group(1)]['data']
+			range_match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get('Range', ''))
+			if range_match:
+				self.state.num_range_downloads += 1
+				start = int(range_match.group(1))
+				end = min(int(range_match.group(2)) + 1 if range_match.group(2) else len(data), len(data))
+				total = len(data)
+				data = data[start:end]
+				self.send_response(206)
+				self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, total))
+			else:
+				self.send_response(200)
+			self.send_header("Content-Type", "application/octet-stream")
+			self.send_header("Content-Length", str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+		else:
+			self.send_json(200, self.state.metadata(file_match.group(1)))
+
+	def list_files(self, params):
+		self.state.num_list_calls += 1
+		query = params.get('q', [''])[0]
+		page_size = int(params.get('pageSize', ['100'])[0])
+		start = int(params.get('pageToken', ['0'])[0])
+		with self.state.lock:
+			matching = sorted(x for x in self.state.files if (not query) or self.state.matches(x, query))
+		page = matching[start:start + page_size]
+		result = {'files': [self.state.metadata(x) for x in page]}
+		if start + page_size < len(matching):
+			result['nextPageToken'] = str(start + page_size)
+		self.send_json(200, result)
+
+	def do_DELETE(self):
+		file_match = re.match(r".*/drive/v3/files/([^/?]+)", urlparse(self.path).path)
+		self.read_body()
+		code = self.delete_file(file_match.group(1) if file_match else None)
+		if 204 == code:
+			self.send_empty(204)
+		else:
+			self.send_json(code, {"error": {"code": code, "message": "not found"}})
+
+	def delete_file(self, file_id):
+		with self.state.lock:
+			if file_id not in self.state.files:
+				return 404
+			del self.state.files[file_id]
+			# drive deletes everything inside a folder along with it
+			orphaned = [x for x, f in self.state.files.items() if file_id in f['parents']]
+		for child_id in orphaned:
+			self.delete_file(child_id)
+		return 204
+
+	def do_batch(self):
+		"""
+		handle a multipart/mixed batch of DELETE requests
+		"""
+
+		self.state.num_batch_calls += 1
+		content_type = self.headers.get('Content-Type')
+		message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode('utf-8') + b"\r\n\r\n" + self.read_body())
+		boundary = "fakebatchboundary"
+		parts = []
+		for part in message.get_payload():
+			request_line = part.get_payload().lstrip().split("\n", 1)[0]
+			method, path = request_line.split(" ")[:2]
+			file_match = re.match(r".*/drive/v3/files/([^/?]+)", path)
+			code = self.delete_file(file_match.group(1)) if ('DELETE' == method) and file_match else 400
+			status_text = "No Content" if 204 == code else "Error"
+			inner = "HTTP/1.1 {} {}\r\nContent-Length: 0\r\n\r\n".format(code, status_text) if 204 == code else 'HTTP/1.1 {} {}\r\nContent-Type: application/json\r\n\r\n{{"error": {{"code": {}, "message": "not found"}}}}'.format(code, status_text, code)
+			content_id = part['Content-ID'].strip('<>')
+			parts.append("--{}\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\n{}\r\n".format(boundary, content_id, inner))
+		body = ("".join(parts) + "--{}--\r\n".format(boundary)).encode('utf-8')
+		self.send_response(200)
+		self.send_header("Content-Type", "multipart/mixed; boundary={}".format(boundary))
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_PUT(self):
+		url = urlparse(self.path)
+		session_id = url.path.rsplit('/', 1)[-1]
+		session = self.state.sessions.get(session_id)
+		if session is None:
+			self.send_json(404, {"error": {"code": 404, "message": "no such upload"}})
+			return
+
+		content_range = self.headers.get('Content-Range', '')
+		status_match = re.match(r"bytes \*/(\d+|\*)", content_range)
+		if status_match:
+			# the client wants to know how much we've got
+			self.read_body()
+			self.state.num_status_queries += 1
+			self.send_progress(session)
+			return
+
+		range_match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", content_range)
+		start = int(range_match.group(1))
+		if self.state.drop_at.get(start, 0) > 0:
+			# throw the chunk away and hang up without answering, like a flaky uplink would
+			self.state.drop_at[start] -= 1
+			self.read_body()
+			self.close_connection = True
+			self.connection.shutdown(2)
+			return
+
+		if self.state.error_at.get(start):
+			code = self.state.error_at[start].pop(0)
+			self.read_body()
+			self.send_json(code, {"error": {"code": code, "message": "chunk refused"}})
+			return
+
+		data = self.read_body()
+		if start <= len(session['data']):
+			session['data'] = session['data'][:start] + data
+		if range_match.group(3) != '*':
+			session['total'] = int(range_match.group(3))
+		self.send_progress(session)
+
+	def send_progress(self, session):
+		if (session['total'] is not None) and (len(session['data']) >= session['total']):
+			file_id = self.state.add_file(session['meta'].get('name'), session['meta'].get('parents', []), session['data'])
+			self.send_json(200, self.state.metadata(file_id))
+		elif 0 == len(session['data']):
+			self.send_empty(308)
+		else:
+			self.send_empty(308, {"Range": "bytes=0-{}".format(len(session['data']) - 1)})
+
+class FakeDrive:
+	"""
+	runs the fake drive on a local port in a background thread
+	"""
+
+	def __init__(self):
+		self.state = FakeDriveState()
+		self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeDriveRequestHandler)
+		self.server.state = self.state
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+	def start(self):
+		self.thread.start()
+		return self
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def build_service(self):
+		"""
+		build a drive service object that talks to this fake instead of google
+		"""
+
+		doc_path = os.path.join(os.path.dirname(googleapiclient.__file__), 'discovery_cache', 'documents', 'drive.v3.json')
+		with open(doc_path) as doc_file:
+			doc = json.load(doc_file)
+		doc['rootUrl'] = "http://{}:{}/".format(*self.server.server_address)
+		doc['baseUrl'] = doc['rootUrl'] + doc['servicePath']
+		return build_from_document(doc, http=build_http())
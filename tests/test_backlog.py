@@ -0,0 +1,106 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from PIL import Image, ImageDraw
+from svlc.backlog import *
+
+def jpeg(square=False):
+	img = Image.new('L', (320,240), 100)
+	if square:
+		ImageDraw.Draw(img).rectangle([100, 80, 200, 160], fill=250)
+	stream = io.BytesIO()
+	img.save(stream, format='JPEG')
+	return stream.getvalue()
+
+class TestBacklogManager(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.frame_dir = os.path.join(self.dir, "images")
+		self.backup_dir = os.path.join(self.dir, "bak")
+		os.mkdir(self.frame_dir)
+		os.mkdir(self.backup_dir)
+		self.free = 10000
+		self.in_flight = set()
+		self.tiers = []
+		self.backlog = BacklogManager(frame_dir=self.frame_dir, batch_dir=self.dir, backup_dir=self.backup_dir, tier_bytes=(1000, 2000, 3000, 4000), tier_free_bytes=(500, 400, 300, 200), release_ratio=0.5, slow_capture_secs=10, in_flight=lambda: self.in_flight, disk_free=lambda: self.free)
+		self.backlog.add_listener(self.tiers.append)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def add_file(self, d, name, num_bytes):
+		path = os.path.join(d, name)
+		with open(path, 'wb') as f:
+			f.write(b'x'*num_bytes)
+		return path
+
+	def test_tiers_step_up_and_only_step_down_once_well_clear(self):
+		self.assertEqual(0, self.backlog.tier_for(999, 10000))
+		self.assertEqual(2, self.backlog.tier_for(2500, 10000))
+		self.assertEqual(3, self.backlog.tier_for(0, 300))
+		self.backlog.tier = 2
+		# under the threshold, but not by enough
+		self.assertEqual(2, self.backlog.tier_for(1500, 10000))
+		self.assertEqual(1, self.backlog.tier_for(900, 10000))
+		self.assertEqual(0, self.backlog.tier_for(400, 10000))
+		self.assertEqual(1, self.backlog.tier_for(400, 900))
+
+	def test_check_counts_everything_unsent(self):
+		self.add_file(self.frame_dir, "host_100d0.jpg", 600)
+		self.add_file(self.frame_dir, "host_101d0.jpg.tmp", 5000)
+		self.add_file(self.dir, "host_102d0_B0.zip.gpg", 600)
+		self.add_file(self.dir, "host_103d0_B0" + SeekableBatchPacker.suffix, 600)
+		self.add_file(self.backup_dir, "host_90d0_B0.zip.gpg", 600)
+		self.assertEqual(2, self.backlog.check())
+		self.assertEqual(2400, self.backlog.stats()['working_bytes'])
+		self.assertListEqual([0, 2], self.tiers)
+		self.assertEqual(10, self.backlog.capture_interval(1))
+		self.assertEqual(20, self.backlog.capture_interval(20))
+		self.assertDictEqual({'slow capture': 1, 'motion only': 1, 'downscale': 0, 'evict': 0}, self.backlog.stats()['tier_entries'])
+
+	def test_check_counts_staged_frames_and_batches(self):
+		from svlc.staging import StagingArea
+		staging = StagingArea(os.path.join(self.dir, "ram"), self.frame_dir, self.dir)
+		self.backlog = BacklogManager(staging, backup_dir=self.backup_dir, tier_bytes=(1000, 2000, 3000, 4000), tier_free_bytes=(500, 400, 300, 200), disk_free=lambda: self.free)
+		self.add_file(self.frame_dir, "host_100d0.jpg", 600)
+		self.add_file(staging.frame_dir_staged, "host_101d0.jpg", 600)
+		self.add_file(staging.batch_dir_staged, "host_102d0_B0.zip.gpg", 600)
+		self.add_file(self.dir, "host_103d0_B0.zip.gpg", 600)
+		self.assertEqual(2, self.backlog.check())
+		self.assertEqual(2400, self.backlog.stats()['working_bytes'])
+
+	def test_evicts_oldest_unsent_first(self):
+		paths = [self.add_file(self.backup_dir, "host_{}d0_B0.zip.gpg".format(100 + i), 500) for i in range(6)]
+		paths += [self.add_file(self.frame_dir, "host_{}d0.jpg".format(200 + i), 500) for i in range(4)]
+		# the oldest is being uploaded right now
+		self.in_flight = {paths[0]}
+		self.assertEqual(4, self.backlog.check())
+		# down to under half the last tier
+		remaining = [x for x in paths if os.path.isfile(x)]
+		self.assertListEqual([paths[0]] + paths[8:], remaining)
+		self.assertEqual(7, self.backlog.stats()['evicted'])
+		self.assertEqual(3500, self.backlog.stats()['bytes_evicted'])
+		# evicting only gets us out of the evict tier -- the rest hold on until uploads drain the backlog
+		self.assertEqual(3, self.backlog.check())
+		self.assertEqual(7, self.backlog.stats()['evicted'])
+		os.remove(paths[0])
+		self.assertEqual(2, self.backlog.check())
+		self.assertListEqual([0, 4, 3, 2], self.tiers)
+
+	def test_filter_drops_still_frames_then_downscales(self):
+		frames = [("host_{}d0.jpg".format(100 + i), jpeg(square=(i >= 3))) for i in range(5)]
+		self.assertListEqual(frames, self.backlog.filter(frames))
+		self.backlog.tier = 2
+		# the first frame and the ones with something in them
+		self.assertListEqual([frames[0][0], frames[3][0], frames[4][0]], [x[0] for x in self.backlog.filter(frames)])
+		self.assertEqual(2, self.backlog.stats()['motion_dropped'])
+		self.backlog.tier = 3
+		path = os.path.join(self.frame_dir, "host_300d0.jpg")
+		with open(path, 'wb') as f:
+			f.write(jpeg(square=True))
+		kept = self.backlog.filter([path])
+		self.assertListEqual([path], kept)
+		self.assertTupleEqual((160, 120), Image.open(path).size)
+		self.assertEqual(1, self.backlog.stats()['downscaled'])
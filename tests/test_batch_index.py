@@ -0,0 +1,66 @@
+import os
+import tempfile
+from unittest import TestCase
+from svlc.batch_index import *
+
+class TestBatchIndex(TestCase):
+	def setUp(self):
+		self.index = BatchIndex(":memory:")
+		self.index.add("id0", "svbase0_100_B0.zip.gpg", "svbase0", 40, 100, 10, "abc", 60)
+		self.index.add("id1", "svbase0_200_B0.zip.gpg", "svbase0", 140, 200, 10, "def", 60)
+		self.index.add("id2", "svbase1_200_B0.zip.gpg", "svbase1", 140, 200, 10, "ghi", 60)
+
+	def test_expired(self):
+		self.assertListEqual([{'id': "id0", 'name': "svbase0_100_B0.zip.gpg", 'parent_id': None}], self.index.expired(150))
+
+	def test_in_range(self):
+		self.assertListEqual(["id0", "id1"], [x['file_id'] for x in self.index.in_range("svbase0", 90, 150)])
+		self.assertListEqual(["id1"], [x['file_id'] for x in self.index.in_range("svbase0", 101, 139)] + [x['file_id'] for x in self.index.in_range("svbase0", 150, 500)])
+
+	def test_remove(self):
+		self.index.remove(["id0", "id2"])
+		self.assertEqual(1, self.index.count())
+
+	def test_remove_in_folders(self):
+		self.index.add("id3", "svbase0_300_B0.zip.gpg", "svbase0", 240, 300, parent_id="dir0")
+		self.index.add("id4", "svbase0_310_B0.zip.gpg", "svbase0", 240, 310, parent_id="dir0")
+		self.index.add("id5", "svbase0_3700_B0.zip.gpg", "svbase0", 3640, 3700, parent_id="dir1")
+		self.index.remove_in_folders(["dir0"])
+		self.assertListEqual(["id0", "id1", "id5"], [x['file_id'] for x in self.index.in_range("svbase0", 0, 5000)])
+
+	def test_reconcile_keeps_files_indexed_since_the_listing(self):
+		listed_at = time()
+		self.index.add("id3", "svbase0_300_B1.zip.gpg", "svbase0", 240, 300, 10, "jkl", 60)
+		with self.index.conn:
+			self.index.conn.execute("UPDATE batches SET uploaded_at = ? WHERE file_id != 'id3'", (listed_at - 1,))
+		# (id3 was uploaded after the listing started, so it's not in it)
+		self.assertTupleEqual((0, 2), self.index.reconcile([{'id': "id1", 'name': "svbase0_200_B0.zip.gpg"}], listed_at))
+		self.assertListEqual(["id1", "id3"], [x['file_id'] for x in self.index.in_range("svbase0", 0, 1000)])
+
+	def test_reconcile_leaves_rows_indexed_meanwhile_alone(self):
+		self.assertFalse(self.index.add("id1", "svbase0_200_B0.zip.gpg", "svbase0", 200, 200, replace=False))
+		self.assertEqual(60, self.index.in_range("svbase0", 150, 150)[0]['num_frames'])
+
+	def test_adds_parent_column_to_old_index(self):
+		path = os.path.join(tempfile.mkdtemp(), "old_index.sqlite3")
+		conn = sqlite3.connect(path)
+		with conn:
+			conn.execute("CREATE TABLE batches (file_id TEXT PRIMARY KEY, name TEXT NOT NULL, host TEXT, start_time REAL, end_time REAL, size INTEGER, md5 TEXT, num_frames INTEGER, uploaded_at REAL)")
+			conn.execute("INSERT INTO batches VALUES ('id0', 'svbase0_100_B0.zip.gpg', 'svbase0', 40, 100, 10, 'abc', 60, 100)")
+		conn.close()
+		index = BatchIndex(path)
+		index.add("id1", "svbase0_200_B0.zip.gpg", "svbase0", 140, 200, parent_id="dir0")
+		self.assertListEqual([None, "dir0"], [x['parent_id'] for x in index.expired(1000)])
+		index.conn.close()
+		os.remove(path)
+		os.rmdir(os.path.dirname(path))
+
+	def test_reconcile(self):
+		remote = [
+			{'id': "id1", 'name': "svbase0_200_B0.zip.gpg"},
+			{'id': "id3", 'name': "svbase0_300_B1.zip.gpg", 'size': "10", 'parents': ["dir0"]},
+			{'id': "id4", 'name': "notes.txt"},
+		]
+		self.assertTupleEqual((1, 2), self.index.reconcile(remote))
+		self.assertListEqual(["id1", "id3"], [x['file_id'] for x in self.index.in_range("svbase0", 0, 1000)])
+		self.assertEqual("dir0", self.index.in_range("svbase0", 250, 1000)[0]['parent_id'])
@@ -0,0 +1,282 @@
+import os
+import tempfile
+import zipfile
+from unittest import TestCase
+from svlc.file_handler import *
+
+class FakeEncryptor:
+	"""
+	"encrypts" by copying the archive as is
+	"""
+
+	def encrypt_stream(self, stream, enc_filename, compress=False):
+		data = stream.read()
+		with open(enc_filename, 'wb') as f:
+			f.write(data)
+		return md5(data).hexdigest()
+
+	def encrypt_file(self, filename, enc_filename, compress=False):
+		with open(filename, 'rb') as f:
+			return self.encrypt_stream(f, enc_filename, compress=compress)
+
+	def encrypt_to_bytes(self, stream, compress=False):
+		return stream.read()
+
+	def decrypt_stream(self, stream):
+		return stream.read()
+
+class TestBatchPacker(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		fd, self.disk_frame = tempfile.mkstemp(dir=self.dir, suffix=".jpg")
+		os.write(fd, b'on disk')
+		os.close(fd)
+
+	def tearDown(self):
+		for x in os.listdir(self.dir):
+			os.remove(os.path.join(self.dir, x))
+		os.rmdir(self.dir)
+
+	def test_packs_in_memory_and_disk_frames(self):
+		packer = BatchPacker(os.path.join(self.dir, "host_10d5_B0.zip"), MAX_FILE_SIZE_PER_UPLOAD, ENC_OVERHEAD_RATIO, FakeEncryptor(), streaming=True)
+		packer.add(("host_10d5.jpg", b'in memory'))
+		packer.add(("host_12d0.jpg", b'also in memory'))
+		packer.add(self.disk_frame)
+		stats = packer.seal()
+
+		self.assertEqual(3, stats['num_files'])
+		self.assertEqual(10.5, stats['start_time'])
+		self.assertEqual(12.0, stats['end_time'])
+		self.assertEqual(len(b'in memory') + len(b'also in memory') + len(b'on disk'), stats['raw_bytes'])
+		# only the disk frame needs cleaning up afterwards
+		self.assertListEqual([self.disk_frame], packer.files_on_disk)
+		with zipfile.ZipFile(stats['batch']) as zf:
+			self.assertEqual(b'in memory', zf.read("host_10d5.jpg"))
+			self.assertEqual(b'on disk', zf.read(self.disk_frame.lstrip('/')))
+
+	def test_overflow_accounts_for_in_memory_frames(self):
+		packer = BatchPacker(os.path.join(self.dir, "host_10d5_B0.zip"), 2000, 0, FakeEncryptor(), streaming=True)
+		self.assertFalse(packer.would_overflow(("host_10d5.jpg", b'x'*100)))
+		self.assertTrue(packer.would_overflow(("host_10d5.jpg", b'x'*1000)))
+		packer.discard()
+
+	def test_codec_chosen_per_member(self):
+		packer = BatchPacker(os.path.join(self.dir, "host_10d5_B0.zip"), MAX_FILE_SIZE_PER_UPLOAD, ENC_OVERHEAD_RATIO, FakeEncryptor(), streaming=True)
+		packer.add(("host_10d5.jpg", b'\xff\xd8\xff' + os.urandom(5000)))
+		packer.add(("host_10d5.log", b'2024-01-01 12:00:00: all quiet\n'*200))
+		stats = packer.seal()
+		self.assertDictEqual({'stored': 1, 'deflate': 1}, stats['codecs'])
+		self.assertLess(stats['compress_ratio'], 1)
+		with zipfile.ZipFile(stats['batch']) as zf:
+			self.assertEqual(zipfile.ZIP_STORED, zf.getinfo("host_10d5.jpg").compress_type)
+			self.assertEqual(zipfile.ZIP_DEFLATED, zf.getinfo("host_10d5.log").compress_type)
+
+	def test_big_batches_spool_out_of_memory(self):
+		frames = [("host_{}d0.jpg".format(i), os.urandom(3000)) for i in range(3)]
+		for spool_bytes in (100000, 1000):
+			packer = BatchPacker(os.path.join(self.dir, "host_10d5_B0.zip"), MAX_FILE_SIZE_PER_UPLOAD, ENC_OVERHEAD_RATIO, FakeEncryptor(), spool_bytes=spool_bytes)
+			for frame in frames:
+				packer.add(frame)
+			stats = packer.seal()
+			with zipfile.ZipFile(stats['batch']) as zf:
+				self.assertListEqual(frames, [(x, zf.read(x)) for x in zf.namelist()])
+			# the spooled archive counts as written, the in-memory one doesn't
+			self.assertEqual(stats['enc_bytes'] + (0 if spool_bytes > stats['zip_bytes'] else stats['zip_bytes']), stats['bytes_written'])
+			os.remove(stats['batch'])
+
+	def test_failed_encryption_leaves_nothing_behind(self):
+		encryptor = FakeEncryptor()
+		encryptor.encrypt_stream = lambda stream, enc_filename, compress=False: None
+		for streaming in (True, False):
+			packer = BatchPacker(os.path.join(self.dir, "host_10d5_B0.zip"), MAX_FILE_SIZE_PER_UPLOAD, ENC_OVERHEAD_RATIO, encryptor, streaming=streaming)
+			packer.add(self.disk_frame)
+			with self.assertRaises(RuntimeError):
+				packer.seal()
+			# (the frame stays where it was for next time)
+			self.assertListEqual([os.path.basename(self.disk_frame)], os.listdir(self.dir))
+
+class TestSeekableBatch(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.frames = [("host_{}d0.jpg".format(i), bytes([i])*1000) for i in range(10)]
+
+	def tearDown(self):
+		for x in os.listdir(self.dir):
+			os.remove(os.path.join(self.dir, x))
+		os.rmdir(self.dir)
+
+	def pack(self, frames, streaming=True):
+		packer = SeekableBatchPacker(os.path.join(self.dir, "host_20d0_B0.svb"), MAX_FILE_SIZE_PER_UPLOAD, ENC_OVERHEAD_RATIO, FakeEncryptor(), streaming=streaming)
+		for frame in frames:
+			packer.add(frame)
+		return packer.seal()
+
+	def test_stats_and_index(self):
+		stats = self.pack(self.frames)
+		self.assertEqual(10, stats['num_files'])
+		self.assertEqual(0.0, stats['start_time'])
+		self.assertEqual(9.0, stats['end_time'])
+		with open(stats['batch'], 'rb') as f:
+			self.assertEqual(stats['md5'], md5(f.read()).hexdigest())
+		reader = SeekableBatchReader(local_range_reader(stats['batch']), FakeEncryptor())
+		self.assertListEqual([x[0] for x in self.frames], [x['name'] for x in reader.index()])
+
+	def test_on_disk_build_matches_streaming(self):
+		streamed = self.pack(self.frames)
+		with open(streamed['batch'], 'rb') as f:
+			streamed_bytes = f.read()
+		self.assertEqual(streamed_bytes, open(self.pack(self.frames, streaming=False)['batch'], 'rb').read())
+		self.assertListEqual(["host_20d0_B0.svb"], os.listdir(self.dir))
+
+	def test_reads_only_frames_in_range(self):
+		stats = self.pack(self.frames)
+		reader = SeekableBatchReader(local_range_reader(stats['batch']), FakeEncryptor(), prefetch_bytes=16)
+		self.assertListEqual(self.frames[3:6], list(reader.read_frames(reader.frames_in_range(3, 5))))
+		# header, rest of the index, then the three back to back frames in one go
+		self.assertEqual(3, reader.num_reads)
+		self.assertLess(reader.bytes_read, 4000 + (SEEKABLE_HEADER.size + os.path.getsize(stats['batch']) - 10000))
+
+	def test_size_stays_under_projection(self):
+		packer = SeekableBatchPacker(os.path.join(self.dir, "host_20d0_B0.svb"), 10000, 0, FakeEncryptor())
+		while not packer.would_overflow(self.frames[len(packer.files)]):
+			packer.add(self.frames[len(packer.files)])
+		self.assertEqual(7, len(packer.files))
+		self.assertLessEqual(packer.seal()['enc_bytes'], 10000)
+
+	def test_plan_batches(self):
+		# planning goes off the worst case for every frame, so it's more conservative than the packer
+		batches = plan_batches(self.frames, 10000, 0, 'seekable')
+		self.assertListEqual([4, 4, 2], [len(x) for x in batches])
+		self.assertListEqual(self.frames, [x for batch in batches for x in batch])
+
+	def test_not_a_seekable_batch(self):
+		path = os.path.join(self.dir, "host_20d0_B0.zip.gpg")
+		with open(path, 'wb') as f:
+			f.write(b'PK\x03\x04' + b'\x00'*100)
+		with self.assertRaises(ValueError):
+			SeekableBatchReader(local_range_reader(path), FakeEncryptor()).index()
+
+class TestEncryptor(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.passphrase_loc = os.path.join(self.dir, "enc_pw.txt")
+		with open(self.passphrase_loc, 'w') as f:
+			f.write("test passphrase\n")
+
+	def tearDown(self):
+		for x in os.listdir(self.dir):
+			os.remove(os.path.join(self.dir, x))
+		os.rmdir(self.dir)
+
+	def test_round_trip_in_chunks(self):
+		encryptor = Encryptor(self.passphrase_loc, engine='aead', chunk_bytes=1000)
+		enc_filename = os.path.join(self.dir, "batch.gpg")
+		for data, compress in ((os.urandom(3500), False), (b"log line\n"*1000, True), (b"", False), (os.urandom(2000), False)):
+			checksum = encryptor.encrypt_stream(io.BytesIO(data), enc_filename, compress=compress)
+			self.assertEqual(file_md5(enc_filename), checksum)
+			with open(enc_filename, 'rb') as f:
+				self.assertEqual(data, encryptor.decrypt_stream(f))
+		# (the compressible one came out smaller than it went in)
+		self.assertLess(len(encryptor.encrypt_to_bytes(io.BytesIO(b"log line\n"*1000), compress=True)), 9000)
+		self.assertEqual(5, encryptor.num_encrypted)
+		# gpg never needed starting
+		self.assertIsNone(encryptor.gpg)
+
+	def test_tampering_is_caught(self):
+		encryptor = Encryptor(self.passphrase_loc, engine='aead', chunk_bytes=1000)
+		data = encryptor.encrypt_to_bytes(io.BytesIO(os.urandom(2500)))
+		flipped = bytearray(data)
+		flipped[-1] ^= 1
+		chunk_bytes = 1000 + AEAD_TAG_BYTES
+		for bad in (bytes(flipped), data[:AEAD_HEADER.size + chunk_bytes], data[:AEAD_HEADER.size] + data[AEAD_HEADER.size + chunk_bytes:]):
+			self.assertIsNone(encryptor.decrypt_stream(io.BytesIO(bad)))
+
+	def test_decrypts_what_gpg_made(self):
+		data = os.urandom(5000)
+		enc_data = Encryptor(self.passphrase_loc, engine='gpg').encrypt_to_bytes(io.BytesIO(data))
+		encryptor = Encryptor(self.passphrase_loc, engine='aead')
+		self.assertIsNone(encryptor.gpg)
+		self.assertEqual(data, encryptor.decrypt_stream(io.BytesIO(enc_data)))
+		self.assertIsNotNone(encryptor.gpg)
+
+	def test_wrong_passphrase(self):
+		enc_data = Encryptor(self.passphrase_loc, engine='aead').encrypt_to_bytes(io.BytesIO(b"frame"))
+		with open(self.passphrase_loc, 'w') as f:
+			f.write("another passphrase\n")
+		self.assertIsNone(Encryptor(self.passphrase_loc, engine='aead').decrypt_stream(io.BytesIO(enc_data)))
+
+class TestChooseCodec(TestCase):
+	def test_already_compressed_is_stored(self):
+		self.assertEqual(zipfile.ZIP_STORED, choose_codec(b'\xff\xd8\xff\xe0' + b'\x00'*4000))
+		self.assertEqual(zipfile.ZIP_STORED, choose_codec(os.urandom(4096)))
+		self.assertEqual(zipfile.ZIP_STORED, choose_codec(b''))
+
+	def test_compressible_uses_configured_codec(self):
+		sample = b'some very repetitive log line\n'*100
+		self.assertEqual(zipfile.ZIP_DEFLATED, choose_codec(sample))
+		self.assertEqual(zipfile.ZIP_LZMA, choose_codec(sample, codec='lzma'))
+		# falls back rather than failing
+		self.assertEqual(zipfile.ZIP_DEFLATED, choose_codec(sample, codec='nonsense'))
+
+class TestPlanBatches(TestCase):
+	def test_batches_stay_under_limit_and_keep_order(self):
+		frames = [("host_{}d0.jpg".format(i), b'x'*5000) for i in range(10)]
+		batches = plan_batches(frames, 20000, ENC_OVERHEAD_RATIO)
+		self.assertListEqual(frames, [x for batch in batches for x in batch])
+		for batch in batches:
+			self.assertLessEqual(sum(max_zip_member_bytes(x) for x in batch)*(1 + ENC_OVERHEAD_RATIO) + ENC_OVERHEAD_BYTES, 20000)
+		self.assertEqual(4, len(batches))
+
+	def test_oversized_frame_gets_its_own_batch(self):
+		frames = [("host_0d0.jpg", b'x'*100), ("host_1d0.jpg", b'x'*50000), ("host_2d0.jpg", b'x'*100)]
+		self.assertListEqual([[frames[0]], [frames[1]], [frames[2]]], plan_batches(frames, 20000, 0))
+
+class TestParallelPackaging(TestCase):
+	def setUp(self):
+		self.addCleanup(os.chdir, os.getcwd())
+		self.dir = tempfile.mkdtemp()
+		os.chdir(self.dir)
+		with open(ENC_PASSPHRASE_LOC, 'w') as f:
+			f.write("test passphrase\n")
+		self.frames = [("host_{}d0.jpg".format(i), os.urandom(5000)) for i in range(10)]
+
+	def tearDown(self):
+		for x in os.listdir(self.dir):
+			os.remove(os.path.join(self.dir, x))
+		os.rmdir(self.dir)
+
+	def test_parallel_batches_are_named_in_order_and_complete(self):
+		file_handler = FileHandler(num_workers=2)
+		self.addCleanup(file_handler.shutdown)
+		file_handler.max_batch_bytes = 20000
+		batches = file_handler.compress_and_encrypt_batch(self.frames)
+		self.assertIsNotNone(file_handler.executor)
+
+		self.assertEqual(4, len(batches))
+		base_name = batches[0][:-len("_B0.zip.gpg")]
+		self.assertListEqual([base_name + "_B{}.zip.gpg".format(i) for i in range(4)], batches)
+		packed = []
+		for batch in batches:
+			self.assertIn(batch, file_handler.batch_info)
+			with open(batch, 'rb') as f:
+				with zipfile.ZipFile(io.BytesIO(file_handler.encryptor.decrypt_stream(f))) as zf:
+					packed += [(x, zf.read(x)) for x in zf.namelist()]
+		self.assertListEqual(self.frames, packed)
+
+	def test_seekable_batches_are_encrypted_in_process(self):
+		file_handler = FileHandler(num_workers=1)
+		file_handler.batch_format = 'seekable'
+		batches = file_handler.compress_and_encrypt_batch(self.frames)
+		self.assertEqual(1, len(batches))
+		self.assertTrue(batches[0].endswith(SeekableBatchPacker.suffix))
+		# every frame and the index, all without a gpg process
+		self.assertEqual(len(self.frames) + 1, file_handler.encryptor.num_encrypted)
+		reader = SeekableBatchReader(local_range_reader(batches[0]), file_handler.encryptor)
+		self.assertListEqual(self.frames, list(reader.read_frames(reader.index())))
+
+		# ...and never one gpg process per frame
+		file_handler.encryptor = Encryptor(engine='gpg')
+		batches = file_handler.compress_and_encrypt_batch(self.frames)
+		self.assertEqual('zip', file_handler.batch_format)
+		self.assertTrue(batches[0].endswith(".zip.gpg"))
+		self.assertEqual(1, file_handler.encryptor.num_encrypted)
@@ -0,0 +1,320 @@
+import os
+import tempfile
+from unittest import TestCase
+from svlc.gdrive_handler import *
+from svlc.tests.fake_drive import FakeDrive
+
+CHUNK = 256*1024
+
+class TestResumableUpload(TestCase):
+	def setUp(self):
+		self.drive = FakeDrive().start()
+		self.handler = GDriveHandler(service=self.drive.build_service(), chunk_size=CHUNK)
+		self.handler.working_dir_id = "workdir"
+		self.handler.upload_retry_base_secs = 0
+		fd, self.path = tempfile.mkstemp(suffix=".zip.gpg")
+		self.data = os.urandom(3*CHUNK + 1000)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(self.data)
+
+	def tearDown(self):
+		self.drive.stop()
+		os.remove(self.path)
+
+	def test_upload_in_chunks(self):
+		file_id = self.handler.upload_file(self.path)
+		self.assertEqual(self.data, self.drive.state.files[file_id]['data'])
+		self.assertListEqual(["workdir"], self.drive.state.files[file_id]['parents'])
+
+	def test_resume_after_dropped_connection(self):
+		# drop more times than httplib2 will quietly retry on its own
+		self.drive.state.drop_at[2*CHUNK] = 3
+		file_id = self.handler.upload_file(self.path)
+		self.assertEqual(self.data, self.drive.state.files[file_id]['data'])
+		# resumed the same upload rather than starting a new one
+		self.assertEqual(1, self.drive.state.num_sessions_started)
+		self.assertGreater(self.drive.state.num_status_queries, 0)
+
+	def test_give_up_after_max_retries(self):
+		self.drive.state.drop_at[CHUNK] = 100
+		self.handler.max_upload_retries = 2
+		self.assertEqual("", self.handler.upload_file(self.path))
+		self.assertDictEqual({}, self.drive.state.files)
+
+	def test_retries_timeouts_and_rate_limits(self):
+		self.drive.state.error_at[CHUNK] = [429, 408, 503]
+		file_id = self.handler.upload_file(self.path)
+		self.assertEqual(self.data, self.drive.state.files[file_id]['data'])
+		self.assertEqual(1, self.drive.state.num_sessions_started)
+
+	def test_other_client_errors_are_not_retried(self):
+		self.drive.state.error_at[CHUNK] = [403, 403]
+		self.assertEqual("", self.handler.upload_file(self.path))
+		# gave up on the first one
+		self.assertListEqual([403], self.drive.state.error_at[CHUNK])
+
+class TestVerifyUpload(TestCase):
+	def setUp(self):
+		self.drive = FakeDrive().start()
+		self.handler = GDriveHandler(service=self.drive.build_service(), chunk_size=CHUNK)
+		self.handler.working_dir_id = "workdir"
+		fd, self.path = tempfile.mkstemp(suffix=".zip.gpg")
+		self.data = os.urandom(CHUNK + 1000)
+		with os.fdopen(fd, 'wb') as f:
+			f.write(self.data)
+		self.file_id = self.handler.upload_file(self.path)
+
+	def tearDown(self):
+		self.drive.stop()
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+	def test_checksum_match(self):
+		self.handler.verify_audit_every_n = 0
+		self.assertTrue(self.handler.verify_upload(self.path, self.file_id, file_md5(self.path)))
+		self.assertFalse(os.path.exists(self.path))
+		self.assertEqual(0, self.drive.state.num_downloads)
+
+	def test_checksum_mismatch(self):
+		self.handler.verify_audit_every_n = 0
+		self.assertFalse(self.handler.verify_upload(self.path, self.file_id, "0"*32))
+		self.assertTrue(os.path.exists(self.path))
+
+	def test_checksum_fetched_when_not_held(self):
+		self.handler.verify_audit_every_n = 0
+		self.handler.uploaded_checksums.clear()
+		self.assertTrue(self.handler.verify_upload(self.path, self.file_id))
+
+	def test_audit_downloads(self):
+		self.handler.verify_audit_every_n = 1
+		self.drive.state.files[self.file_id]['data'] = b'corrupted'
+		self.assertFalse(self.handler.verify_upload(self.path, self.file_id, file_md5(self.path)))
+		self.assertEqual(1, self.drive.state.num_downloads)
+		self.assertFalse(os.path.exists(self.path + "_TMP_VER.raw"))
+
+class TestPurgeOlds(TestCase):
+	def setUp(self):
+		self.drive = FakeDrive().start()
+		self.handler = GDriveHandler(service=self.drive.build_service())
+		self.handler.list_page_size = 50
+		self.dir_id = self.drive.state.add_file(ACTIVE_GDRIVE_DIR_NAME, [], mime_type=GDRIVE_FOLDER_MIME_TYPE)
+		now = time()
+		self.old_ids = [self.add_batch(now - MAX_AGE_BEFORE_PURGE - 3600 - i) for i in range(230)]
+		self.new_ids = [self.add_batch(now - i) for i in range(20)]
+
+	def tearDown(self):
+		self.drive.stop()
+
+	def add_batch(self, timestamp):
+		name = "svbase0_{}_B0.zip.gpg".format(float_to_filename_compatible_str(timestamp))
+		return self.drive.state.add_file(name, [self.dir_id], created_time=timestamp)
+
+	def test_finds_working_dir(self):
+		self.drive.state.add_file(ACTIVE_GDRIVE_DIR_NAME + "_old", [], mime_type=GDRIVE_FOLDER_MIME_TYPE)
+		self.assertEqual(self.dir_id, self.handler.get_working_dir_id())
+
+	def test_lists_every_page(self):
+		self.assertEqual(250, len(self.handler.find_existing_files()))
+
+	def test_purge_deletes_only_expired(self):
+		self.handler.purge_olds()
+		remaining = set(self.drive.state.files)
+		self.assertTrue(set(self.new_ids) <= remaining)
+		self.assertFalse(set(self.old_ids) & remaining)
+		# 230 expired files at 50 per page and 100 per batch
+		self.assertEqual(1 + 5, self.drive.state.num_list_calls)
+		self.assertEqual(3, self.drive.state.num_batch_calls)
+
+	def test_purge_leaves_foreign_files(self):
+		foreign_id = self.drive.state.add_file("notes.txt", [self.dir_id], created_time=0)
+		self.handler.purge_olds()
+		self.assertIn(foreign_id, self.drive.state.files)
+
+class TestPurgeWithIndex(TestCase):
+	def setUp(self):
+		self.drive = FakeDrive().start()
+		self.index = BatchIndex(":memory:")
+		self.handler = GDriveHandler(service=self.drive.build_service(), index=self.index)
+		self.dir_id = self.drive.state.add_file(ACTIVE_GDRIVE_DIR_NAME, [], mime_type=GDRIVE_FOLDER_MIME_TYPE)
+		self.handler.working_dir_id = self.dir_id
+		self.now = time()
+
+	def tearDown(self):
+		self.drive.stop()
+
+	def upload_batch(self, start_time, end_time):
+		path = "svbase0_{}_B0.zip.gpg".format(float_to_filename_compatible_str(end_time))
+		with open(path, 'wb') as f:
+			f.write(b'batch')
+		file_id = self.handler.upload_file(path, {'start_time': start_time, 'end_time': end_time, 'num_files': 3})
+		os.remove(path)
+		return file_id
+
+	def test_upload_indexes_and_purge_skips_listing(self):
+		old_id = self.upload_batch(self.now - MAX_AGE_BEFORE_PURGE - 100, self.now - MAX_AGE_BEFORE_PURGE - 50)
+		new_id = self.upload_batch(self.now - 100, self.now - 50)
+		self.assertEqual(2, self.index.count())
+		self.handler.purge_olds()
+		self.assertNotIn(old_id, self.drive.state.files)
+		self.assertIn(new_id, self.drive.state.files)
+		self.assertEqual(1, self.index.count())
+		self.assertEqual(0, self.drive.state.num_list_calls)
+
+	def test_reconcile(self):
+		known_id = self.upload_batch(self.now - 100, self.now - 50)
+		unknown_id = self.drive.state.add_file("svbase0_{}_B0.zip.gpg".format(float_to_filename_compatible_str(self.now)), [self.dir_id])
+		del self.drive.state.files[known_id]
+		self.handler.reconcile_index()
+		self.assertListEqual([unknown_id], [x['file_id'] for x in self.index.in_range("svbase0", 0, self.now + 1)])
+
+class TestDiscoveryDoc(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.cache_loc = os.path.join(self.dir, "discovery.json")
+		self.forget_doc()
+
+	def tearDown(self):
+		self.forget_doc()
+		for x in os.listdir(self.dir):
+			os.remove(os.path.join(self.dir, x))
+		os.rmdir(self.dir)
+
+	def forget_doc(self):
+		load_discovery_doc.__globals__['_discovery_doc'] = None
+
+	def test_cached_and_reused(self):
+		doc = load_discovery_doc(self.cache_loc)
+		self.assertIn('"drive"', doc)
+		with open(self.cache_loc) as f:
+			self.assertEqual(doc, f.read())
+		# a later start reads it back from the cache
+		self.forget_doc()
+		with open(self.cache_loc, 'w') as f:
+			f.write('{"name": "drive", "cached": true}')
+		self.assertEqual('{"name": "drive", "cached": true}', load_discovery_doc(self.cache_loc))
+
+	def test_service_builds_from_cached_doc(self):
+		import httplib2
+		service = build_from_document(load_discovery_doc(self.cache_loc), http=httplib2.Http())
+		self.assertTrue(hasattr(service, 'files'))
+
+class TestPartitionedLayout(TestCase):
+	def setUp(self):
+		self.drive = FakeDrive().start()
+		self.dir_id = self.drive.state.add_file(ACTIVE_GDRIVE_DIR_NAME, [], mime_type=GDRIVE_FOLDER_MIME_TYPE)
+		self.handler = self.new_handler()
+		# start of the hour a bit over a day ago
+		self.base = (int(time()) // 3600)*3600 - MAX_AGE_BEFORE_PURGE - 5*3600
+
+	def tearDown(self):
+		self.drive.stop()
+
+	def new_handler(self, index=None):
+		handler = GDriveHandler(service=self.drive.build_service(), index=index, layout='hour')
+		handler.working_dir_id = self.dir_id
+		return handler
+
+	def batch_name(self, timestamp, host="svbase0"):
+		return "{}_{}_B0.zip.gpg".format(host, float_to_filename_compatible_str(timestamp))
+
+	def add_batches(self, hours, per_hour, index=None, host="svbase0"):
+		"""
+		put <per hour> batches in each of the given hours (after base) straight into the fake drive, in the folders the handler would upload them to
+
+		returns: {hour: [file IDs]}
+		"""
+
+		ids = {}
+		for hour in hours:
+			for i in range(per_hour):
+				name = self.batch_name(self.base + 3600*hour + 60*i, host)
+				parent_id = self.handler.get_upload_dir_id(name)
+				file_id = self.drive.state.add_file(name, [parent_id])
+				ids.setdefault(hour, []).append(file_id)
+				if index is not None:
+					index.add(file_id, name, host, self.base + 3600*hour, self.base + 3600*hour + 60*i, parent_id=parent_id)
+		return ids
+
+	def test_folder_paths(self):
+		self.assertTupleEqual(("svbase0", "1970-01-02T01"), remote_folder_path(self.batch_name(90000.5), 'hour'))
+		self.assertTupleEqual(("svbase0", "1970-01-02"), remote_folder_path(self.batch_name(90000.5), 'day'))
+		self.assertIsNone(remote_folder_path(self.batch_name(90000.5), 'flat'))
+		# logs stay in the working dir
+		self.assertIsNone(remote_folder_path("svbase0_STARTAT_90000d5_0.log.gpg", 'hour'))
+		self.assertTupleEqual((86400, 90000), period_bounds("1970-01-02T00"))
+		self.assertTupleEqual((86400, 172800), period_bounds("1970-01-02"))
+		self.assertIsNone(period_bounds("svbase0"))
+
+	def test_upload_makes_folders_lazily(self):
+		path = self.batch_name(self.base + 10)
+		with open(path, 'wb') as f:
+			f.write(b'batch')
+		try:
+			file_id = self.handler.upload_file(path)
+			self.assertNotEqual("", file_id)
+			# a second upload into the same hour, from another handler, makes no new folders
+			self.assertNotEqual("", self.new_handler().upload_file(path))
+		finally:
+			os.remove(path)
+		self.assertEqual(2, self.drive.state.num_create_calls)
+		period_dir = self.drive.state.files[self.drive.state.files[file_id]['parents'][0]]
+		host_dir = self.drive.state.files[period_dir['parents'][0]]
+		self.assertEqual(strftime("%Y-%m-%dT%H", gmtime(self.base)), period_dir['name'])
+		self.assertEqual("svbase0", host_dir['name'])
+		self.assertListEqual([self.dir_id], host_dir['parents'])
+
+	def test_purge_deletes_whole_folders(self):
+		ids = self.add_batches(range(10), 50)
+		self.add_batches(range(3), 10, host="svbase1")
+		self.drive.state.num_list_calls = 0
+		self.handler.purge_olds()
+		remaining = set(self.drive.state.files)
+		# hours 0-4 are wholly past the max age. hour 5 is only partly, so it stays for now
+		for hour in range(10):
+			self.assertEqual(hour >= 5, set(ids[hour]) <= remaining)
+		# host folders, each host's period folders and the working dir's own files -- however many batches there are
+		self.assertEqual(1 + 2 + 1, self.drive.state.num_list_calls)
+		self.assertEqual(1, self.drive.state.num_batch_calls)
+		# deleted folders get made again if something turns up for them
+		self.assertNotIn(self.handler.get_upload_dir_id(self.batch_name(self.base)), remaining)
+
+	def test_purge_with_index(self):
+		index = BatchIndex(":memory:")
+		self.handler = self.new_handler(index)
+		ids = self.add_batches(range(10), 20, index)
+		self.drive.state.num_list_calls = 0
+		self.handler.purge_olds()
+		remaining = set(self.drive.state.files)
+		for hour in range(10):
+			self.assertEqual(hour >= 5, set(ids[hour]) <= remaining)
+		self.assertEqual(0, self.drive.state.num_list_calls)
+		self.assertEqual(1, self.drive.state.num_batch_calls)
+		self.assertEqual(5*20, index.count())
+
+	def test_purge_with_index_after_restart(self):
+		index = BatchIndex(":memory:")
+		ids = self.add_batches(range(10), 2, index)
+		self.drive.state.num_list_calls = 0
+		# a fresh handler only has the folder IDs from the index, so it looks up their names (but never lists anything)
+		self.new_handler(index).purge_olds()
+		remaining = set(self.drive.state.files)
+		for hour in range(10):
+			self.assertEqual(hour >= 5, set(ids[hour]) <= remaining)
+		self.assertEqual(0, self.drive.state.num_list_calls)
+
+	def test_find_batches_lists_only_overlapping_folders(self):
+		ids = self.add_batches(range(10), 5)
+		self.drive.state.num_list_calls = 0
+		# (batches are packed every minute, so nothing packed over 200 s after the range ends has any of its frames)
+		found = self.handler.find_batches("svbase0", self.base + 7*3600 + 30, self.base + 8*3600 - 700, slack=900)
+		self.assertListEqual(ids[7][1:] + ids[8][:4], [x['id'] for x in found])
+		# the working dir, the host's period folders, then hours 7-8
+		self.assertEqual(1 + 1 + 2, self.drive.state.num_list_calls)
+
+	def test_reconcile_walks_folders(self):
+		index = BatchIndex(":memory:")
+		self.handler = self.new_handler(index)
+		ids = self.add_batches(range(3), 2)
+		self.handler.reconcile_index()
+		self.assertEqual(6, index.count())
+		self.assertEqual(self.drive.state.files[ids[2][0]]['parents'][0], index.in_range("svbase0", self.base + 2*3600, self.base + 2*3600)[0]['parent_id'])
@@ -0,0 +1,126 @@
+import os
+import tempfile
+from unittest import TestCase
+from svlc.log_shipper import *
+
+class FakeEncryptor:
+	"""
+	"encrypts" by copying as is
+	"""
+
+	def encrypt_stream(self, stream, enc_filename, compress=False):
+		data = stream.read()
+		with open(enc_filename, 'wb') as f:
+			f.write(data)
+		return md5(data).hexdigest()
+
+class FakeDriveHandler:
+	def __init__(self):
+		self.uploads = [] # (name, contents)
+		self.fail = False
+
+	def upload_file(self, path_to_file, batch_info=None):
+		if self.fail:
+			return ""
+		with open(path_to_file, 'rb') as f:
+			self.uploads.append((os.path.basename(path_to_file), f.read()))
+		return "id{}".format(len(self.uploads))
+
+class TestLogShipper(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.log_path = os.path.join(self.dir, "host_STARTAT_10d0.log")
+		self.db_path = os.path.join(self.dir, "log_ship.sqlite3")
+		self.drive_handler = FakeDriveHandler()
+
+	def tearDown(self):
+		for x in os.listdir(self.dir):
+			os.remove(os.path.join(self.dir, x))
+		os.rmdir(self.dir)
+
+	def shipper(self, **kwargs):
+		return LogShipper(FakeEncryptor(), log_path=self.log_path, db_path=self.db_path, **kwargs)
+
+	def append(self, text, path=None):
+		with open(path or self.log_path, 'a') as f:
+			f.write(text)
+
+	def test_only_new_complete_lines_are_shipped(self):
+		shipper = self.shipper()
+		self.append("one\ntwo\nthr")
+		self.assertTrue(shipper.ship(self.drive_handler))
+		self.append("ee\n")
+		self.assertTrue(shipper.ship(self.drive_handler))
+		# nothing new, nothing shipped
+		self.assertTrue(shipper.ship(self.drive_handler))
+		self.assertListEqual([("host_STARTAT_10d0_0.log.gpg", b"one\ntwo\n"), ("host_STARTAT_10d0_1.log.gpg", b"three\n")], self.drive_handler.uploads)
+		self.assertListEqual(["host_STARTAT_10d0.log", "log_ship.sqlite3"], sorted(os.listdir(self.dir)))
+
+	def test_offset_survives_restart_and_failures(self):
+		self.append("one\n")
+		self.shipper().ship(self.drive_handler)
+		self.append("two\n")
+		self.drive_handler.fail = True
+		self.assertFalse(self.shipper().ship(self.drive_handler))
+		self.append("three\n")
+		self.drive_handler.fail = False
+		self.assertTrue(self.shipper().ship(self.drive_handler))
+		self.assertListEqual([b"one\n", b"two\nthree\n"], [x[1] for x in self.drive_handler.uploads])
+
+	def test_previous_logs_get_their_tails_shipped(self):
+		self.append("old\n")
+		self.shipper().ship(self.drive_handler)
+		self.append("old tail\n")
+		# restart with a new log
+		old_log_path = self.log_path
+		self.log_path = os.path.join(self.dir, "host_STARTAT_20d0.log")
+		self.append("new\n")
+		shipper = self.shipper()
+		shipper.ship(self.drive_handler)
+		self.assertListEqual([b"old\n", b"old tail\n", b"new\n"], [x[1] for x in self.drive_handler.uploads])
+		# and it's forgotten about the old one now that it's done
+		self.assertIsNone(shipper.progress(old_log_path))
+
+	def test_rotation(self):
+		shipper = self.shipper(rotate_bytes=10, keep=1)
+		for i in range(3):
+			self.append("line {}\n".format(i)*2)
+			self.assertTrue(shipper.ship(self.drive_handler))
+		self.assertListEqual([b"line 0\nline 0\n", b"line 1\nline 1\n", b"line 2\nline 2\n"], [x[1] for x in self.drive_handler.uploads])
+		self.assertListEqual(["host_STARTAT_10d0_0.log.gpg", "host_STARTAT_10d0_1.log.gpg", "host_STARTAT_10d0_2.log.gpg"], [x[0] for x in self.drive_handler.uploads])
+		# every ship rotated the log out, and only the newest rotated one is left
+		self.assertListEqual(["host_STARTAT_10d0_R2.log", "log_ship.sqlite3"], sorted(os.listdir(self.dir)))
+		self.assertTupleEqual((0, 3, 3), shipper.progress(self.log_path))
+
+	def test_rotated_log_tail_is_shipped(self):
+		shipper = self.shipper(rotate_bytes=10)
+		self.append("line 0\nline 1\n")
+		shipper.ship_tail(self.log_path, self.drive_handler)
+		# written after the ship but before the rotation
+		self.append("line 2\n")
+		self.assertTrue(shipper.rotate(self.drive_handler))
+		self.assertListEqual([("host_STARTAT_10d0_0.log.gpg", b"line 0\nline 1\n"), ("host_STARTAT_10d0_R0_0.log.gpg", b"line 2\n")], self.drive_handler.uploads)
+		self.assertIsNone(shipper.progress(self.log_path[:-4] + "_R0.log"))
+
+	def test_rotates_while_shipping_fails(self):
+		shipper = self.shipper(rotate_bytes=10, keep=0)
+		self.drive_handler.fail = True
+		for i in range(2):
+			self.append("line {}\n".format(i)*2)
+			self.assertFalse(shipper.ship(self.drive_handler))
+		# the log didn't keep growing, and nothing rotated out has been thrown away
+		self.assertListEqual(["host_STARTAT_10d0_R0.log", "host_STARTAT_10d0_R1.log", "log_ship.sqlite3"], sorted(os.listdir(self.dir)))
+		self.assertIsNotNone(shipper.progress(self.log_path[:-4] + "_R0.log"))
+
+		self.drive_handler.fail = False
+		self.assertTrue(shipper.ship(self.drive_handler))
+		self.assertListEqual([b"line 0\nline 0\n", b"line 1\nline 1\n"], [x[1] for x in self.drive_handler.uploads])
+		self.assertListEqual(["log_ship.sqlite3"], os.listdir(self.dir))
+
+	def test_segments_are_capped(self):
+		shipper = self.shipper(segment_bytes=10)
+		self.append("one\ntwo\nthree\n" + "x"*12 + "\nfour")
+		self.assertTrue(shipper.ship(self.drive_handler))
+		# a line longer than a whole segment goes up in pieces
+		self.assertListEqual([b"one\ntwo\n", b"three\n", b"x"*10, b"xx\n"], [x[1] for x in self.drive_handler.uploads])
+		self.assertTupleEqual((27, 4, 0), shipper.progress(self.log_path))
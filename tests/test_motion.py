@@ -0,0 +1,88 @@
+import io
+import os
+import tempfile
+from unittest import TestCase
+from PIL import Image, ImageDraw
+from svlc.motion import *
+
+def jpeg(square=False):
+	img = Image.new('L', (320,240), 100)
+	if square:
+		ImageDraw.Draw(img).rectangle([100, 80, 200, 160], fill=250)
+	stream = io.BytesIO()
+	img.save(stream, format='JPEG')
+	return stream.getvalue()
+
+class TestMotionFilter(TestCase):
+	def setUp(self):
+		self.quiet = jpeg()
+		self.busy = jpeg(square=True)
+
+	def test_drops_quiet_frames(self):
+		motion_filter = MotionFilter(keyframe_secs=60)
+		frames = [("host_{}d0.jpg".format(i), self.quiet) for i in range(10)]
+		frames[5] = ("host_5d0.jpg", self.busy)
+		kept = motion_filter.filter(frames)
+		# the first frame (nothing to compare against yet) and the one with something in it
+		self.assertListEqual(["host_0d0.jpg", "host_5d0.jpg"], [x[0] for x in kept])
+		self.assertEqual(0.8, motion_filter.stats()['drop_rate'])
+
+	def test_keyframes(self):
+		motion_filter = MotionFilter(keyframe_secs=60)
+		frames = [("host_{}d0.jpg".format(30*i), self.quiet) for i in range(5)]
+		kept = motion_filter.filter(frames)
+		self.assertListEqual(["host_0d0.jpg", "host_60d0.jpg", "host_120d0.jpg"], [x[0] for x in kept])
+		self.assertEqual(2, motion_filter.stats()['keyframes'])
+
+	def test_frames_filtered_in_time_order(self):
+		motion_filter = MotionFilter(keyframe_secs=60)
+		kept = motion_filter.filter([("host_2d0.jpg", self.quiet), ("host_1d0.jpg", self.quiet)])
+		self.assertListEqual(["host_1d0.jpg"], [x[0] for x in kept])
+
+	def test_dropped_files_removed(self):
+		motion_filter = MotionFilter(keyframe_secs=60)
+		self.addCleanup(os.chdir, os.getcwd())
+		os.chdir(tempfile.mkdtemp())
+		for name in ["host_1d0.jpg", "host_2d0.jpg"]:
+			with open(name, 'wb') as f:
+				f.write(self.quiet)
+		self.assertListEqual(["host_1d0.jpg"], motion_filter.filter(["host_1d0.jpg", "host_2d0.jpg"]))
+		self.assertListEqual(["host_1d0.jpg"], os.listdir("."))
+
+	def test_undecodable_frames_kept(self):
+		motion_filter = MotionFilter()
+		self.assertEqual(1, len(motion_filter.filter([("host_1d0.jpg", b'not a jpeg')])))
+		self.assertEqual(1, motion_filter.stats()['undecodable'])
+
+class TestCaptureRateController(TestCase):
+	def setUp(self):
+		self.now = 0
+		self.controller = CaptureRateController(min_interval=0.25, max_interval=4, active_threshold=0.02, quiet_threshold=0.005, hold_secs=30, clock=lambda: self.now)
+		self.intervals = []
+		self.controller.add_listener(self.intervals.append)
+
+	def test_speeds_up_on_activity_and_backs_off_after_hold(self):
+		self.assertEqual(0.25, self.controller.observe(0.1))
+		self.now = 10
+		# still quiet for less than the hold time
+		self.assertEqual(0.25, self.controller.observe(0))
+		for i, expected in enumerate([0.5, 1, 2, 4, 4]):
+			self.now = 30 + i
+			self.assertEqual(expected, self.controller.observe(0))
+		self.assertListEqual([4, 0.25, 0.5, 1, 2, 4], self.intervals)
+		self.assertListEqual(['active', 'back off', 'back off', 'back off', 'back off'], [x['decision'] for x in self.controller.stats()['history']])
+
+	def test_hysteresis_band_holds_rate(self):
+		self.controller.observe(0.1)
+		self.now = 100
+		# between the thresholds: neither active nor quiet
+		self.assertEqual(0.25, self.controller.observe(0.01))
+		self.assertEqual(1, self.controller.stats()['changes'])
+
+	def test_update_scores_frames(self):
+		quiet, busy = jpeg(), jpeg(square=True)
+		# first frame just seeds the background
+		self.assertEqual(4, self.controller.update(("host_0d0.jpg", quiet)))
+		self.assertEqual(4, self.controller.update(("host_1d0.jpg", quiet)))
+		self.assertEqual(0.25, self.controller.update(("host_2d0.jpg", busy)))
+		self.assertEqual(0.25, self.controller.update(None))
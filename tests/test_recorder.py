@@ -0,0 +1,50 @@
+from unittest import TestCase
+from svlc.recorder import *
+
+class TestFrameRingBuffer(TestCase):
+	def test_overwrites_oldest_when_full(self):
+		ring = FrameRingBuffer(max_frames=3)
+		for i in range(5):
+			ring.push("f{}".format(i), b'x'*(i + 1))
+		self.assertListEqual(["f2", "f3", "f4"], [x[0] for x in ring.snapshot()])
+		self.assertDictEqual({'frames': 3, 'bytes': 3 + 4 + 5, 'pushed': 5, 'overwritten': 2}, ring.stats())
+
+	def test_overwrites_oldest_when_over_byte_cap(self):
+		ring = FrameRingBuffer(max_frames=10, max_bytes=10)
+		for i in range(5):
+			ring.push("f{}".format(i), b'x'*(i + 1))
+		self.assertListEqual(["f3", "f4"], [x[0] for x in ring.snapshot()])
+		self.assertDictEqual({'frames': 2, 'bytes': 4 + 5, 'pushed': 5, 'overwritten': 3}, ring.stats())
+
+	def test_discard_keeps_newer_frames(self):
+		ring = FrameRingBuffer(max_frames=3)
+		ring.push("f0", b'a')
+		ring.push("f1", b'bb')
+		frames = ring.snapshot()
+		# arrives while the snapshot is being handed over
+		ring.push("f2", b'ccc')
+		ring.discard(frames)
+		self.assertListEqual([("f2", b'ccc')], ring.snapshot())
+		self.assertEqual(3, ring.stats()['bytes'])
+
+class TestContinuousRecorder(TestCase):
+	def test_synthetic_frames_end_up_in_ring(self):
+		recorder = ContinuousRecorder(SyntheticFrameSource(num_frames=5, sleep_fn=lambda x: None), FrameRingBuffer(max_frames=10), min_interval=0, warmup_secs=0)
+		recorder.begin_warmup()
+		recorder.thread.join(10)
+		frames = recorder.ring.snapshot()
+		self.assertEqual(5, len(frames))
+		for name, data in frames:
+			self.assertTrue(name.startswith(PATH_TO_IMAGES))
+			self.assertIsNotNone(parse_file_name(name[len(PATH_TO_IMAGES):])[1])
+			# JPEG start/end of image markers
+			self.assertEqual(b'\xff\xd8', data[:2])
+			self.assertEqual(b'\xff\xd9', data[-2:])
+
+	def test_frames_throttled_to_min_interval(self):
+		# the clock never moves, so everything after the first frame is too soon
+		recorder = ContinuousRecorder(SyntheticFrameSource(num_frames=4, sleep_fn=lambda x: None), min_interval=1, warmup_secs=0, clock=lambda: 100)
+		recorder.begin_warmup()
+		recorder.thread.join(10)
+		self.assertEqual(1, len(recorder.ring))
+		self.assertEqual(3, recorder.stats()['throttled'])
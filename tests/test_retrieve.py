@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from svlc.retrieve import *
+from svlc.tests.fake_drive import FakeDrive
+
+class FakeEncryptor:
+	"""
+	"encrypts" by passing everything through as is
+	"""
+
+	def encrypt_stream(self, stream, enc_filename, compress=False):
+		data = stream.read()
+		with open(enc_filename, 'wb') as f:
+			f.write(data)
+		return md5(data).hexdigest()
+
+	def encrypt_to_bytes(self, stream, compress=False):
+		return stream.read()
+
+	def decrypt_stream(self, stream):
+		return stream.read()
+
+class TestRetrieveFrames(TestCase):
+	def setUp(self):
+		self.drive = FakeDrive().start()
+		self.handler = GDriveHandler(service=self.drive.build_service(), index=BatchIndex(":memory:"))
+		self.handler.working_dir_id = self.drive.state.add_file(ACTIVE_GDRIVE_DIR_NAME, [], mime_type=GDRIVE_FOLDER_MIME_TYPE)
+		self.dir = tempfile.mkdtemp()
+		self.frames = [("host_{}d0.jpg".format(i), os.urandom(1000)) for i in range(100, 120)]
+
+	def tearDown(self):
+		self.drive.stop()
+		for x in os.listdir(self.dir):
+			os.remove(os.path.join(self.dir, x))
+		os.rmdir(self.dir)
+
+	def upload_batch(self, packer_class, frames, name):
+		packer = packer_class(os.path.join(self.dir, name), MAX_FILE_SIZE_PER_UPLOAD, ENC_OVERHEAD_RATIO, FakeEncryptor())
+		for frame in frames:
+			packer.add(frame)
+		stats = packer.seal()
+		return self.handler.upload_file(stats['batch'], stats)
+
+	def test_seekable_batch_only_fetches_matching_frames(self):
+		file_id = self.upload_batch(SeekableBatchPacker, self.frames, "host_120d0_B0.svb")
+		retrieved = list(retrieve_frames(self.handler, FakeEncryptor(), "host", 105, 108))
+		self.assertListEqual(self.frames[5:9], retrieved)
+		# the index, then all four frames in one go -- never the whole batch
+		self.assertEqual(2, self.drive.state.num_range_downloads)
+		self.assertEqual(2, self.drive.state.num_downloads)
+
+	def test_zip_batch_is_fetched_whole(self):
+		self.upload_batch(BatchPacker, self.frames[:10], "host_110d0_B0.zip")
+		self.upload_batch(SeekableBatchPacker, self.frames[10:], "host_120d0_B0.svb")
+		retrieved = list(retrieve_frames(self.handler, FakeEncryptor(), "host", 108, 111))
+		self.assertListEqual(self.frames[8:12], retrieved)
+
+	def test_broken_zip_batch_gives_no_frames(self):
+		path = os.path.join(self.dir, "host_110d0_B0.zip.gpg")
+		with open(path, 'wb') as f:
+			f.write(b'not a zip')
+		self.handler.upload_file(path)
+		self.upload_batch(SeekableBatchPacker, self.frames[10:], "host_120d0_B0.svb")
+		self.assertListEqual(self.frames[10:12], list(retrieve_frames(self.handler, FakeEncryptor(), "host", 108, 111)))
+
+	def test_nothing_in_range(self):
+		self.upload_batch(SeekableBatchPacker, self.frames, "host_120d0_B0.svb")
+		self.assertListEqual([], list(retrieve_frames(self.handler, FakeEncryptor(), "host", 200, 300)))
+		self.assertListEqual([], list(retrieve_frames(self.handler, FakeEncryptor(), "otherhost", 100, 120)))
+
+class TestRestorer(TestCase):
+	def setUp(self):
+		self.drive = FakeDrive().start()
+		self.dir_id = self.drive.state.add_file(ACTIVE_GDRIVE_DIR_NAME, [], mime_type=GDRIVE_FOLDER_MIME_TYPE)
+		self.dir = tempfile.mkdtemp()
+		self.out_dir = tempfile.mkdtemp()
+		self.frames = [("host_{}d0.jpg".format(1700000000 + i), os.urandom(1000)) for i in range(40)]
+		handler = self.drive_handler()
+		# five batches of eight, alternating formats
+		for i in range(5):
+			packer_class = SeekableBatchPacker if i % 2 else BatchPacker
+			packer = packer_class(os.path.join(self.dir, "host_{}d0_B0{}".format(1700000010 + 8*i, packer_class.suffix)), MAX_FILE_SIZE_PER_UPLOAD, ENC_OVERHEAD_RATIO, FakeEncryptor())
+			for frame in self.frames[8*i:8*(i + 1)]:
+				packer.add(frame)
+			stats = packer.seal()
+			handler.upload_file(stats['batch'])
+			os.remove(stats['batch'])
+
+	def tearDown(self):
+		self.drive.stop()
+		os.rmdir(self.dir)
+		shutil.rmtree(self.out_dir)
+
+	def drive_handler(self):
+		# (no index, so batches are found by their names)
+		handler = GDriveHandler(service=self.drive.build_service())
+		handler.working_dir_id = self.dir_id
+		return handler
+
+	def test_restores_frames_in_range_into_time_ordered_dirs(self):
+		restorer = Restorer(FakeEncryptor(), drive_handler_factory=self.drive_handler, num_workers=2)
+		stats = restorer.restore("host", 1700000005, 1700000030, self.out_dir)
+		self.assertEqual(26, stats['num_frames'])
+		self.assertEqual(5, stats['num_batches'])
+		self.assertGreater(stats['frames_per_sec'], 0)
+		for name, data in self.frames[5:31]:
+			with open(restored_frame_path(self.out_dir, name), 'rb') as f:
+				self.assertEqual(data, f.read())
+		restored = [x for _, _, files in os.walk(self.out_dir) for x in files]
+		self.assertListEqual(sorted(restored), sorted(x[0] for x in self.frames[5:31]))
+
+	def test_failed_batch_is_skipped_and_counted(self):
+		def drive_handler():
+			handler = self.drive_handler()
+			download_file = handler.download_file
+			def flaky_download_file(file_id):
+				if "host_1700000026d0_B0.zip.gpg" == self.drive.state.files[file_id]['name']:
+					raise ConnectionResetError("connection dropped")
+				return download_file(file_id)
+			handler.download_file = flaky_download_file
+			return handler
+
+		restorer = Restorer(FakeEncryptor(), drive_handler_factory=drive_handler, num_workers=2)
+		stats = restorer.restore("host", 1700000005, 1700000030, self.out_dir)
+		self.assertEqual(1, stats['num_failed_batches'])
+		# everything but the frames in that batch
+		self.assertEqual(18, stats['num_frames'])
+		restored = [x for _, _, files in os.walk(self.out_dir) for x in files]
+		self.assertListEqual(sorted(restored), sorted(x[0] for x in self.frames[5:16] + self.frames[24:31]))
+
+	def test_frame_path(self):
+		capture_time = localtime(1700000000.5)
+		self.assertEqual(os.path.join("out", "host", strftime("%Y-%m-%d", capture_time), strftime("%H", capture_time), "host_1700000000d5.jpg"), restored_frame_path("out", "./working_images/host_1700000000d5.jpg"))
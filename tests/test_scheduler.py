@@ -0,0 +1,85 @@
+from unittest import TestCase
+from svlc.scheduler import *
+
+class FakeClock:
+	def __init__(self):
+		self.now = 100.0
+
+	def __call__(self):
+		return self.now
+
+	def sleep(self, secs):
+		self.now += secs
+
+class TestScheduler(TestCase):
+	def setUp(self):
+		self.clock = FakeClock()
+		self.sched = Scheduler(clock=self.clock, sleep_fn=self.clock.sleep)
+		self.runs = []
+
+	def job(self, name, duration=0):
+		def callback():
+			self.runs.append((name, self.clock.now))
+			self.clock.now += duration
+		return callback
+
+	def run_until(self, end_time):
+		while self.clock.now <= end_time:
+			self.clock.sleep(self.sched.run_pending())
+
+	def test_sleeps_until_next_deadline(self):
+		self.sched.add_job('a', 1, self.job('a'))
+		self.sched.add_job('b', 2.5, self.job('b'))
+		self.assertEqual(1, self.sched.run_pending())
+		self.clock.sleep(1)
+		self.assertEqual(1, self.sched.run_pending())
+		self.assertListEqual([('a', 101)], self.runs)
+
+	def test_fixed_rate_does_not_drift(self):
+		self.sched.add_job('a', 1, self.job('a', duration=0.3))
+		self.run_until(105)
+		self.assertListEqual([101, 102, 103, 104, 105], [x[1] for x in self.runs])
+
+	def test_fixed_delay_anchors_to_end_of_run(self):
+		self.sched.add_job('a', 1, self.job('a', duration=0.5), fixed_rate=False)
+		self.run_until(104)
+		self.assertListEqual([101, 102.5, 104], [x[1] for x in self.runs])
+
+	def test_overrun_skips_missed_deadlines(self):
+		job = self.sched.add_job('a', 1, self.job('a', duration=2.5))
+		self.clock.sleep(self.sched.run_pending())
+		self.assertEqual(0.5, self.sched.run_pending())
+		self.assertEqual(2, job.num_skipped)
+		self.assertEqual(1, job.overruns.num)
+		self.assertEqual(1.5, job.overruns.max)
+
+	def test_records_lateness(self):
+		job = self.sched.add_job('a', 1, self.job('a'))
+		self.clock.sleep(1.02)
+		self.sched.run_pending()
+		self.assertEqual(1, job.lateness.num)
+		self.assertAlmostEqual(0.02, job.lateness.max)
+		self.assertEqual(1, job.stats()['lateness']['buckets']['<=0.05'])
+
+	def test_period_change_applies_from_next_reschedule(self):
+		job = self.sched.add_job('a', 1, self.job('a'))
+		self.run_until(101)
+		job.period = 3
+		self.run_until(105)
+		self.assertListEqual([101, 102, 105], [x[1] for x in self.runs])
+
+	def test_set_period_shorter_takes_effect_right_away(self):
+		self.sched.add_job('a', 10, self.job('a'))
+		self.clock.sleep(1)
+		self.sched.set_period('a', 1)
+		self.run_until(103.5)
+		# rather than waiting until 110 for the old deadline, and without the stale deadline running it again
+		self.assertListEqual([('a', 102), ('a', 103)], self.runs)
+		self.run_until(110.5)
+		self.assertEqual(9, len(self.runs))
+
+	def test_set_period_longer_waits_for_current_deadline(self):
+		self.sched.add_job('a', 1, self.job('a'))
+		self.sched.set_period('a', 5)
+		self.run_until(106.5)
+		self.assertListEqual([('a', 101), ('a', 106)], self.runs)
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from svlc.staging import *
+from svlc.upload_journal import UploadJournal
+
+class TestStagingArea(TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.frame_dir = os.path.join(self.dir, "images") + os.sep
+		self.batch_dir = os.path.join(self.dir, "batches")
+		os.mkdir(self.frame_dir)
+		os.mkdir(self.batch_dir)
+		self.now = 10000
+		self.staging = StagingArea(os.path.join(self.dir, "ram"), self.frame_dir, self.batch_dir, max_bytes=1000, spill_ratio=0.5, stall_secs=100, wall_clock=lambda: self.now)
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def stage(self, name, size, age=0, is_frame=True):
+		path = os.path.join(self.staging.frame_dir_staged if is_frame else self.staging.batch_dir_staged, name)
+		with open(path, 'wb') as f:
+			f.write(b'x'*size)
+		os.utime(path, (self.now - age, self.now - age))
+		self.staging.record_write(path, size)
+		return path
+
+	def test_unstaged_writes_go_to_flash(self):
+		staging = StagingArea(None, self.frame_dir, self.batch_dir)
+		self.assertEqual(self.frame_dir, staging.frame_dir())
+		self.assertEqual(self.batch_dir, staging.batch_dir(10**9))
+		self.assertListEqual([self.frame_dir], staging.frame_dirs())
+		staging.record_write(os.path.join(self.frame_dir, "host_1d0.jpg"), 300)
+		self.assertEqual(300, staging.stats()['flash_bytes_written'])
+		self.assertFalse(staging.check())
+
+	def test_writes_go_to_ram_until_full(self):
+		self.assertEqual(self.staging.frame_dir_staged, self.staging.frame_dir())
+		self.stage("host_1d0.jpg", 600)
+		self.assertEqual(self.staging.batch_dir_staged, self.staging.batch_dir(400))
+		self.assertEqual(self.batch_dir, self.staging.batch_dir(401))
+		stats = self.staging.stats()
+		self.assertEqual(600, stats['ram_bytes_written'])
+		self.assertEqual(0, stats['flash_bytes_written'])
+		self.assertEqual(1, stats['unstaged_batches'])
+
+	def test_spills_oldest_frames_when_full(self):
+		oldest = self.stage("host_1d0.jpg", 300, age=30)
+		in_flight = self.stage("host_2d0.jpg", 300, age=20)
+		self.stage("host_3d0.jpg", 300, age=10)
+		self.stage("host_4d0_B0.zip.gpg", 300, is_frame=False)
+		self.assertTrue(self.staging.check([in_flight]))
+
+		# only the frames nobody's packing are spilled (and we stop once we're under half the cap)
+		self.assertListEqual(["host_1d0.jpg", "host_3d0.jpg"], sorted(os.listdir(self.frame_dir)))
+		self.assertFalse(os.path.exists(oldest))
+		self.assertEqual(600, self.staging.staged_bytes)
+		self.assertEqual(600, self.staging.stats()['flash_bytes_written'])
+
+		# nothing left we can spill, so new files go to the card...
+		batch = self.stage("host_5d0_B0.zip.gpg", 500, is_frame=False)
+		self.assertFalse(self.staging.check([in_flight]))
+		self.assertEqual(self.frame_dir, self.staging.frame_dir())
+		# ...until there's some room again
+		os.remove(batch)
+		self.assertFalse(self.staging.check([in_flight]))
+		os.remove(in_flight)
+		self.assertTrue(self.staging.check())
+		self.assertEqual(self.staging.frame_dir_staged, self.staging.frame_dir())
+
+	def test_spills_everything_while_uploads_are_stalled(self):
+		self.stage("host_1d0.jpg", 100)
+		batch = self.stage("host_2d0_B0.zip.gpg", 100, age=99, is_frame=False)
+		self.assertTrue(self.staging.check())
+		self.now += 1
+		self.assertFalse(self.staging.check())
+		self.assertTrue(self.staging.stalled)
+		self.assertListEqual(["host_1d0.jpg"], os.listdir(self.frame_dir))
+		self.assertEqual(self.batch_dir, self.staging.batch_dir())
+
+		# the stuck batch finally made it
+		os.remove(batch)
+		self.assertTrue(self.staging.check())
+		self.assertFalse(self.staging.stalled)
+
+	def test_flush_moves_finished_files_and_follows_batches_in_the_journal(self):
+		self.stage("host_1d0.jpg", 100)
+		self.stage("host_1d5.jpg.tmp", 100)
+		batch = self.stage("host_2d0_B0.zip.gpg", 100, is_frame=False)
+		# sealed, but not journaled yet
+		self.stage("host_2d0_B1.zip.gpg", 100, is_frame=False)
+		# still being encrypted (and the archive it's being built from)
+		self.stage("host_2d0_B2.zip.gpg.part", 50, is_frame=False)
+		self.stage("host_2d0_B2.zip", 50, is_frame=False)
+		# still being uploaded
+		in_flight = self.stage("host_2d0_B3.zip.gpg", 100, is_frame=False)
+		journal = UploadJournal(":memory:")
+		journal.record(batch, 'packaged')
+		journal.record(in_flight, 'uploading')
+		self.assertEqual(3, self.staging.flush(journal, [in_flight]))
+
+		self.assertListEqual([in_flight], [x[0] for x in self.staging.staged_files()])
+		self.assertListEqual(["host_2d0_B0.zip.gpg", "host_2d0_B1.zip.gpg"], sorted(os.listdir(self.batch_dir)))
+		self.assertEqual(3, self.staging.stats()['discarded'])
+		self.assertListEqual(["host_1d0.jpg"], os.listdir(self.frame_dir))
+		self.assertListEqual(sorted([os.path.join(self.batch_dir, "host_2d0_B0.zip.gpg"), in_flight]), sorted(x['path'] for x in journal.pending()))
+
+	def test_batches_are_packed_into_staging(self):
+		self.addCleanup(os.chdir, os.getcwd())
+		os.chdir(self.dir)
+		with open(ENC_PASSPHRASE_LOC, 'w') as f:
+			f.write("test passphrase\n")
+		file_handler = FileHandler(num_workers=1)
+		file_handler.staging = StagingArea(os.path.join(self.dir, "ram"), max_bytes=100000)
+		batches = file_handler.compress_and_encrypt_batch([("host_{}d0.jpg".format(i), os.urandom(5000)) for i in range(3)])
+
+		self.assertEqual(1, len(batches))
+		self.assertTrue(file_handler.staging.is_staged(batches[0]))
+		self.assertTrue(os.path.isfile(batches[0]))
+		stats = file_handler.staging.stats()
+		self.assertEqual(file_handler.batch_info[batches[0]]['bytes_written'], stats['ram_bytes_written'])
+		self.assertEqual(0, stats['flash_bytes_written'])
@@ -0,0 +1,87 @@
+import io
+import os
+import tempfile
+from unittest import TestCase
+import numpy as np
+from PIL import Image
+from svlc.transcode import *
+
+def noisy_jpeg(seed=0, size=(320,240)):
+	# noise is about as hard to compress as it gets
+	rng = np.random.default_rng(seed)
+	img = Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+	stream = io.BytesIO()
+	img.save(stream, format='JPEG', quality=95)
+	return stream.getvalue()
+
+class TestFitToBudget(TestCase):
+	def setUp(self):
+		self.img = Image.open(io.BytesIO(noisy_jpeg()))
+
+	def test_highest_quality_that_fits(self):
+		data, quality, scale, _ = fit_to_budget(self.img, 60000, 90, max_encodes=10)
+		self.assertLessEqual(len(data), 60000)
+		self.assertEqual(1, scale)
+		# one step up wouldn't have fit
+		self.assertGreater(len(encode(self.img, quality + 1)), 60000)
+
+	def test_good_guess_is_cheap(self):
+		_, quality, _, _ = fit_to_budget(self.img, 60000, 90, max_encodes=10)
+		_, _, _, num_encodes = fit_to_budget(self.img, 60000, quality)
+		self.assertEqual(2, num_encodes)
+
+	def test_downscales_when_quality_is_not_enough(self):
+		data, quality, scale, _ = fit_to_budget(self.img, 10000, 90)
+		self.assertLessEqual(len(data), 10000)
+		self.assertEqual(TRANSCODE_MIN_QUALITY, quality)
+		self.assertLess(scale, 1)
+
+	def test_never_downscales_past_the_minimum(self):
+		import svlc.transcode
+		scales = []
+		real_encode = svlc.transcode.encode
+		def spy(img, quality, scale=1):
+			scales.append(scale)
+			return real_encode(img, quality, scale)
+		svlc.transcode.encode = spy
+		self.addCleanup(setattr, svlc.transcode, 'encode', real_encode)
+		data, _, _, _ = fit_to_budget(self.img, 10, 90)
+		self.assertIsNone(data)
+		# the last try is right at the minimum, none below it
+		self.assertEqual(TRANSCODE_MIN_SCALE, scales[-1])
+		self.assertEqual(TRANSCODE_MIN_SCALE, min(scales))
+
+class TestFrameTranscoder(TestCase):
+	def test_frames_fit_budget_and_small_ones_are_untouched(self):
+		transcoder = FrameTranscoder(max_bytes=60000, num_workers=0)
+		small = ("host_0d0.jpg", b'x'*100)
+		frames = transcoder.transcode([small, ("host_1d0.jpg", noisy_jpeg(1)), ("host_2d0.jpg", noisy_jpeg(2))])
+		self.assertIs(small, frames[0])
+		self.assertListEqual(["host_0d0.jpg", "host_1d0.jpg", "host_2d0.jpg"], [x[0] for x in frames])
+		for _, data in frames[1:]:
+			self.assertLessEqual(len(data), 60000)
+			Image.open(io.BytesIO(data)).load()
+		self.assertEqual(2, transcoder.stats()['transcoded'])
+		# both frames are the same scene
+		self.assertEqual(1, len(transcoder.quality_cache))
+
+	def test_undecodable_frame_kept_as_it_was(self):
+		transcoder = FrameTranscoder(max_bytes=60000, num_workers=0)
+		truncated = ("host_1d0.jpg", noisy_jpeg(1)[:70000])
+		frames = transcoder.transcode([truncated, ("host_2d0.jpg", noisy_jpeg(2))])
+		self.assertIs(truncated, frames[0])
+		self.assertLessEqual(len(frames[1][1]), 60000)
+		self.assertEqual(1, transcoder.stats()['undecodable'])
+		self.assertEqual(1, transcoder.stats()['transcoded'])
+
+	def test_files_overwritten_in_worker_processes(self):
+		transcoder = FrameTranscoder(max_bytes=60000, num_workers=2)
+		self.addCleanup(transcoder.shutdown)
+		path = os.path.join(tempfile.mkdtemp(), "host_1d0.jpg")
+		with open(path, 'wb') as f:
+			f.write(noisy_jpeg())
+		self.addCleanup(os.rmdir, os.path.dirname(path))
+		self.addCleanup(os.remove, path)
+		self.assertListEqual([path], transcoder.transcode([path]))
+		self.assertLessEqual(os.path.getsize(path), 60000)
+		self.assertListEqual(["host_1d0.jpg"], os.listdir(os.path.dirname(path)))
@@ -0,0 +1,49 @@
+from unittest import TestCase
+from svlc.upload_control import *
+
+MB = 1000000
+
+class TestUploadController(TestCase):
+	def setUp(self):
+		self.now = 0
+		self.controller = UploadController(start_bytes=10*MB, min_bytes=1*MB, max_bytes=100*MB, start_secs=60, min_secs=30, max_secs=900, target_secs=60, timeout_secs=180, grow_factor=1.5, shrink_factor=0.5, alpha=1, clock=lambda: self.now)
+
+	def test_grows_up_to_what_the_link_can_take(self):
+		# 1MB/s, so batches stop growing at a minute's worth
+		sizes = [self.controller.observe_upload(x, x / MB, True) for x in [10*MB, 15*MB, 22500000, 33750000, 50625000, 60*MB]]
+		self.assertListEqual([15*MB, 22500000, 33750000, 50625000, 60*MB, 60*MB], sizes)
+
+	def test_fast_link_goes_to_max(self):
+		for i in range(10):
+			self.controller.observe_upload(self.controller.batch_bytes, 1, True)
+		self.assertEqual(100*MB, self.controller.batch_bytes)
+
+	def test_shrinks_on_failures_and_timeouts(self):
+		self.assertEqual(5*MB, self.controller.observe_upload(10*MB, 20, False))
+		self.assertEqual(2500000, self.controller.observe_upload(5*MB, 200, True))
+		self.assertEqual(1250000, self.controller.observe_upload(2500000, 5, False))
+		# (no smaller than the minimum)
+		self.assertEqual(1*MB, self.controller.observe_upload(1250000, 5, False))
+		self.assertEqual(1*MB, self.controller.observe_upload(1*MB, 5, False))
+		stats = self.controller.stats()
+		self.assertEqual(4, stats['failures'])
+		self.assertEqual(1, stats['timeouts'])
+		self.assertEqual(1, stats['error_rate'])
+		# (the last one changed nothing -- both already at their bounds)
+		self.assertListEqual(['failed', 'timed out', 'failed', 'failed'], [x['decision'] for x in stats['history']])
+
+	def test_interval_follows_ingest_and_backs_off_on_failure(self):
+		self.controller.observe_ingest(0)
+		self.now = 60
+		# 100KB/s coming in, so it takes 100 sec to fill a 10MB batch
+		self.assertEqual(100, self.controller.observe_ingest(6*MB))
+		self.controller.observe_upload(10*MB, 20, False)
+		# half the batch size, but twice the wait
+		self.assertEqual(100, self.controller.interval)
+		self.controller.observe_upload(5*MB, 20, False)
+		self.assertEqual(2500000 / 100000 * 4, self.controller.interval)
+		self.controller.observe_upload(2500000, 1, True)
+		self.assertEqual(37.5, self.controller.interval)
+		for i in range(10):
+			self.controller.observe_upload(self.controller.batch_bytes, 1, False)
+		self.assertEqual(900, self.controller.interval)
@@ -0,0 +1,45 @@
+from unittest import TestCase
+from svlc.upload_journal import *
+
+class TestUploadJournal(TestCase):
+	def setUp(self):
+		self.journal = UploadJournal(":memory:")
+
+	def test_state_progression(self):
+		self.journal.record("b0.zip.gpg", 'packaged', batch_info={'md5': "abc"})
+		self.journal.record("b0.zip.gpg", 'uploading')
+		self.journal.record("b0.zip.gpg", 'uploaded', file_id="id0")
+		entry = self.journal.pending()[0]
+		self.assertEqual('uploaded', entry['state'])
+		self.assertEqual("id0", entry['file_id'])
+		# batch info is kept from the first record
+		self.assertDictEqual({'md5': "abc"}, entry['batch_info'])
+		self.journal.record("b0.zip.gpg", 'deleted')
+		self.assertListEqual([], self.journal.pending())
+
+	def test_unknown_state(self):
+		with self.assertRaises(ValueError):
+			self.journal.record("b0.zip.gpg", 'lost')
+
+	def test_failed_backs_off_exponentially(self):
+		self.journal.record("b0.zip.gpg", 'uploading')
+		self.assertEqual(10, self.journal.failed("b0.zip.gpg", base_secs=10, max_secs=25))
+		self.assertEqual(20, self.journal.failed("b0.zip.gpg", base_secs=10, max_secs=25))
+		self.assertEqual(25, self.journal.failed("b0.zip.gpg", base_secs=10, max_secs=25))
+		self.assertListEqual([], self.journal.pending())
+		self.assertEqual(1, len(self.journal.pending(now=time() + 30)))
+
+	def test_reset_backoff(self):
+		self.journal.record("b0.zip.gpg", 'uploading')
+		self.journal.failed("b0.zip.gpg")
+		self.journal.reset_backoff()
+		self.assertEqual(1, self.journal.pending()[0]['attempts'])
+
+	def test_adopt_and_move(self):
+		self.journal.record("b0.zip.gpg", 'packaged')
+		self.assertListEqual(["b1.zip.gpg"], self.journal.adopt(["b0.zip.gpg", "b1.zip.gpg"]))
+		self.journal.move("b1.zip.gpg", "bak/b1.zip.gpg")
+		self.assertDictEqual({'packaged': 1, 'failed': 1}, self.journal.state_counts())
+		self.assertListEqual(["b0.zip.gpg", "bak/b1.zip.gpg"], sorted(x['path'] for x in self.journal.pending()))
+		self.assertEqual('failed', self.journal.state_of("bak/b1.zip.gpg"))
+		self.assertIsNone(self.journal.state_of("b1.zip.gpg"))
@@ -0,0 +1,249 @@
+import os
+import shutil
+import tempfile
+import threading
+from time import sleep
+from unittest import TestCase
+from svlc.uploader import *
+
+class FakeFileHandler:
+	def __init__(self):
+		self.batch_info = {}
+		self.packaged = []
+		self.frames_packed = set()
+		self.on_sealed = None
+		self.batch_dir = ''
+
+	def compress_and_encrypt_batch(self, frames):
+		self.packaged.append(frames)
+		self.frames_packed = set(frame_name(x) for x in frames)
+		batch = "batch{}".format(len(self.packaged))
+		self.seal(batch)
+		return [batch]
+
+	def batch_dirs(self):
+		return [self.batch_dir]
+
+	def seal(self, batch):
+		self.batch_info[batch] = {'batch': batch, 'md5': "md5-" + batch}
+		if self.on_sealed is not None:
+			self.on_sealed(self.batch_info[batch])
+
+class FakeDriveHandler:
+	def __init__(self):
+		self.thread_name = threading.current_thread().name
+
+class TestUploadWorkerPool(TestCase):
+	def test_jobs_run_on_workers(self):
+		pool = UploadWorkerPool(FakeFileHandler(), num_workers=2, drive_handler_factory=FakeDriveHandler)
+		pool.start()
+		done = threading.Event()
+		seen = []
+		def job(drive_handler):
+			seen.append(drive_handler.thread_name)
+			done.set()
+		self.assertTrue(pool.submit_job(job))
+		self.assertTrue(done.wait(5))
+		self.assertTrue(seen[0].startswith('uploader'))
+
+	def test_worker_keeps_trying_to_set_up_drive(self):
+		attempts = []
+		def flaky_factory():
+			attempts.append(1)
+			if len(attempts) < 3:
+				raise OSError("network is unreachable")
+			return FakeDriveHandler()
+		pool = UploadWorkerPool(FakeFileHandler(), num_workers=1, drive_handler_factory=flaky_factory, handler_retry_base_secs=0.01)
+		done = threading.Event()
+		self.assertTrue(pool.submit_job(lambda d: done.set()))
+		pool.start()
+		self.assertTrue(done.wait(5))
+		self.assertEqual(3, len(attempts))
+		self.assertEqual(2, pool.stats()['handler_failures'])
+
+	def test_submit_never_blocks_when_full(self):
+		# not started, so nothing drains the queues
+		pool = UploadWorkerPool(FakeFileHandler(), num_workers=1, max_queue_depth=1, drive_handler_factory=FakeDriveHandler)
+		self.assertTrue(pool.submit_frames(["a.jpg"]))
+		self.assertFalse(pool.submit_frames(["b.jpg"]))
+		self.assertTrue(pool.submit_job(lambda d: None))
+		self.assertFalse(pool.submit_job(lambda d: None))
+		self.assertEqual(2, pool.stats()['jobs_turned_away'])
+
+	def test_frames_not_resubmitted_while_in_flight(self):
+		file_handler = FakeFileHandler()
+		pool = UploadWorkerPool(file_handler, num_workers=1, drive_handler_factory=FakeDriveHandler)
+		pool.submit_frames(["a.jpg", "b.jpg"])
+		pool.submit_frames(["a.jpg", "b.jpg", "c.jpg"])
+		self.assertEqual(2, pool.stats()['package_queue_depth'])
+		self.assertEqual(3, pool.stats()['frames_in_flight'])
+		self.assertListEqual(["c.jpg"], pool.package_queue.queue[1])
+
+class FakeBatchPerFrameFileHandler(FakeFileHandler):
+	def compress_and_encrypt_batch(self, frames):
+		self.packaged.append(frames)
+		for frame in frames:
+			self.seal("batch_" + frame)
+		return ["batch_" + x for x in frames]
+
+class TestSealedBatches(TestCase):
+	def test_every_batch_journaled_as_sealed_and_left_to_the_journal_on_stop(self):
+		journal = UploadJournal(":memory:")
+		# the worker can't get going until we say so, so only one batch fits in the queue
+		drive_ready = threading.Event()
+		pool = UploadWorkerPool(FakeBatchPerFrameFileHandler(), num_workers=1, max_queue_depth=1, drive_handler_factory=lambda: drive_ready.wait(5) and FakeDriveHandler(), journal=journal)
+		pool.start()
+		pool.submit_frames(["a.jpg", "b.jpg", "c.jpg"])
+		for _ in range(100):
+			if 3 == len(journal.pending()):
+				break
+			threading.Event().wait(0.05)
+		self.assertListEqual(["batch_a.jpg", "batch_b.jpg", "batch_c.jpg"], sorted(x['path'] for x in journal.pending()))
+		self.assertEqual(3, pool.stats()['batches_in_flight'])
+
+		threading.Timer(0.2, drive_ready.set).start()
+		self.assertTrue(pool.stop(timeout=10))
+		# nothing got uploaded, and the journal has all of it for next time
+		self.assertDictEqual({'packaged': 3}, journal.state_counts())
+		self.assertEqual(0, pool.stats()['jobs_done'])
+
+	def test_stop_while_drive_is_unreachable(self):
+		def unreachable():
+			raise OSError("network is unreachable")
+		pool = UploadWorkerPool(FakeFileHandler(), num_workers=2, drive_handler_factory=unreachable, handler_retry_base_secs=60)
+		pool.start()
+		self.assertTrue(pool.stop(timeout=5))
+
+class FakeVerifyingDriveHandler:
+	def __init__(self):
+		self.verified = []
+
+	def verify_upload(self, path_to_file, file_id, local_checksum):
+		self.verified.append((path_to_file, file_id, local_checksum))
+		os.remove(path_to_file)
+		return True
+
+class TestRetryPending(TestCase):
+	def setUp(self):
+		self.journal = UploadJournal(":memory:")
+		self.pool = UploadWorkerPool(FakeFileHandler(), num_workers=1, drive_handler_factory=FakeVerifyingDriveHandler, journal=self.journal)
+		fd, self.path = tempfile.mkstemp(suffix=".zip.gpg")
+		os.close(fd)
+
+	def tearDown(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+
+	def test_uploaded_batch_gets_verified(self):
+		self.journal.record(self.path, 'uploaded', file_id="id0", batch_info={'md5': "abc"})
+		self.pool.retry_pending()
+		self.assertEqual(1, self.pool.stats()['batches_in_flight'])
+		# a second sweep doesn't queue it again while it's still in flight
+		self.pool.retry_pending()
+		self.assertEqual(1, self.pool.job_queue.qsize())
+		drive_handler = FakeVerifyingDriveHandler()
+		self.pool.job_queue.get()(drive_handler)
+		self.assertListEqual([(self.path, "id0", "abc")], drive_handler.verified)
+		self.assertListEqual([], self.journal.pending())
+		self.assertEqual(0, self.pool.stats()['batches_in_flight'])
+
+	def test_missing_batch_marked_deleted(self):
+		self.journal.record(self.path, 'uploading')
+		os.remove(self.path)
+		self.pool.retry_pending()
+		self.assertEqual(0, self.pool.job_queue.qsize())
+		self.assertDictEqual({'deleted': 1}, self.journal.state_counts())
+
+class TestResume(TestCase):
+	def test_unfinished_batches_removed_and_finished_ones_adopted(self):
+		file_handler = FakeFileHandler()
+		file_handler.batch_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, file_handler.batch_dir)
+		names = ["host_1d0_B0.zip.gpg", "host_2d0_B0.svb", "host_3d0_B0.zip", "host_3d0_B1.zip.gpg.part", "host_4d0_B0.svb.part", "host_4d0_B0.svb.frames", "notes.zip"]
+		for name in names:
+			open(os.path.join(file_handler.batch_dir, name), 'w').close()
+		journal = UploadJournal(":memory:")
+		pool = UploadWorkerPool(file_handler, num_workers=1, drive_handler_factory=FakeDriveHandler, journal=journal)
+		pool.resume()
+		# (anything that isn't ours is left alone)
+		self.assertListEqual(["host_1d0_B0.zip.gpg", "host_2d0_B0.svb", "notes.zip"], sorted(os.listdir(file_handler.batch_dir)))
+		self.assertListEqual([os.path.join(file_handler.batch_dir, x) for x in names[:2]], sorted(x['path'] for x in journal.pending()))
+		self.assertEqual(2, pool.job_queue.qsize())
+
+class TestFrameFilters(TestCase):
+	def test_filters_run_in_order_before_packaging(self):
+		file_handler = FakeFileHandler()
+		drop_b = lambda frames: [x for x in frames if x != "b.jpg"]
+		rename = lambda frames: [x.upper() for x in frames]
+		pool = UploadWorkerPool(file_handler, num_workers=1, drive_handler_factory=FakeDriveHandler, frame_filters=[drop_b, rename])
+		pool.start()
+		pool.submit_frames(["a.jpg", "b.jpg"])
+		# (the batch isn't going anywhere afterwards, so just wait for it to be packaged)
+		for _ in range(100):
+			if file_handler.packaged:
+				break
+			threading.Event().wait(0.05)
+		self.assertListEqual([["A.JPG"]], file_handler.packaged)
+
+class FakeBrokenFileHandler(FakeFileHandler):
+	def compress_and_encrypt_batch(self, frames):
+		# the first batch gets sealed, then something goes wrong
+		self.frames_packed = set(frame_name(x) for x in frames[:1])
+		raise RuntimeError("Failed to encrypt batch")
+
+class TestUnpackedFrames(TestCase):
+	def test_in_memory_frames_saved_when_packaging_fails(self):
+		spill_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, spill_dir)
+		pool = UploadWorkerPool(FakeBrokenFileHandler(), num_workers=1, drive_handler_factory=FakeDriveHandler, spill_dir=spill_dir)
+		pool.submit_frames([("./working_images/host_1d0.jpg", b'one'), ("./working_images/host_2d0.jpg", b'two'), "host_3d0.jpg"])
+		pool.start()
+		for _ in range(100):
+			if 0 == pool.stats()['frames_in_flight']:
+				break
+			threading.Event().wait(0.05)
+
+		# only the in-memory frame that wasn't sealed needs saving (the file's still where it was)
+		self.assertListEqual(["host_2d0.jpg"], os.listdir(spill_dir))
+		with open(os.path.join(spill_dir, "host_2d0.jpg"), 'rb') as f:
+			self.assertEqual(b'two', f.read())
+		self.assertEqual(1, pool.stats()['frames_spilled'])
+
+class FakeFailingDriveHandler:
+	def upload_file(self, path_to_file, batch_info=None):
+		return ""
+
+class TestUploadController(TestCase):
+	def test_controller_sees_uploads_and_sizes_batches(self):
+		file_handler = FakeFileHandler()
+		file_handler.max_batch_bytes = 0
+		controller = UploadController(start_bytes=10000000, min_bytes=1000000)
+		pool = UploadWorkerPool(file_handler, num_workers=1, drive_handler_factory=FakeFailingDriveHandler, controller=controller)
+		pool.upload_failed = lambda path: None
+		fd, path = tempfile.mkstemp()
+		os.write(fd, b'batch')
+		os.close(fd)
+		pool.upload_and_verify(path, None, FakeFailingDriveHandler())
+		os.remove(path)
+		self.assertEqual(1, controller.stats()['failures'])
+		self.assertEqual(5000000, controller.batch_bytes)
+		pool.submit_frames([("a.jpg", b'frame')])
+		pool.start()
+		for i in range(50):
+			if file_handler.packaged:
+				break
+			sleep(0.1)
+		self.assertEqual(5000000, file_handler.max_batch_bytes)
+
+	def test_ingest_is_observed_once_per_cycle(self):
+		self.now = 0
+		controller = UploadController(start_bytes=10000000, min_bytes=1000000, clock=lambda: self.now)
+		pool = UploadWorkerPool(FakeFileHandler(), num_workers=1, controller=controller)
+		pool.end_cycle()
+		self.now = 100
+		# the frame dirs, then the ring a moment later
+		pool.submit_frames([("a.jpg", b'x'*5000000)])
+		self.now = 100.01
+		pool.submit_frames([("b.jpg", b'x'*5000000)])
+		self.assertAlmostEqual(100, pool.end_cycle(), delta=0.1)
+		self.assertAlmostEqual(100000, controller.ingest_rate, delta=10)
@@ -1,6 +1,12 @@
+import os
+from time import sleep
 from unittest import TestCase
 from svlc.util import *
 
+def log_in_worker(msg):
+	get_logger('test_util.worker').warning(msg, extra=log_fields(marker="worker"))
+	return os.getpid()
+
 class TestParseFileName(TestCase):
 	def test_proper_format_int_timestamp(self):
 		fname = "svbase0_1513047.tar.gz"
@@ -14,6 +20,12 @@ class TestParseFileName(TestCase):
 		actual_result = parse_file_name(fname)
 		self.assertTupleEqual(expected_result,actual_result)
 
+	def test_batch_suffix(self):
+		fname = "svbase0_1513047{}3125_B2.zip.gpg".format(FILE_DEC_SEPARATOR)
+		expected_result = ("svbase0",1513047.3125)
+		actual_result = parse_file_name(fname)
+		self.assertTupleEqual(expected_result,actual_result)
+
 	def test_improper_format(self):
 		fname = "asdf.txt"
 		expected_result = (None,None)
@@ -80,4 +92,67 @@ class TestFloatToFilenameCompatibleStr(TestCase):
 		value = -1.5
 		expected_result = "-1{}5".format(FILE_DEC_SEPARATOR)
 		actual_result = float_to_filename_compatible_str(value)
-		self.assertEqual(expected_result,actual_result)
\ No newline at end of file
+		self.assertEqual(expected_result,actual_result)
+
+class TestLogging(TestCase):
+	def make_record(self, name="file_handler.FileHandler", msg="hello", **extra):
+		record = logging.LogRecord(name, logging.DEBUG, __file__, 0, msg, None, None)
+		record.__dict__.update(extra)
+		return record
+
+	def test_one_handler_no_duplicates(self):
+		parent = get_logger('test_util_parent')
+		child = get_logger('test_util_parent.Child')
+		get_logger('test_util_parent.Child')
+		self.assertEqual(1, len(child.handlers))
+		self.assertListEqual(child.handlers, parent.handlers)
+		self.assertFalse(child.propagate)
+
+	def test_stage_and_fields(self):
+		record = self.make_record()
+		StageFilter().filter(record)
+		self.assertEqual("file_handler", record.stage)
+		self.assertEqual("", record.field_str)
+		record = self.make_record(**log_fields('upload', batch="b0", secs=1.5))
+		StageFilter().filter(record)
+		self.assertEqual("upload", record.stage)
+		self.assertEqual("\tbatch=b0 secs=1.5", record.field_str)
+
+	def test_rate_limit(self):
+		limiter = RateLimitFilter(max_lines=2, window_secs=1000)
+		self.assertListEqual([True, True, False, False], [limiter.filter(self.make_record(**log_fields(rate_limit='x'))) for _ in range(4)])
+		# other keys and unkeyed lines aren't held up
+		self.assertTrue(limiter.filter(self.make_record(**log_fields(rate_limit='y'))))
+		self.assertTrue(limiter.filter(self.make_record()))
+		self.assertEqual(2, limiter.num_dropped)
+		# next window
+		limiter.windows['x'][0] -= 1000
+		record = self.make_record(**log_fields(rate_limit='x'))
+		self.assertTrue(limiter.filter(record))
+		self.assertEqual("hello (2 similar lines dropped)", record.msg)
+
+	def test_lines_reach_the_file(self):
+		get_logger('test_util').info("queued line", extra=log_fields(marker="test_lines_reach_the_file"))
+		flush_logs()
+		with open(LOGFILE_NAME) as f:
+			self.assertIn("[test_util] queued line\tmarker=test_lines_reach_the_file\n", f.read())
+
+	def test_worker_lines_reach_the_file(self):
+		with process_pool(1) as pool:
+			self.assertNotEqual(os.getpid(), pool.submit(log_in_worker, "logged in a worker").result())
+		# (it comes back through the worker's queue first)
+		for _ in range(100):
+			flush_logs()
+			with open(LOGFILE_NAME) as f:
+				if "[test_util] logged in a worker\tmarker=worker\n" in f.read():
+					break
+			sleep(0.05)
+		else:
+			self.fail("worker's log line never made it to the file")
+
+	def test_startup_milestones_only_count_once(self):
+		mark_startup('test_util milestone')
+		first = startup_profile()['test_util milestone']
+		mark_startup('test_util milestone')
+		self.assertEqual(first, startup_profile()['test_util milestone'])
+		self.assertGreaterEqual(first, 0)
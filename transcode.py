@@ -0,0 +1,192 @@
+"""
+transcode -- re-encodes frames so that each one fits in a byte budget, since zipping JPEGs gets us next to nothing
+"""
+
+from util import *
+from file_handler import frame_name
+
+import io
+from os import replace
+from os.path import basename
+from time import perf_counter
+
+from PIL import Image, ImageStat
+
+def scene_key(host, data):
+	"""
+	roughly what kind of scene this is -- which camera, and how bright (night frames compress very differently to day ones)
+	"""
+
+	thumb = Image.open(io.BytesIO(data))
+	thumb.draft('L', (64,48))
+	return "{}/{}".format(host, int(ImageStat.Stat(thumb.convert('L')).mean[0]) // 32)
+
+def encode(img, quality, scale=1):
+	if scale < 1:
+		img = img.resize((max(1, int(img.size[0]*scale)), max(1, int(img.size[1]*scale))), Image.BILINEAR)
+	stream = io.BytesIO()
+	img.save(stream, format='JPEG', quality=quality)
+	return stream.getvalue()
+
+def fit_to_budget(img, max_bytes, start_quality, min_quality=TRANSCODE_MIN_QUALITY, max_quality=TRANSCODE_MAX_QUALITY, max_encodes=TRANSCODE_MAX_ENCODES):
+	"""
+	find (close to) the highest JPEG quality that gets the image under max_bytes, starting from a guess
+
+	the guess is what worked for the last frame of the same scene, so usually it fits and all we do is try one step up in case the scene got easier. if it doesn't fit, binary search below it. if nothing fits even at min_quality, the image is downscaled until it does
+
+	returns: (encoded bytes, quality, scale, number of encodes), bytes is None if nothing fit
+	"""
+
+	quality = min(max(start_quality, min_quality), max_quality)
+	data = encode(img, quality)
+	num_encodes = 1
+	if len(data) <= max_bytes:
+		if quality < max_quality:
+			up = min(max_quality, quality + TRANSCODE_QUALITY_STEP)
+			up_data = encode(img, up)
+			num_encodes += 1
+			if len(up_data) <= max_bytes:
+				return up_data, up, 1, num_encodes
+		return data, quality, 1, num_encodes
+
+	best = None
+	lo, hi = min_quality, quality - 1
+	while (lo <= hi) and (num_encodes < max_encodes):
+		quality = (lo + hi) // 2
+		data = encode(img, quality)
+		num_encodes += 1
+		if len(data) <= max_bytes:
+			best = (data, quality)
+			lo = quality + 1
+		else:
+			hi = quality - 1
+	if best is not None:
+		return best[0], best[1], 1, num_encodes
+
+	# too detailed to fit at any quality we're willing to go down to -- shrink it
+	scale = 1
+	while scale > TRANSCODE_MIN_SCALE:
+		scale = max(TRANSCODE_MIN_SCALE, scale*0.75)
+		data = encode(img, min_quality, scale)
+		num_encodes += 1
+		if len(data) <= max_bytes:
+			return data, min_quality, scale, num_encodes
+	return None, None, None, num_encodes
+
+def transcode_frame(frame, max_bytes, quality_cache:dict):
+	"""
+	re-encode a single frame (file or (name, bytes) tuple) if it's over the budget. files are overwritten with the smaller version
+
+	runs in a worker process, so everything it needs is passed in and everything it learns is passed back. that includes errors -- one frame we can't decode mustn't take the rest of the batch down with it, so it's passed through as it was
+
+	returns: (frame, scene, quality found, original size, new size, number of encodes, error or None)
+	"""
+
+	name = frame_name(frame)
+	data = b''
+	try:
+		if isinstance(frame, str):
+			with open(frame, 'rb') as f:
+				data = f.read()
+		else:
+			data = frame[1]
+		if len(data) <= max_bytes:
+			return frame, None, None, len(data), len(data), 0, None
+
+		img = Image.open(io.BytesIO(data))
+		host, _ = parse_file_name(basename(name))
+		scene = scene_key(host, data)
+		new_data, quality, scale, num_encodes = fit_to_budget(img, max_bytes, quality_cache.get(scene, TRANSCODE_MAX_QUALITY))
+	except Exception as e:
+		return frame, None, None, len(data), len(data), 0, "{}: {}".format(type(e).__name__, e)
+	if new_data is None:
+		# leave it as it was, the packer will cope
+		return frame, scene, None, len(data), len(data), num_encodes, None
+
+	if isinstance(frame, str):
+		with open(frame + '.tmp', 'wb') as f:
+			f.write(new_data)
+		replace(frame + '.tmp', frame)
+		out = frame
+	else:
+		out = (name, new_data)
+	return out, scene, quality, len(data), len(new_data), num_encodes, None
+
+class FrameTranscoder:
+	"""
+	re-encodes every frame that's over <max_bytes> at the highest quality that fits, spread over a pool of worker processes
+
+	the quality that worked for each scene is remembered and used as the starting guess for the next frame of that scene
+	"""
+
+	def __init__(self, max_bytes=TRANSCODE_MAX_BYTES_PER_FRAME, num_workers=TRANSCODE_WORKERS):
+		self.max_bytes = max_bytes
+		self.num_workers = num_workers
+		self.executor = None # started on first use
+		self.quality_cache = {} # scene -> last quality that fit
+
+		# stats
+		self.num_frames = 0
+		self.num_transcoded = 0
+		self.num_encodes = 0
+		self.num_undecodable = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.transcode_secs = 0
+		self.log = get_logger('transcode.FrameTranscoder')
+
+	def transcode(self, frames:list):
+		"""
+		returns: the frames, re-encoded where needed, in the same order
+		"""
+
+		if not frames:
+			return frames
+		if (self.executor is None) and (self.num_workers > 0):
+			self.executor = process_pool(self.num_workers)
+
+		start_time = perf_counter()
+		num_frames = len(frames)
+		quality_cache = dict(self.quality_cache)
+		if self.executor is None:
+			results = [transcode_frame(x, self.max_bytes, quality_cache) for x in frames]
+		else:
+			results = list(self.executor.map(transcode_frame, frames, [self.max_bytes]*num_frames, [quality_cache]*num_frames, chunksize=max(1, num_frames // (4*self.num_workers))))
+
+		out = []
+		bytes_in, bytes_out = 0, 0
+		for frame, scene, quality, orig_bytes, new_bytes, num_encodes, error in results:
+			out.append(frame)
+			if error is not None:
+				# better to upload it over budget than to lose it
+				self.log.warning("Could not transcode frame {}, keeping it as it was: {}".format(frame_name(frame), error))
+				self.num_undecodable += 1
+			if quality is not None:
+				self.quality_cache[scene] = quality
+				self.num_transcoded += 1
+			self.num_encodes += num_encodes
+			bytes_in += orig_bytes
+			bytes_out += new_bytes
+		elapsed = perf_counter() - start_time
+		self.num_frames += num_frames
+		self.bytes_in += bytes_in
+		self.bytes_out += bytes_out
+		self.transcode_secs += elapsed
+		self.log.info("Transcoded {} frames: {} -> {} bytes in {:.2f} sec. Overall: {}".format(num_frames, bytes_in, bytes_out, elapsed, self.stats()))
+		return out
+
+	def stats(self):
+		return {
+			'frames': self.num_frames,
+			'transcoded': self.num_transcoded,
+			'undecodable': self.num_undecodable,
+			'encodes_per_transcode': 0 if 0 == self.num_transcoded else self.num_encodes / self.num_transcoded,
+			'ratio': 0 if 0 == self.bytes_in else self.bytes_out / self.bytes_in,
+			'ms_per_frame': 0 if 0 == self.num_frames else 1000*self.transcode_secs/self.num_frames,
+			'scene_qualities': dict(self.quality_cache),
+		}
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
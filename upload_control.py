@@ -0,0 +1,141 @@
+"""
+upload_control -- sizes batches and paces uploads to suit the uplink, from how the uploads themselves are going
+"""
+
+from util import *
+
+import threading
+from collections import deque
+from time import monotonic
+
+class UploadController:
+	"""
+	tunes the target batch size and the upload interval as uploads succeed and fail
+
+	every upload is measured (bytes, secs, whether it made it), feeding moving averages of throughput, latency and error rate. an upload that made it in under <timeout secs> grows the batch size by <grow factor>, but never past what the measured throughput gets up in <target secs>. one that failed or took longer than that shrinks it by <shrink factor>. the batch size stays within [min bytes, max bytes]
+
+	the upload interval is however long it takes to capture a batch's worth of frames (so batches actually fill up), doubled for every failure in a row, within [min secs, max secs]
+
+	safe to share between the upload worker threads. nothing is pushed anywhere -- whoever's packing and scheduling uploads reads batch_bytes and interval when they need them
+	"""
+
+	def __init__(self, start_bytes=MAX_FILE_SIZE_PER_UPLOAD, min_bytes=ADAPTIVE_BATCH_MIN_BYTES, max_bytes=ADAPTIVE_BATCH_MAX_BYTES, start_secs=SECS_PER_UPLOAD, min_secs=ADAPTIVE_UPLOAD_MIN_SECS, max_secs=ADAPTIVE_UPLOAD_MAX_SECS, target_secs=ADAPTIVE_UPLOAD_TARGET_SECS, timeout_secs=ADAPTIVE_UPLOAD_TIMEOUT_SECS, grow_factor=ADAPTIVE_GROW_FACTOR, shrink_factor=ADAPTIVE_SHRINK_FACTOR, alpha=ADAPTIVE_STATS_ALPHA, history_len=ADAPTIVE_HISTORY_LEN, clock=monotonic):
+		self.min_bytes = min_bytes
+		self.max_bytes = max_bytes
+		self.min_secs = min_secs
+		self.max_secs = max_secs
+		self.target_secs = target_secs
+		self.timeout_secs = timeout_secs
+		self.grow_factor = grow_factor
+		self.shrink_factor = shrink_factor
+		self.alpha = alpha
+		self.clock = clock
+		self.batch_bytes = int(min(max_bytes, max(min_bytes, start_bytes)))
+		self.start_secs = start_secs
+		self.interval = min(max_secs, max(min_secs, start_secs))
+		self.lock = threading.Lock()
+		self.history = deque(maxlen=history_len) # the most recent decisions that changed something
+
+		# moving averages (None until there's something to average)
+		self.throughput = None # bytes/s while uploading
+		self.latency = None # s per upload
+		self.error_rate = None # fraction of uploads that failed or timed out
+		self.ingest_rate = None # bytes/s of frames handed over to be uploaded
+		self.last_ingest_time = None
+		self.consecutive_failures = 0
+
+		# stats
+		self.num_uploads = 0
+		self.num_failures = 0
+		self.num_timeouts = 0
+		self.num_changes = 0
+		self.log = get_logger('upload_control.UploadController')
+
+	def average(self, old, new):
+		return new if old is None else (1 - self.alpha)*old + self.alpha*new
+
+	def observe_upload(self, num_bytes, secs, ok):
+		"""
+		adjust the batch size and upload interval given how an upload of <num bytes> went
+
+		returns: the target batch size (bytes)
+		"""
+
+		with self.lock:
+			self.num_uploads += 1
+			timed_out = ok and (secs > self.timeout_secs)
+			self.latency = self.average(self.latency, secs)
+			self.error_rate = self.average(self.error_rate, 0 if (ok and not timed_out) else 1)
+			if ok and (secs > 0):
+				# (a failed upload gives up partway, so its bytes/s mean nothing)
+				self.throughput = self.average(self.throughput, num_bytes / secs)
+
+			if not ok:
+				self.num_failures += 1
+				self.consecutive_failures += 1
+				decision = 'failed'
+				new_bytes = self.batch_bytes*self.shrink_factor
+			elif timed_out:
+				self.num_timeouts += 1
+				self.consecutive_failures += 1
+				decision = 'timed out'
+				new_bytes = self.batch_bytes*self.shrink_factor
+			else:
+				self.consecutive_failures = 0
+				decision = 'ok'
+				new_bytes = self.batch_bytes*self.grow_factor
+				if self.throughput is not None:
+					new_bytes = min(new_bytes, max(self.batch_bytes, self.throughput*self.target_secs))
+			self.decide(decision, new_bytes)
+			return self.batch_bytes
+
+	def observe_ingest(self, num_bytes):
+		"""
+		note that <num bytes> of frames have just been handed over to be uploaded (all of them since the last call), and adjust the upload interval to match
+
+		returns: the upload interval (s)
+		"""
+
+		with self.lock:
+			now = self.clock()
+			if (self.last_ingest_time is not None) and (now > self.last_ingest_time):
+				self.ingest_rate = self.average(self.ingest_rate, num_bytes / (now - self.last_ingest_time))
+			self.last_ingest_time = now
+			self.decide('ingest', self.batch_bytes)
+			return self.interval
+
+	def decide(self, decision, new_bytes):
+		"""
+		settle on a new batch size (kept in bounds) and the upload interval that goes with it, and note down what changed (call with the lock held)
+		"""
+
+		new_bytes = int(min(self.max_bytes, max(self.min_bytes, new_bytes)))
+		new_interval = self.start_secs if self.ingest_rate in (None, 0) else new_bytes / self.ingest_rate
+		if self.consecutive_failures > 0:
+			# (capped so a long outage can't overflow it)
+			new_interval *= 2 ** min(self.consecutive_failures, 16)
+		new_interval = min(self.max_secs, max(self.min_secs, new_interval))
+		if (new_bytes == self.batch_bytes) and (new_interval == self.interval):
+			return
+
+		self.log.info("Batch size {} -> {} bytes, upload interval {:.1f} -> {:.1f} sec ({})".format(self.batch_bytes, new_bytes, self.interval, new_interval, decision), extra=log_fields('upload', decision=decision, batch_bytes=new_bytes, interval=round(new_interval, 1), throughput=None if self.throughput is None else round(self.throughput), error_rate=None if self.error_rate is None else round(self.error_rate, 3)))
+		self.history.append({'time': self.clock(), 'decision': decision, 'old_batch_bytes': self.batch_bytes, 'batch_bytes': new_bytes, 'old_interval': self.interval, 'interval': new_interval})
+		self.batch_bytes = new_bytes
+		self.interval = new_interval
+		self.num_changes += 1
+
+	def stats(self):
+		with self.lock:
+			return {
+				'batch_bytes': self.batch_bytes,
+				'interval': self.interval,
+				'throughput': self.throughput,
+				'latency': self.latency,
+				'error_rate': self.error_rate,
+				'ingest_rate': self.ingest_rate,
+				'uploads': self.num_uploads,
+				'failures': self.num_failures,
+				'timeouts': self.num_timeouts,
+				'changes': self.num_changes,
+				'history': list(self.history),
+			}
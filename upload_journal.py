@@ -0,0 +1,111 @@
+"""
+upload_journal -- crash-safe record of where every batch is on its way from packaged to uploaded, verified and deleted
+"""
+
+from util import *
+
+import json
+import sqlite3
+import threading
+from time import time
+
+# the states a batch goes through, in order. failed batches wait (in the local backup dir) for a retry
+JOURNAL_STATES = ['packaged', 'uploading', 'uploaded', 'verified', 'deleted', 'failed']
+# states where there's still something left to do
+PENDING_STATES = ['packaged', 'uploading', 'uploaded', 'verified', 'failed']
+
+class UploadJournal:
+	"""
+	write-ahead journal of batch states, keyed by local path. every state change is committed to disk before we act on it, so that after a crash we know exactly where each batch got to
+
+	safe to share between the upload worker threads
+	"""
+
+	def __init__(self, db_path=UPLOAD_JOURNAL_DB_LOC):
+		self.conn = sqlite3.connect(db_path, check_same_thread=False)
+		self.lock = threading.Lock()
+		self.log = get_logger('upload_journal.UploadJournal')
+		with self.lock, self.conn:
+			# make sure a commit really is on the disk before we move on
+			self.conn.execute("PRAGMA synchronous=FULL")
+			self.conn.execute("CREATE TABLE IF NOT EXISTS journal (path TEXT PRIMARY KEY, state TEXT NOT NULL, file_id TEXT, batch_info TEXT, attempts INTEGER DEFAULT 0, next_attempt_at REAL DEFAULT 0, updated_at REAL)")
+			# nothing left to do for these
+			self.conn.execute("DELETE FROM journal WHERE state = 'deleted'")
+
+	def record(self, path, state, file_id=None, batch_info=None):
+		"""
+		move the given batch into the given state (file ID and batch info are only overwritten if given)
+		"""
+
+		if state not in JOURNAL_STATES:
+			raise ValueError("Unknown journal state: {}".format(state))
+		with self.lock, self.conn:
+			self.conn.execute("INSERT INTO journal (path, state, file_id, batch_info, updated_at) VALUES (?,?,?,?,?) ON CONFLICT(path) DO UPDATE SET state=excluded.state, file_id=COALESCE(excluded.file_id, file_id), batch_info=COALESCE(excluded.batch_info, batch_info), updated_at=excluded.updated_at", (path, state, file_id, None if batch_info is None else json.dumps(batch_info), time()))
+
+	def adopt(self, paths, state='failed'):
+		"""
+		start tracking any of the given files the journal doesn't already know about (e.g. left behind by a crash, or from before there was a journal)
+
+		returns: the paths that were adopted
+		"""
+
+		with self.lock, self.conn:
+			known = set(x[0] for x in self.conn.execute("SELECT path FROM journal").fetchall())
+			adopted = [x for x in paths if x not in known]
+			self.conn.executemany("INSERT INTO journal (path, state, updated_at) VALUES (?,?,?)", [(x, state, time()) for x in adopted])
+		if adopted:
+			self.log.warning("Adopted {} untracked batches into the upload journal: {}".format(len(adopted), adopted))
+		return adopted
+
+	def move(self, old_path, new_path):
+		"""
+		the batch at old_path now lives at new_path
+		"""
+
+		with self.lock, self.conn:
+			self.conn.execute("UPDATE journal SET path = ?, updated_at = ? WHERE path = ?", (new_path, time(), old_path))
+
+	def failed(self, path, base_secs=UPLOAD_RETRY_BACKOFF_BASE_SECS, max_secs=UPLOAD_RETRY_BACKOFF_MAX_SECS):
+		"""
+		mark the batch as failed and push its next attempt back (exponentially, up to a limit)
+		"""
+
+		with self.lock, self.conn:
+			row = self.conn.execute("SELECT attempts FROM journal WHERE path = ?", (path,)).fetchone()
+			attempts = (0 if row is None else row[0]) + 1
+			delay = min(max_secs, base_secs * (2 ** (attempts - 1)))
+			self.conn.execute("UPDATE journal SET state = 'failed', attempts = ?, next_attempt_at = ?, updated_at = ? WHERE path = ?", (attempts, time() + delay, time(), path))
+		return delay
+
+	def reset_backoff(self):
+		"""
+		make every failed batch due for a retry right away (e.g. because uploads are working again)
+		"""
+
+		with self.lock, self.conn:
+			self.conn.execute("UPDATE journal SET next_attempt_at = 0 WHERE state = 'failed' AND next_attempt_at > 0")
+
+	def pending(self, now=None):
+		"""
+		every batch that still has something left to do and isn't waiting out a backoff, oldest first
+
+		returns: list of dicts with 'path', 'state', 'file_id', 'batch_info' and 'attempts'
+		"""
+
+		now = time() if now is None else now
+		with self.lock:
+			rows = self.conn.execute("SELECT path, state, file_id, batch_info, attempts FROM journal WHERE state IN ({}) AND next_attempt_at <= ? ORDER BY updated_at".format(",".join("?"*len(PENDING_STATES))), PENDING_STATES + [now]).fetchall()
+		return [{'path': path, 'state': state, 'file_id': file_id, 'batch_info': None if batch_info is None else json.loads(batch_info), 'attempts': attempts} for path, state, file_id, batch_info, attempts in rows]
+
+	def state_of(self, path):
+		"""
+		returns: the state the given batch is in, or None if the journal doesn't know it
+		"""
+
+		with self.lock:
+			row = self.conn.execute("SELECT state FROM journal WHERE path = ?", (path,)).fetchone()
+		return None if row is None else row[0]
+
+	def state_counts(self):
+		with self.lock:
+			return dict(self.conn.execute("SELECT state, COUNT(*) FROM journal GROUP BY state").fetchall())
@@ -0,0 +1,422 @@
+"""
+uploader -- background packaging and upload workers, so that the capture loop never has to wait on compression, encryption or the network
+"""
+
+from util import *
+from file_handler import *
+from upload_journal import *
+from upload_control import *
+
+import threading
+from functools import partial
+from glob import glob
+from queue import Queue, Full
+from os import replace
+from time import time
+
+def default_drive_handler():
+	# the drive stack takes a while to import, so it's left until an upload worker actually needs it
+	from gdrive_handler import GDriveHandler
+	return GDriveHandler()
+
+class UploadWorkerPool:
+	"""
+	one packaging thread feeding a bounded queue of jobs that are worked through by a fixed number of upload threads
+
+	jobs are callables that take a GDriveHandler. each upload thread gets its own handler, since the underlying http connection can't be shared between threads. handlers are built on the upload threads, so nothing to do with drive ever holds up whoever started the pool. a thread that can't build one (e.g. we booted with no network) keeps trying, backing off from <handler retry base secs> up to <handler retry max secs>, and jobs wait in the queue until it can
+
+	if given frame filters (callables taking and returning a list of frames, e.g. MotionFilter.filter), they're run in order over each list of frames on the packaging thread before they're packaged
+
+	in-memory frames only exist in the list they were handed over in, so any that don't make it into a sealed batch (packaging failed, or their batch was skipped) are written out to <spill dir> to be picked up from there next time, like frames captured to disk
+
+	if given a journal, every batch's progress is recorded in it so that anything interrupted by a crash (or that failed and was backed up) gets picked up again by retry_pending. batches are journaled the moment they're sealed, before the frames that went into them are removed
+
+	stop stops taking jobs and waits for the ones under way, so nothing's pulled out from under them (e.g. by a staging flush on the way out)
+
+	if given a controller, it's told how much is handed over in each upload cycle (see end_cycle) and how every upload goes, and the file handler packs batches to the size it settles on
+	"""
+
+	def __init__(self, file_handler:FileHandler, num_workers=UPLOAD_WORKERS, max_queue_depth=UPLOAD_QUEUE_DEPTH, drive_handler_factory=default_drive_handler, journal:UploadJournal=None, frame_filters=(), controller:UploadController=None, spill_dir=PATH_TO_IMAGES, handler_retry_base_secs=DRIVE_HANDLER_RETRY_BASE_SECS, handler_retry_max_secs=DRIVE_HANDLER_RETRY_MAX_SECS):
+		self.file_handler = file_handler
+		self.controller = controller
+		self.frame_filters = frame_filters
+		self.spill_dir = spill_dir
+		self.journal = journal
+		self.batches_in_flight = set() # batches that have been queued for a worker but not finished with yet
+		self.num_workers = num_workers
+		self.drive_handler_factory = drive_handler_factory
+		self.handler_retry_base_secs = handler_retry_base_secs
+		self.handler_retry_max_secs = handler_retry_max_secs
+		self.package_queue = Queue(maxsize=max_queue_depth) # lists of frames waiting to be packaged
+		self.job_queue = Queue(maxsize=max_queue_depth) # jobs waiting for an upload worker
+		self.frames_in_flight = set() # names of frames that have been handed over but not yet packaged
+		self.cycle_bytes = 0 # bytes of frames handed over since the end of the last upload cycle
+		self.lock = threading.Lock()
+		self.threads = []
+		self.start_time = None
+		self.stopping = threading.Event()
+		# batches sealed by the packaging thread that haven't been queued for upload yet
+		self.sealed = []
+		file_handler.on_sealed = self.batch_sealed
+
+		# stats
+		self.num_busy_workers = 0
+		self.busy_secs = 0
+		self.num_jobs_done = 0
+		self.num_jobs_turned_away = 0
+		self.num_handler_failures = 0
+		self.num_frames_spilled = 0
+		self.log = get_logger('uploader.UploadWorkerPool')
+
+	def start(self):
+		self.start_time = time()
+		self.threads.append(threading.Thread(target=self.package_loop, name='packager', daemon=True))
+		for i in range(self.num_workers):
+			self.threads.append(threading.Thread(target=self.worker_loop, name='uploader{}'.format(i), daemon=True))
+		for thread in self.threads:
+			thread.start()
+
+	def submit_frames(self, frames:list):
+		"""
+		hand a list of frames (files, or (name, bytes) tuples from an in-memory capture) over to be packaged and uploaded. frames that were already handed over are ignored
+
+		never blocks -- returns False (and the frames stay where they are for next time) if the pipeline is backed up
+		"""
+
+		with self.lock:
+			frames = [x for x in frames if frame_name(x) not in self.frames_in_flight]
+			if 0 == len(frames):
+				return True
+			try:
+				self.package_queue.put_nowait(frames)
+			except Full:
+				self.num_jobs_turned_away += 1
+				self.log.warning("Packaging queue full, leaving {} frames for the next upload cycle.".format(len(frames)))
+				return False
+			self.frames_in_flight.update(frame_name(x) for x in frames)
+			self.cycle_bytes += sum(frame_size(x) for x in frames if (not isinstance(x, str)) or isfile(x))
+		return True
+
+	def end_cycle(self):
+		"""
+		call once everything for this upload cycle has been handed over (however many submit_frames that took), so the controller sees the cycle's ingest as a whole
+
+		returns: the upload interval (s) if there's a controller, otherwise None
+		"""
+
+		with self.lock:
+			num_bytes = self.cycle_bytes
+			self.cycle_bytes = 0
+		if self.controller is None:
+			return None
+		return self.controller.observe_ingest(num_bytes)
+
+	def submit_job(self, job, block=False):
+		"""
+		queue up a job (a callable taking a GDriveHandler) for the next free upload worker
+
+		returns False if the queue is full (only possible if not blocking)
+		"""
+
+		try:
+			if block:
+				# (keep an eye out for stop while we wait)
+				while True:
+					try:
+						self.job_queue.put(job, timeout=1)
+						break
+					except Full:
+						if self.stopping.is_set():
+							raise
+			else:
+				self.job_queue.put_nowait(job)
+		except Full:
+			with self.lock:
+				self.num_jobs_turned_away += 1
+			self.log.warning("Upload queue full, dropping job {}".format(job))
+			return False
+		return True
+
+	def package_loop(self):
+		while not self.stopping.is_set():
+			frames = self.package_queue.get()
+			if frames is None:
+				# (woken up by stop)
+				break
+			to_package = frames
+			self.sealed = []
+			try:
+				for frame_filter in self.frame_filters:
+					to_package = frame_filter(to_package)
+				if self.controller is not None:
+					self.file_handler.max_batch_bytes = self.controller.batch_bytes
+				self.file_handler.compress_and_encrypt_batch(to_package)
+				while self.sealed:
+					batch = self.sealed[0]
+					batch_info = self.file_handler.batch_info.pop(batch, None)
+					# wait for room rather than dropping the batch -- this only holds up packaging, not capture
+					if not self.submit_job(partial(self.upload_and_verify, batch, batch_info), block=True):
+						break
+					self.sealed.pop(0)
+			except Exception:
+				self.log.exception("Caught exception while packaging {} frames".format(len(frames)))
+			finally:
+				# anything sealed that never made it into the queue (packaging failed partway, or we're stopping) is in the journal, so it's left to retry_pending
+				with self.lock:
+					self.batches_in_flight.difference_update(self.sealed)
+				self.sealed = []
+				self.spill_unpacked(to_package)
+				with self.lock:
+					self.frames_in_flight.difference_update(frame_name(x) for x in frames)
+
+	def batch_sealed(self, stats):
+		"""
+		called by the file handler (on the packaging thread) as soon as a batch is sealed: mark it in flight so retry_pending can't grab it before it's queued, and journal it before the frames that went into it are removed
+		"""
+
+		with self.lock:
+			self.batches_in_flight.add(stats['batch'])
+		self.sealed.append(stats['batch'])
+		if self.journal is not None:
+			self.journal.record(stats['batch'], 'packaged', batch_info=stats)
+
+	def spill_unpacked(self, frames:list):
+		"""
+		write any of the given in-memory frames that didn't make it into a sealed batch out to the spill dir, so they aren't lost
+		"""
+
+		unpacked = [x for x in frames if (not isinstance(x, str)) and (x[0] not in self.file_handler.frames_packed)]
+		if 0 == len(unpacked):
+			return
+		if not isdir(self.spill_dir):
+			makedirs(self.spill_dir)
+		num_spilled = 0
+		for name, data in unpacked:
+			path = join(self.spill_dir, basename(name))
+			try:
+				# (written under another name first so the next upload cycle never picks up half a frame)
+				with open(path + '.tmp', 'wb') as f:
+					f.write(data)
+				replace(path + '.tmp', path)
+			except OSError as e:
+				self.log.error("Couldn't save unpackaged frame {}: {}".format(name, e))
+				continue
+			num_spilled += 1
+		with self.lock:
+			self.num_frames_spilled += num_spilled
+		self.log.warning("Saved {} in-memory frames that didn't make it into a batch to {} for next time".format(num_spilled, self.spill_dir))
+
+	def upload_and_verify(self, path_to_file, batch_info, drive_handler:'GDriveHandler'):
+		"""
+		upload the given batch, verify it, and back it up locally if either fails
+		"""
+
+		try:
+			if self.journal is not None:
+				self.journal.record(path_to_file, 'uploading')
+			num_bytes = getsize(path_to_file) if isfile(path_to_file) else 0
+			start_time = time()
+			drive_file_id = drive_handler.upload_file(path_to_file, batch_info)
+			upload_secs = time() - start_time
+			if self.controller is not None:
+				self.controller.observe_upload(num_bytes, upload_secs, "" != drive_file_id)
+			if "" == drive_file_id:
+				self.upload_failed(path_to_file)
+				return
+			mark_startup('first upload')
+			self.log.info("Uploaded {} in {:.2f} sec".format(path_to_file, upload_secs), extra=log_fields('upload', batch=path_to_file, bytes=num_bytes, secs=round(upload_secs, 3)))
+			if self.journal is not None:
+				self.journal.record(path_to_file, 'uploaded', file_id=drive_file_id)
+			self.verify(path_to_file, drive_file_id, batch_info, drive_handler)
+		finally:
+			with self.lock:
+				self.batches_in_flight.discard(path_to_file)
+
+	def verify(self, path_to_file, drive_file_id, batch_info, drive_handler:'GDriveHandler'):
+		# (verify_upload deletes the local file if it passes)
+		if drive_handler.verify_upload(path_to_file, drive_file_id, None if batch_info is None else batch_info['md5']):
+			if self.journal is not None:
+				self.journal.record(path_to_file, 'verified')
+				self.journal.record(path_to_file, 'deleted')
+				# uploads are working, so don't leave anything waiting out a backoff
+				self.journal.reset_backoff()
+		else:
+			self.upload_failed(path_to_file)
+
+	def upload_failed(self, path_to_file):
+		# we need to back this file up
+		backup_path = local_backup([path_to_file])[0]
+		if self.journal is not None:
+			self.journal.move(path_to_file, backup_path)
+			delay = self.journal.failed(backup_path)
+			self.log.warning("Will retry uploading {} in {} sec".format(backup_path, delay))
+
+	def resume(self):
+		"""
+		on startup: clear out whatever a crash left half packed, pick up batches that never made it into the journal (a crash right after encrypting, or backups from before there was a journal), then get going on everything that was left unfinished
+		"""
+
+		if self.journal is None:
+			return
+		batches = []
+		for batch_dir in self.file_handler.batch_dirs():
+			self.remove_unfinished_batches(batch_dir)
+			batches.extend(glob(join(batch_dir, "*" + BatchPacker.suffix + ".gpg")) + glob(join(batch_dir, "*" + SeekableBatchPacker.suffix)))
+		self.journal.adopt(sorted(batches), 'packaged')
+		self.journal.adopt(backed_up_files(), 'failed')
+		self.log.info("Resuming from upload journal: {}".format(self.journal.state_counts()))
+		self.retry_pending()
+
+	def remove_unfinished_batches(self, batch_dir):
+		"""
+		remove what's left of batches that were still being packed when we went down: unencrypted archives, encrypted ones that never got renamed into place, and seekable batches' frames. their frames were only ever removed once a batch was sealed, so they'll be packed again
+		"""
+
+		for path in glob(join(batch_dir, "*" + BatchPacker.suffix)) + glob(join(batch_dir, "*" + PART_SUFFIX)) + glob(join(batch_dir, "*" + SeekableBatchPacker.suffix + ".frames")):
+			# (only ever our own, going by the name)
+			if parse_file_name(basename(path))[1] is None:
+				continue
+			self.log.warning("Removing unfinished batch file {} left behind from last time".format(path))
+			try:
+				remove(path)
+			except OSError as e:
+				self.log.error("Couldn't remove unfinished batch file {}: {}".format(path, e))
+
+	def retry_pending(self):
+		"""
+		hand anything in the journal that's due for another go back to the workers: batches left behind by a crash, and failed batches that have waited out their backoff
+
+		never blocks -- whatever doesn't fit in the queue waits for the next call
+		"""
+
+		if self.journal is None:
+			return
+
+		for entry in self.journal.pending():
+			path = entry['path']
+			with self.lock:
+				if path in self.batches_in_flight:
+					continue
+			if not isfile(path):
+				# nothing left to upload. the only things that remove a batch are a successful verification (which deletes it) or a backup (which we'd have followed), so it's done
+				self.log.info("Batch {} in journal state {} no longer exists locally, marking deleted".format(path, entry['state']))
+				self.journal.record(path, 'deleted')
+				continue
+
+			if 'verified' == entry['state']:
+				remove(path)
+				self.journal.record(path, 'deleted')
+				continue
+			elif ('uploaded' == entry['state']) and (entry['file_id'] is not None):
+				job = partial(self.verify_in_flight, path, entry['file_id'], entry['batch_info'])
+			else:
+				job = partial(self.upload_and_verify, path, entry['batch_info'])
+
+			with self.lock:
+				self.batches_in_flight.add(path)
+			if not self.submit_job(job):
+				with self.lock:
+					self.batches_in_flight.discard(path)
+				break
+			self.log.info("Retrying batch {} from journal state {} (attempt {})".format(path, entry['state'], entry['attempts'] + 1))
+
+	def verify_in_flight(self, path_to_file, drive_file_id, batch_info, drive_handler:'GDriveHandler'):
+		try:
+			self.verify(path_to_file, drive_file_id, batch_info, drive_handler)
+		finally:
+			with self.lock:
+				self.batches_in_flight.discard(path_to_file)
+
+	def new_drive_handler(self):
+		"""
+		build a drive handler for this thread, trying until it works
+
+		returns: the handler, or None if the pool was stopped first
+		"""
+
+		num_failures = 0
+		while True:
+			try:
+				drive_handler = self.drive_handler_factory()
+			except Exception:
+				num_failures += 1
+				with self.lock:
+					self.num_handler_failures += 1
+				delay = min(self.handler_retry_max_secs, self.handler_retry_base_secs * 2 ** min(num_failures - 1, 16))
+				self.log.exception("Couldn't set up google drive (attempt {}), trying again in {} sec".format(num_failures, delay), extra=log_fields(rate_limit='drive handler failed'))
+				if self.stopping.wait(delay):
+					return None
+				continue
+			mark_startup('drive handler ready')
+			return drive_handler
+
+	def worker_loop(self):
+		drive_handler = self.new_drive_handler()
+		while drive_handler is not None:
+			job = self.job_queue.get()
+			if (job is None) or self.stopping.is_set():
+				# (whatever was left in the queue is in the journal)
+				break
+			with self.lock:
+				self.num_busy_workers += 1
+			job_start_time = time()
+			try:
+				job(drive_handler)
+			except Exception:
+				self.log.exception("Caught exception while running upload job {}".format(job))
+			finally:
+				with self.lock:
+					self.num_busy_workers -= 1
+					self.busy_secs += time() - job_start_time
+					self.num_jobs_done += 1
+
+	def stop(self, timeout=UPLOAD_POOL_STOP_SECS):
+		"""
+		stop taking jobs, and wait (up to <timeout> sec all told) for the packaging and uploads under way to finish. anything still queued is in the journal for next time
+
+		returns: whether every thread has finished
+		"""
+
+		self.stopping.set()
+		# wake up anyone waiting on an empty queue (a full one's being worked through, and gets checked between jobs)
+		for queue, num_waiting in ((self.package_queue, 1), (self.job_queue, self.num_workers)):
+			for i in range(num_waiting):
+				try:
+					queue.put_nowait(None)
+				except Full:
+					break
+		deadline = time() + timeout
+		for thread in self.threads:
+			thread.join(max(0, deadline - time()))
+		still_running = [x.name for x in self.threads if x.is_alive()]
+		if still_running:
+			self.log.warning("Upload pool threads {} still busy after {} sec, leaving them to it".format(still_running, timeout))
+		return 0 == len(still_running)
+
+	def paths_in_flight(self):
+		"""
+		returns: every frame and batch the pool is currently working on
+		"""
+
+		with self.lock:
+			return self.frames_in_flight | self.batches_in_flight
+
+	def stats(self):
+		"""
+		snapshot of queue depths and worker utilisation (fraction of worker time spent on jobs since start)
+		"""
+
+		with self.lock:
+			elapsed = 0 if self.start_time is None else time() - self.start_time
+			return {
+				'package_queue_depth': self.package_queue.qsize(),
+				'job_queue_depth': self.job_queue.qsize(),
+				'frames_in_flight': len(self.frames_in_flight),
+				'batches_in_flight': len(self.batches_in_flight),
+				'busy_workers': self.num_busy_workers,
+				'utilisation': 0 if 0 == elapsed else self.busy_secs / (elapsed * self.num_workers),
+				'jobs_done': self.num_jobs_done,
+				'jobs_turned_away': self.num_jobs_turned_away,
+				'handler_failures': self.num_handler_failures,
+				'frames_spilled': self.num_frames_spilled,
+			}
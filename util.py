@@ -7,7 +7,16 @@ from constants import *
 from time import time
 import logging
 import logging.config
-logging.config.fileConfig('logging.conf',disable_existing_loggers=False)
+import logging.handlers
+import queue
+import threading
+import atexit
+import multiprocessing
+
+# worker processes (see process_pool) get their own copy of this module, but log through their parent
+_in_worker = 'MainProcess' != multiprocessing.current_process().name
+if not _in_worker:
+	logging.config.fileConfig('logging.conf',disable_existing_loggers=False)
 
 def get_hostname():
 	"""
@@ -37,7 +46,8 @@ def parse_file_name(filename):
 	given the string that is the name of a file (regardless of type), get its source and creation time (s since epoch)
 	"""
 
-	re_match = re.match(r"(\w+)_(-?\d+" + FILE_DEC_SEPARATOR + r"?\d*)\..*",filename)
+	# batches have a _B<batch number> suffix on the timestamp
+	re_match = re.match(r"(\w+)_(-?\d+" + FILE_DEC_SEPARATOR + r"?\d*)(?:_B\d+)?\..*",filename)
 	if re_match is None:
 		return None,None
 	else:
@@ -69,9 +79,84 @@ def float_to_filename_compatible_str(f:float):
 		
 	return "{}{}{}".format(integer_part,FILE_DEC_SEPARATOR,decimal_part)
 
+# when we started (near enough -- util is the first thing everything imports), for the startup profile
+START_TIME = time()
+
 # create the logfile name once at program start
 LOGFILE_NAME = "{}_STARTAT_{}.log".format(get_hostname(),float_to_filename_compatible_str(time()))
 
+class StageFilter(logging.Filter):
+	"""
+	fills in the structured fields every log line gets: the stage of the pipeline it came from (the module it was logged in, unless the call says otherwise) and any extra key=value fields logged with it
+	"""
+
+	def filter(self, record):
+		if getattr(record, 'stage', None) is None:
+			record.stage = record.name.split('.')[0]
+		fields = getattr(record, 'fields', None)
+		record.field_str = "" if not fields else "\t" + " ".join("{}={}".format(k, v) for k, v in fields.items())
+		return True
+
+class RateLimitFilter(logging.Filter):
+	"""
+	lets through at most <max lines> lines with the same rate limit key every <window secs>, and drops the rest. lines without a key are never limited
+
+	the first line let through after some have been dropped says how many were
+	"""
+
+	def __init__(self, max_lines=LOG_RATE_LIMIT_LINES, window_secs=LOG_RATE_LIMIT_SECS):
+		super().__init__()
+		self.max_lines = max_lines
+		self.window_secs = window_secs
+		self.windows = {} # key -> [start of the current window, lines let through in it, lines dropped from it]
+		self.num_dropped = 0
+		self.lock = threading.Lock()
+
+	def filter(self, record):
+		key = getattr(record, 'rate_limit', None)
+		if key is None:
+			return True
+		now = time()
+		with self.lock:
+			window = self.windows.get(key)
+			if (window is None) or (now - window[0] >= self.window_secs):
+				if (window is not None) and (window[2] > 0):
+					record.msg = "{} ({} similar lines dropped)".format(record.msg, window[2])
+				window = self.windows[key] = [now, 0, 0]
+			if window[1] >= self.max_lines:
+				window[2] += 1
+				self.num_dropped += 1
+				return False
+			window[1] += 1
+			return True
+
+def log_fields(stage=None, rate_limit=None, **fields):
+	"""
+	structured extras for a log call, e.g. log.info("...", extra=log_fields('upload', batch=name, secs=1.2))
+
+	stage overrides the stage the line is filed under, and lines sharing a rate_limit key are rate limited together
+	"""
+
+	return {'stage': stage, 'rate_limit': rate_limit, 'fields': fields}
+
+# every logger feeds the one file handler through an (unbounded) queue, so logging never has to wait on the disk. the listener thread does the writing
+_log_queue = queue.Queue()
+_log_file_handler = logging.FileHandler(LOGFILE_NAME, delay=True)
+_log_file_handler.setLevel(logging.DEBUG)
+_log_formatter = logging.Formatter("%(asctime)s:\t%(name)s - %(levelname)s:\t[%(stage)s] %(message)s%(field_str)s")
+_log_formatter.datefmt = "%Y-%m-%d %H:%M:%S %Z"
+_log_file_handler.setFormatter(_log_formatter)
+_log_rate_limiter = RateLimitFilter()
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_queue_handler.addFilter(_log_rate_limiter)
+_log_queue_handler.addFilter(StageFilter())
+# (workers get theirs from init_worker_logging)
+if not _in_worker:
+	_log_listener = logging.handlers.QueueListener(_log_queue, _log_file_handler)
+	_log_listener.start()
+	# write out whatever's still queued on the way out
+	atexit.register(_log_listener.stop)
+
 def get_logger(loc):
 	"""
 	get a logger object pointing to the latched logfile name with proper formatting
@@ -79,15 +164,96 @@ def get_logger(loc):
 
 	# create the logger object
 	logger = logging.getLogger(loc) # TODO include file/class name here?
-	# create file handler to put all stuff into the file
-	fh = logging.FileHandler(LOGFILE_NAME)
-	fh.setLevel(logging.DEBUG)
-	fmtr = logging.Formatter("%(asctime)s:\t%(name)s - %(levelname)s:\t%(message)s")
-	fmtr.datefmt = "%Y-%m-%d %H:%M:%S %Z"
-	fh.setFormatter(fmtr)
-	logger.addHandler(fh)
+	if _log_queue_handler not in logger.handlers:
+		logger.addHandler(_log_queue_handler)
+	# the handler's on every logger we hand out, so don't let lines go round again through a parent (e.g. file_handler.FileHandler -> file_handler)
+	logger.propagate = False
 	return logger
 
+_worker_log_queue = None # what worker processes log into (made with the first process pool)
+_worker_log_lock = threading.Lock()
+
+def init_worker_logging(log_queue):
+	"""
+	initializer for worker processes: everything they log goes back to the parent through <log queue>
+	"""
+
+	_log_queue_handler.queue = log_queue
+
+def process_pool(num_workers):
+	"""
+	a pool of worker processes for CPU heavy work (packaging, transcoding)
+
+	by the time one's needed we've got threads running (and holding locks, like the log queue's), so workers are started from a fork server rather than forked from us mid-flight. whatever they log is fed into our own log queue
+
+	returns: the ProcessPoolExecutor
+	"""
+
+	global _worker_log_queue
+	from concurrent.futures import ProcessPoolExecutor
+
+	mp_context = multiprocessing.get_context('forkserver')
+	# (nothing of ours gets imported into the fork server itself, each worker imports what it needs)
+	mp_context.set_forkserver_preload([])
+	with _worker_log_lock:
+		if _worker_log_queue is None:
+			_worker_log_queue = mp_context.Queue()
+			worker_log_listener = logging.handlers.QueueListener(_worker_log_queue, logging.handlers.QueueHandler(_log_queue))
+			worker_log_listener.start()
+			atexit.register(worker_log_listener.stop)
+	return ProcessPoolExecutor(max_workers=num_workers, mp_context=mp_context, initializer=init_worker_logging, initargs=(_worker_log_queue,))
+
+def reopen_log_files():
+	"""
+	make the log file handler close its file and open LOGFILE_NAME again on its next write (e.g. once the old log has been renamed out of the way)
+	"""
+
+	_log_file_handler.acquire()
+	try:
+		if _log_file_handler.stream is not None:
+			_log_file_handler.stream.close()
+			_log_file_handler.stream = None
+	finally:
+		_log_file_handler.release()
+
+def flush_logs():
+	"""
+	wait for everything logged so far to be written out
+	"""
+
+	_log_queue.join()
+
+_startup_marks = {} # milestone -> s after START_TIME it was first hit
+_startup_lock = threading.Lock()
+
+def mark_startup(milestone):
+	"""
+	note the first time the given startup milestone (e.g. 'first frame') is hit. cheap enough to call every time it happens
+	"""
+
+	if milestone in _startup_marks:
+		return
+	with _startup_lock:
+		if milestone in _startup_marks:
+			return
+		secs = time() - START_TIME
+		_startup_marks[milestone] = secs
+	log.info("Startup: {} after {:.3f} sec".format(milestone, secs), extra=log_fields('startup', milestone=milestone, secs=round(secs, 3)))
+
+def startup_profile():
+	"""
+	when each startup milestone was hit, in s since we started
+	"""
+
+	with _startup_lock:
+		return dict(_startup_marks)
+
+def log_stats():
+	return {
+		'queued': _log_queue.qsize(),
+		'dropped': _log_rate_limiter.num_dropped,
+	}
+
 log = get_logger('util')
 log.info("Starting log in {}".format(LOGFILE_NAME))
 